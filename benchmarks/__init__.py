@@ -0,0 +1,5 @@
+# Benchmarks for red-blue-world. Run them all and write the results as JSON with
+#
+#   python -m benchmarks --out results.json
+#
+# every benchmark function returns a json friendly dict, see benchmarks/__main__.py
@@ -0,0 +1,66 @@
+# Runs every benchmark and writes one JSON document, so results can be diffed across commits.
+#
+#   python -m benchmarks --out results.json
+#   python -m benchmarks --quick --only patches quilt
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from benchmarks import memory, patches, quilt, recorder, storage
+
+def _commit() -> str | None:
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', default=None, help='write the results here instead of stdout')
+    parser.add_argument('--quick', action='store_true', help='small sizes, for checking that everything runs')
+    parser.add_argument('--only', nargs='+', choices=['patches', 'quilt', 'storage', 'memory', 'recorder'])
+    args = parser.parse_args()
+
+    if args.quick:
+        sizes = {'steps': 2_000, 'transitions': 200, 'storage': [1_000], 'memory': 200}
+    else:
+        sizes = {'steps': 100_000, 'transitions': 5_000, 'storage': [10_000, 100_000, 1_000_000], 'memory': 20_000}
+
+    benchmarks = {
+        'patches': lambda: patches.run(sizes['steps']),
+        'quilt': lambda: quilt.run(sizes['transitions']),
+        'storage': lambda: storage.run(sizes['storage']),
+        'memory': lambda: memory.run(sizes['memory']),
+        'recorder': lambda: recorder.run(sizes['steps']),
+    }
+
+    results = {
+        'commit': _commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'results': {},
+    }
+    for name, bench in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        print(f'running {name}', file=sys.stderr)
+        results['results'][name] = bench()
+
+    text = json.dumps(results, indent=2)
+    if args.out is None:
+        print(text)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Memory growth of a Quilt over a long random walk, and bytes held per resident patch, sampled with tracemalloc.
+import tracemalloc
+from typing import Callable, Dict
+
+import numpy as np
+
+from red_blue_world.Quilt import Quilt
+from red_blue_world.patch_loader import patch_loader, patch_rng
+from red_blue_world.patches.gw import Action
+from red_blue_world.patches.pickyeater import ContinualCollectRGB, ContinualCollectXY
+
+def growth(transitions: int, samples: int, max_patches: int = 32, **quilt_args) -> Dict:
+    np.random.seed(0)
+    quilt = Quilt(max_patches=max_patches, **quilt_args)
+    quilt.reset()
+    rng = np.random.RandomState(0)
+
+    every = max(1, transitions // samples)
+    traced = []
+    tracemalloc.start()
+    for i in range(transitions):
+        a = [Action.up.value, Action.right.value, Action.down.value, Action.left.value][rng.randint(4)]
+        patch_id = quilt._active_patch_id
+        while quilt._active_patch_id == patch_id:
+            quilt.step(a)
+
+        if i % every == 0:
+            traced.append(tracemalloc.get_traced_memory()[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    quilt.close()
+
+    # the first half warms caches (sqlite, simplejson), growth after that is what leaks
+    half = len(traced) // 2
+    return {
+        'transitions': transitions,
+        'traced_bytes': traced,
+        'peak_bytes': peak,
+        'second_half_growth_bytes': traced[-1] - traced[half],
+    }
+
+# patches as a Quilt caches them
+PATCHES: Dict[str, Callable[[int], object]] = {
+    'gw': lambda i: patch_loader('gw', None, patch_rng(0, (i, 0)), observation_mode='state'),
+    'pe_xy': lambda i: ContinualCollectXY('bench', rng=np.random.default_rng(i), observation_mode='state'),
+    'pe_rgb': lambda i: ContinualCollectRGB('bench', rng=np.random.default_rng(i), observation_mode='state'),
+}
+
+def patch_bytes(name: str, n: int) -> Dict:
+    build = PATCHES[name]
+    build(0).reset()  # warm up module level caches
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    patches = []
+    for i in range(n):
+        patch = build(i)
+        patch.reset()
+        patches.append(patch)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return {'patches': n, 'bytes_per_patch': (after - before) / n}
+
+def run(transitions: int) -> Dict:
+    return {
+        'stored': growth(transitions, samples=20),
+        'procedural': growth(transitions, samples=20, world_seed=0),
+        'per_patch': {name: patch_bytes(name, max(transitions // 10, 10)) for name in PATCHES},
+    }
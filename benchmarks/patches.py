@@ -0,0 +1,48 @@
+# Single-patch step and construction throughput for ContinualGridWorld and the picky eater variants.
+import time
+from typing import Dict
+
+import numpy as np
+
+from red_blue_world.patches.gw import ContinualGridWorld
+from red_blue_world.patches.pickyeater import ContinualCollectPartial, ContinualCollectRGB, ContinualCollectXY
+
+PATCHES = {
+    'gw': lambda: ContinualGridWorld(15),
+    'pe_xy': lambda: ContinualCollectXY('bench', seed=0),
+    'pe_rgb': lambda: ContinualCollectRGB('bench', seed=0),
+    'pe_partial': lambda: ContinualCollectPartial('bench', seed=0),
+}
+
+def step_throughput(name: str, steps: int) -> Dict:
+    np.random.seed(0)
+    patch = PATCHES[name]()
+    patch.reset()
+
+    # the grid world reports leaving through an edge but keeps the agent, so any action is fine
+    actions = np.random.RandomState(0).randint(5, size=steps)
+    start = time.perf_counter()
+    for a in actions:
+        patch.step(int(a))
+    elapsed = time.perf_counter() - start
+
+    return {'steps': steps, 'seconds': elapsed, 'steps_per_sec': steps / elapsed}
+
+def build_throughput(name: str, patches: int) -> Dict:
+    # exploration builds a new patch on every transition
+    np.random.seed(0)
+    build = PATCHES[name]
+    build()
+
+    start = time.perf_counter()
+    for _ in range(patches):
+        build()
+    elapsed = time.perf_counter() - start
+
+    return {'patches': patches, 'seconds': elapsed, 'patches_per_sec': patches / elapsed}
+
+def run(steps: int) -> Dict:
+    return {
+        name: dict(step_throughput(name, steps), build=build_throughput(name, max(steps // 100, 10)))
+        for name in PATCHES
+    }
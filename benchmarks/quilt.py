@@ -0,0 +1,60 @@
+# Quilt.step throughput under random walks with frequent patch transitions,
+# with the latency of the steps that cross into another patch.
+import time
+from typing import Dict
+
+import numpy as np
+
+from red_blue_world.Quilt import Quilt
+from red_blue_world.patches.gw import Action
+
+def random_walk(transitions: int, max_patches: int, world_size: int, **quilt_args) -> Dict:
+    np.random.seed(0)
+    quilt = Quilt(max_patches=max_patches, **quilt_args)
+    quilt.reset()
+    rng = np.random.RandomState(0)
+
+    step_times = []
+    transition_times = []
+    start = time.perf_counter()
+    while len(transition_times) < transitions:
+        # walk straight in one direction until the agent changes patch, staying inside the world
+        x, y = quilt._active_patch_id
+        moves = [(Action.up.value, (x, y + 1)), (Action.right.value, (x + 1, y)),
+                 (Action.down.value, (x, y - 1)), (Action.left.value, (x - 1, y))]
+        moves = [a for a, (nx, ny) in moves if 0 <= nx < world_size and 0 <= ny < world_size]
+        a = moves[rng.randint(len(moves))]
+
+        patch_id = quilt._active_patch_id
+        while True:
+            t = time.perf_counter()
+            quilt.step(a)
+            elapsed = time.perf_counter() - t
+            if quilt._active_patch_id != patch_id:
+                transition_times.append(elapsed)
+                break
+            step_times.append(elapsed)
+
+    total = time.perf_counter() - start
+    quilt.close()
+
+    steps = len(step_times) + len(transition_times)
+    return {
+        'steps': steps,
+        'transitions': len(transition_times),
+        'steps_per_sec': steps / total,
+        'step_us': _percentiles(step_times),
+        'transition_us': _percentiles(transition_times),
+        'prefetch': quilt.prefetch_stats(),
+    }
+
+def run(transitions: int) -> Dict:
+    return {
+        'prefetch': random_walk(transitions, max_patches=32, world_size=1000),
+        'no_prefetch': random_walk(transitions, max_patches=32, world_size=1000, prefetch=False),
+        'procedural': random_walk(transitions, max_patches=32, world_size=1000, world_seed=0),
+    }
+
+def _percentiles(times) -> Dict:
+    us = np.asarray(times) * 1e6
+    return {'p50': float(np.percentile(us, 50)), 'p99': float(np.percentile(us, 99)), 'max': float(us.max())}
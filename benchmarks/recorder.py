@@ -0,0 +1,39 @@
+# Cost of recording every Quilt.step with a TrajectoryRecorder, relative to not recording.
+import shutil
+import tempfile
+import time
+from typing import Dict
+
+import numpy as np
+
+from red_blue_world.Quilt import Quilt
+from red_blue_world.Recorder import TrajectoryRecorder
+
+def steps_per_sec(steps: int, recorder: TrajectoryRecorder | None) -> float:
+    np.random.seed(0)
+    quilt = Quilt(max_patches=64, recorder=recorder)
+    quilt.reset()
+    actions = np.random.RandomState(0).randint(5, size=steps)
+
+    start = time.perf_counter()
+    for a in actions:
+        quilt.step(int(a))
+    if recorder is not None:
+        recorder.flush()
+    elapsed = time.perf_counter() - start
+
+    quilt.close()
+    return steps / elapsed
+
+def run(steps: int) -> Dict:
+    results = {'steps': steps, 'plain_steps_per_sec': steps_per_sec(steps, None)}
+    for format in ('npz', 'npy'):
+        path = tempfile.mkdtemp()
+        try:
+            with TrajectoryRecorder(path, chunk_size=4096, format=format) as recorder:
+                rate = steps_per_sec(steps, recorder)
+        finally:
+            shutil.rmtree(path)
+        results[f'{format}_steps_per_sec'] = rate
+        results[f'{format}_overhead'] = results['plain_steps_per_sec'] / rate - 1
+    return results
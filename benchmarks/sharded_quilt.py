@@ -0,0 +1,42 @@
+# Agent steps/second of a ShardedQuilt as the number of worker processes grows.
+# One worker per core is the intended setup, so run it on a box with at least as many cores as workers.
+#
+#   python benchmarks/sharded_quilt.py --agents 256 --workers 1 2 4 8 16 32
+import argparse
+import time
+
+import numpy as np
+
+from red_blue_world.ShardedQuilt import ShardedQuilt
+
+def bench(agents: int, workers: int, steps: int, region_size: int) -> float:
+    quilt = ShardedQuilt(agents, workers, region_size=region_size, copy_observation=False)
+    try:
+        quilt.reset()
+        rng = np.random.RandomState(0)
+        actions = rng.randint(5, size=(steps, agents))
+
+        start = time.perf_counter()
+        for a in actions:
+            quilt.step(a)
+        return agents * steps / (time.perf_counter() - start)
+    finally:
+        quilt.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--agents', type=int, default=256)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--steps', type=int, default=2000)
+    parser.add_argument('--region-size', type=int, default=8)
+    args = parser.parse_args()
+
+    print(f'{"workers":>8} {"steps/s":>12} {"speedup":>8}')
+    base = None
+    for workers in args.workers:
+        rate = bench(args.agents, workers, args.steps, args.region_size)
+        base = base or rate
+        print(f'{workers:>8} {rate:>12.0f} {rate / base:>8.2f}')
+
+if __name__ == '__main__':
+    main()
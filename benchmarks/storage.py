@@ -0,0 +1,77 @@
+# SqliteBasicStorage store/load throughput at various sizes.
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+from red_blue_world.StorageManager import StoreFactory, patch_key
+from benchmarks.storage_batching import patch_state
+
+def throughput(n: int, codec: str, batch_size: int) -> Dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        store = StoreFactory.create_store('sqlite_basic', os.path.join(tmp, 'bench.db'), codec=codec)
+        keys = [str(i) for i in range(n)]
+
+        start = time.perf_counter()
+        for lo in range(0, n, batch_size):
+            store.store_patches((keys[i], patch_state(i)) for i in range(lo, min(lo + batch_size, n)))
+        store_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for lo in range(0, n, batch_size):
+            store.load_patch_states(keys[lo:lo + batch_size])
+        load_batched_s = time.perf_counter() - start
+
+        # single loads are slow, time a sample of them
+        sample = keys[::max(1, n // 1000)]
+        start = time.perf_counter()
+        for key in sample:
+            store.load_patch_state(key)
+        load_single_s = time.perf_counter() - start
+
+        store.close()
+
+    return {
+        'patches': n,
+        'store_per_sec': n / store_s,
+        'load_batched_per_sec': n / load_batched_s,
+        'load_single_per_sec': len(sample) / load_single_s,
+    }
+
+def region(n: int, side: int = 7, repeats: int = 200) -> Dict:
+    """ side x side blocks out of a square world of about n patches, by range scan and by id. """
+    width = max(side, int(n ** 0.5))
+    with tempfile.TemporaryDirectory() as tmp:
+        store = StoreFactory.create_store('sqlite_basic', os.path.join(tmp, 'bench.db'), codec='binary')
+        coords = [(x, y) for x in range(width) for y in range(width)]
+        store.store_patches((patch_key(c), patch_state(i)) for i, c in enumerate(coords))
+
+        corners = [coords[(i * 7919) % len(coords)] for i in range(repeats)]
+        corners = [(min(x, width - side), min(y, width - side)) for x, y in corners]
+
+        start = time.perf_counter()
+        for x, y in corners:
+            store.load_region(x, y, x + side - 1, y + side - 1)
+        region_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for x, y in corners:
+            store.load_patch_states([patch_key((x + dx, y + dy)) for dx in range(side) for dy in range(side)])
+        by_id_s = time.perf_counter() - start
+
+        store.close()
+
+    return {
+        'patches': len(coords),
+        'side': side,
+        'region_per_sec': repeats / region_s,
+        'by_id_per_sec': repeats / by_id_s,
+    }
+
+def run(sizes: List[int], batch_size: int = 1000) -> Dict:
+    results: Dict = {
+        codec: [throughput(n, codec, batch_size) for n in sizes]
+        for codec in ('json', 'binary')
+    }
+    results['region'] = [region(n) for n in sizes]
+    return results
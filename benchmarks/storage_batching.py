@@ -0,0 +1,60 @@
+# Compares patches/second for SqliteBasicStorage.store_patch (one commit per patch)
+# against store_patches (one transaction per batch).
+#
+#   python benchmarks/storage_batching.py --sizes 10000 100000 1000000
+import argparse
+import os
+import tempfile
+import time
+
+from red_blue_world.StorageManager import StoreFactory
+
+def patch_state(i: int) -> dict:
+    # roughly the size of a serialized ContinualGridWorld patch
+    return {
+        'agent_loc': [i % 15, (i // 15) % 15],
+        'objects': [[k, 1 + k % 2, k % 15, k // 15] for k in range(22)],
+    }
+
+def bench_single(db_name: str, n: int, codec: str) -> float:
+    store = StoreFactory.create_store('sqlite_basic', db_name, codec=codec)
+    start = time.perf_counter()
+    for i in range(n):
+        store.store_patch(str(i), patch_state(i))
+    store.close()
+    return n / (time.perf_counter() - start)
+
+def bench_batched(db_name: str, n: int, batch_size: int, codec: str) -> float:
+    store = StoreFactory.create_store('sqlite_basic', db_name, codec=codec)
+    start = time.perf_counter()
+    for lo in range(0, n, batch_size):
+        store.store_patches((str(i), patch_state(i)) for i in range(lo, min(lo + batch_size, n)))
+    store.close()
+    return n / (time.perf_counter() - start)
+
+def bench_buffered(db_name: str, n: int, batch_size: int, codec: str) -> float:
+    store = StoreFactory.create_store('sqlite_basic', db_name, buffer_size=batch_size, codec=codec)
+    start = time.perf_counter()
+    for i in range(n):
+        store.store_patch(str(i), patch_state(i))
+    store.close()
+    return n / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--codec', default='json', choices=['json', 'binary'])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = os.path.join(tmp, 'bench.db')
+        print(f'{"patches":>10} {"single/s":>12} {"batched/s":>12} {"buffered/s":>12}')
+        for n in args.sizes:
+            single = bench_single(db_name, n, args.codec)
+            batched = bench_batched(db_name, n, args.batch_size, args.codec)
+            buffered = bench_buffered(db_name, n, args.batch_size, args.codec)
+            print(f'{n:>10} {single:>12.0f} {batched:>12.0f} {buffered:>12.0f}')
+
+if __name__ == '__main__':
+    main()
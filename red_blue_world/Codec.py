@@ -0,0 +1,239 @@
+import functools
+import math
+import struct
+import numpy as np
+import simplejson
+from abc import ABCMeta, abstractmethod
+from typing import Any, Dict
+
+# A codec turns a serialized patch state (the dict returned by Patch.serialize) into bytes and back.
+# Every encoding is self-describing, so a store can read rows written with any registered codec.
+# This keeps databases written before a store switched codecs readable.
+
+
+class Codec(metaclass=ABCMeta):
+    name: str
+
+    @abstractmethod
+    def encode(self, patch_state: Dict) -> bytes:
+        pass
+
+    # rows written before stores held blobs come back as text
+    @abstractmethod
+    def decode(self, data: bytes | str) -> Dict:
+        pass
+
+    @abstractmethod
+    def can_decode(self, data: bytes | str) -> bool:
+        pass
+
+
+class JsonCodec(Codec):
+    name = 'json'
+
+    def encode(self, patch_state: Dict) -> bytes:
+        return simplejson.dumps(patch_state, default=_to_json).encode('utf-8')
+
+    def decode(self, data: bytes | str) -> Dict:
+        return simplejson.loads(data)
+
+    def can_decode(self, data: bytes | str) -> bool:
+        # json is the fallback for anything that does not carry a binary header
+        return True
+
+
+class BinaryCodec(Codec):
+    """
+    Small fixed header followed by one record per key:
+        magic | uint16 n_entries
+        uint16 key_len | key | uint8 tag | payload
+
+    NumPy arrays (and rectangular numeric lists) are written as their raw buffers:
+        uint8 dtype_len | dtype | uint8 packed_len | packed dtype | uint8 ndim | uint32 * ndim shape | data
+    everything else falls back to a json payload:
+        uint32 len | json
+    """
+    name = 'binary'
+
+    MAGIC = b'RBW\x01'
+
+    _ARRAY = 1
+    _LIST = 2
+    _JSON = 3
+
+    def encode(self, patch_state: Dict) -> bytes:
+        out = [self.MAGIC, struct.pack('<H', len(patch_state))]
+        for key, value in patch_state.items():
+            k = key.encode('utf-8')
+            out.append(struct.pack('<H', len(k)))
+            out.append(k)
+
+            if isinstance(value, np.ndarray) and value.dtype.kind in 'biuf':
+                out.append(struct.pack('<B', self._ARRAY))
+                out.append(self._pack_array(value))
+                continue
+
+            arr = _numeric_array(value)
+            if arr is not None:
+                out.append(struct.pack('<B', self._LIST))
+                out.append(self._pack_array(arr))
+                continue
+
+            payload = simplejson.dumps(value, default=_to_json).encode('utf-8')
+            out.append(struct.pack('<BI', self._JSON, len(payload)))
+            out.append(payload)
+
+        return b''.join(out)
+
+    def decode(self, data: bytes | str) -> Dict:
+        assert isinstance(data, bytes)
+        view = memoryview(data)
+        offset = len(self.MAGIC)
+        (n,) = struct.unpack_from('<H', view, offset)
+        offset += 2
+
+        patch_state = {}
+        for _ in range(n):
+            (key_len,) = struct.unpack_from('<H', view, offset)
+            offset += 2
+            key = bytes(view[offset:offset + key_len]).decode('utf-8')
+            offset += key_len
+
+            (tag,) = struct.unpack_from('<B', view, offset)
+            offset += 1
+
+            if tag == self._JSON:
+                (length,) = struct.unpack_from('<I', view, offset)
+                offset += 4
+                patch_state[key] = simplejson.loads(bytes(view[offset:offset + length]))
+                offset += length
+                continue
+
+            arr, offset = self._unpack_array(view, offset, copy=tag == self._ARRAY)
+            patch_state[key] = arr if tag == self._ARRAY else arr.tolist()
+
+        return patch_state
+
+    def can_decode(self, data: bytes | str) -> bool:
+        return isinstance(data, bytes) and data[:len(self.MAGIC)] == self.MAGIC
+
+    def _pack_array(self, arr: np.ndarray) -> bytes:
+        # arrays holding small whole numbers (object status, coordinates) are packed
+        # into the smallest integer dtype and cast back to their own dtype on decode
+        packed = arr
+        if arr.size and arr.dtype.kind in 'iuf':
+            lo, hi = arr.min(), arr.max()
+            if np.isfinite(lo) and np.isfinite(hi):
+                small = _int_dtype(int(lo), int(hi))
+                if small is not None and small.itemsize < arr.dtype.itemsize:
+                    candidate = arr.astype(small)
+                    if arr.dtype.kind != 'f' or (candidate == arr).all():
+                        packed = candidate
+
+        dtype = arr.dtype.str.encode('ascii')
+        packed_dtype = packed.dtype.str.encode('ascii')
+        header = struct.pack(
+            f'<B{len(dtype)}sB{len(packed_dtype)}sB{arr.ndim}I',
+            len(dtype), dtype, len(packed_dtype), packed_dtype, arr.ndim, *arr.shape)
+        return header + np.ascontiguousarray(packed).tobytes()
+
+    def _unpack_array(self, view: memoryview, offset: int, copy: bool):
+        (dtype_len,) = struct.unpack_from('<B', view, offset)
+        offset += 1
+        dtype = _dtype(bytes(view[offset:offset + dtype_len]))
+        offset += dtype_len
+
+        (packed_len,) = struct.unpack_from('<B', view, offset)
+        offset += 1
+        packed = _dtype(bytes(view[offset:offset + packed_len]))
+        offset += packed_len
+
+        (ndim,) = struct.unpack_from('<B', view, offset)
+        offset += 1
+        shape = struct.unpack_from(f'<{ndim}I', view, offset)
+        offset += 4 * ndim
+
+        count = math.prod(shape)
+        arr = np.frombuffer(view, dtype=packed, count=count, offset=offset).reshape(shape)
+        if copy:
+            # astype copies, so the patch owns a writable array instead of a view into the row
+            arr = arr.astype(dtype)
+        return arr, offset + count * packed.itemsize
+
+
+_CODECS: Dict[str, Codec] = {}
+
+def register_codec(codec: Codec) -> None:
+    _CODECS[codec.name] = codec
+
+def get_codec(name: str) -> Codec:
+    if name not in _CODECS:
+        raise NotImplementedError(f'Unknown codec: {name}')
+    return _CODECS[name]
+
+def decode(data: bytes | str) -> Dict:
+    """ Decodes a stored patch state with whichever registered codec wrote it. """
+    # json is registered first and accepts anything, so check the others before it
+    for codec in reversed(_CODECS.values()):
+        if codec.can_decode(data):
+            return codec.decode(data)
+    raise NotImplementedError('No codec can decode this patch state')
+
+register_codec(JsonCodec())
+register_codec(BinaryCodec())
+
+# ------------------------
+# -- Internal utilities --
+# ------------------------
+
+def _to_json(obj: Any) -> Any:
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def _numeric_array(value: Any) -> np.ndarray | None:
+    """ Returns value as an array if it is a non-empty, rectangular list of only ints or only floats. """
+    if not isinstance(value, (list, tuple)):
+        return None
+
+    # mixed lists would be upcast by numpy and not round trip exactly
+    ints = floats = False
+    lo = hi = 0
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, (list, tuple)):
+            if len(v) == 0:
+                return None
+            stack.extend(v)
+        elif type(v) is int or isinstance(v, np.integer):
+            ints = True
+            lo, hi = min(lo, v), max(hi, v)
+        elif type(v) is float or isinstance(v, np.floating):
+            floats = True
+        else:
+            return None
+
+    # lists are decoded back into python numbers, so ints can go straight into a small dtype
+    dtype = _int_dtype(int(lo), int(hi)) if ints else np.dtype(np.float64)
+    if ints == floats or dtype is None:
+        return None
+    try:
+        return np.array(value, dtype=dtype)
+    except ValueError:
+        # ragged
+        return None
+
+@functools.lru_cache(maxsize=None)
+def _dtype(name: bytes) -> np.dtype:
+    return np.dtype(name.decode('ascii'))
+
+def _int_dtype(lo: int, hi: int) -> np.dtype | None:
+    for dtype, info in _INT_DTYPES:
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return None
+
+_INT_DTYPES = [(np.dtype(t), np.iinfo(t)) for t in (np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32, np.int64)]
@@ -1,29 +1,61 @@
+import os
+import multiprocessing as mp
 import numpy as np
+from typing import Any, Callable, Dict, List, Tuple
 
-from patches.gw import ContinualGridWorld
-from patches.pickyeater import ContinualCollectPartial, ContinualCollectRGB, ContinualCollectXY
+from red_blue_world.patches.gw import ContinualGridWorld
+from red_blue_world.patches.pickyeater import BatchedContinualCollect, ContinualCollectPartial, ContinualCollectRGB, ContinualCollectXY
+from red_blue_world.Recorder import TrajectoryRecorder
+from red_blue_world import shm
+
+
+def _picky_eater(cls) -> Callable[[Dict], Any]:
+    def build(config: Dict):
+        kwargs = {
+            'observation_mode': config.get('observation_mode', 'both'),
+            'layout': config.get('layout', 'four_rooms'),
+        }
+        seed = config.get('seed')
+        if seed is None:
+            return cls(config['env_name'], **kwargs)
+        return cls(config['env_name'], seed=seed, **kwargs)
+    return build
+
+# env_name -> constructor taking the config
+# config['observation_mode'] ('both', 'state' or 'observation') picks what step and reset compute,
+# the other one comes back as None. The picky eaters take config['layout'], a name from MAP_LAYOUTS
+ENVS: Dict[str, Callable[[Dict], Any]] = {
+    'gw': lambda config: ContinualGridWorld(config['grid_size'], observation_mode=config.get('observation_mode', 'both')),
+    'pe_partial': _picky_eater(ContinualCollectPartial),
+    'pe_rgb': _picky_eater(ContinualCollectRGB),
+    'pe_xy': _picky_eater(ContinualCollectXY),
+}
+
+# picky eater envs that BatchedContinualCollect can step together
+_BATCHED_OBSERVATION = {
+    'pe_partial': 'partial',
+    'pe_rgb': 'rgb',
+    'pe_xy': 'xy',
+}
 
 
 class RedBlueEnv:
-    def __init__(self, config):
+    def __init__(self, config, recorder: TrajectoryRecorder | None = None):
         self.env_name = config['env_name']
         self.gird_size = config['grid_size']
+        self.config = config
+
+        # records every step under patch id (0, 0), the caller closes it
+        self.recorder = recorder
 
         self.env = self._init_env()
 
     def _init_env(self):
         """ Initialize the environment based on the config. """
+        if self.env_name not in ENVS:
+            raise NotImplementedError(f'Unknown env: {self.env_name}')
 
-        if self.env_name == 'gw':
-            env = ContinualGridWorld(self.gird_size)
-        elif self.env_name == 'pe_partial':
-            env = ContinualCollectPartial(self.gird_size)
-        elif self.env_name == 'pe_rgb':
-            env = ContinualCollectRGB(self.gird_size)
-        elif self.env_name == 'pe_xy':
-            env = ContinualCollectXY(self.gird_size)
-
-        return env
+        return ENVS[self.env_name](self.config)
 
     def reset(self):
         """ Reset the environment to the start state. """
@@ -33,7 +65,247 @@ class RedBlueEnv:
         """ Take a step in the environment. """
 
         # TODO: make new_patch and direction the same type (the last element of output)
-        return self.env.step(action)
+        out = self.env.step(action)
+        if self.recorder is not None:
+            self.recorder.record((0, 0), out[0], out[1], action, out[2], out[-1])
+        return out
+
+
+class VectorRedBlueEnv:
+    """
+    N copies of one RedBlueEnv behind a single reset()/step(actions) call returning stacked arrays:
+        reset() -> states, observations
+        step(actions) -> states, observations, rewards, directions
+
+    directions is env specific: the grid world reports Direction values (Direction.none.value, 4,
+    when the agent did not leave its patch), the picky eaters the action that moved the agent (4
+    when it stayed put). Picky eater action 0 is not Direction.up.
+    states or observations are None when config['observation_mode'] skips them.
+
+    The environments are continual and never end an episode by themselves. An env that does
+    report one (the done flag of the picky eater step) is reset right away and the returned
+    state and observation are the first ones of the new episode.
+
+    mode='sync' steps every env in this process. The picky eater envs are stepped together
+    by BatchedContinualCollect.
+    mode='subprocess' splits the envs over num_workers processes, each running a sync
+    VectorRedBlueEnv over its slice. Actions and results go through shared memory, the pipes
+    only carry the commands.
+
+    Copy i is built from config with seed = seeds[i] (config.get('seed', 0) + i by default).
+    The grid world draws from the global generator instead, each worker seeds it with the
+    seed of its first copy.
+    """
+
+    def __init__(self, config: Dict, num_envs: int, mode: str = 'sync', seeds: List[int] | None = None,
+                 num_workers: int | None = None, start_method: str = 'spawn') -> None:
+        if mode not in ('sync', 'subprocess'):
+            raise NotImplementedError(f'Unknown mode: {mode}')
+
+        if seeds is None:
+            seeds = [config.get('seed', 0) + i for i in range(num_envs)]
+        if len(seeds) != num_envs:
+            raise ValueError(f'Expected {num_envs} seeds, got {len(seeds)}')
+
+        self.config = config
+        self.num_envs = num_envs
+        self.mode = mode
+        self.seeds = seeds
+
+        if mode == 'sync':
+            self._init_sync()
+        else:
+            self._init_subprocess(num_workers or min(num_envs, os.cpu_count() or 1), start_method)
+
+    # ---------------
+    # -- Sync mode --
+    # ---------------
+
+    def _init_sync(self) -> None:
+        self._batched = None
+        self.envs: List[RedBlueEnv] = []
+
+        name = self.config['env_name']
+        if name in _BATCHED_OBSERVATION:
+            self._batched = BatchedContinualCollect(self.seeds, observation=_BATCHED_OBSERVATION[name],
+                                                    observation_mode=self.config.get('observation_mode', 'both'),
+                                                    layout=self.config.get('layout', 'four_rooms'))
+            return
+
+        for i in range(self.num_envs):
+            self.envs.append(RedBlueEnv(dict(self.config, seed=self.seeds[i])))
+
+    def _reset_sync(self) -> Tuple[np.ndarray | None, np.ndarray | None]:
+        if self._batched is not None:
+            return self._batched.reset()
+
+        states, observations = zip(*(env.reset() for env in self.envs))
+        return _stack(states), _stack(observations)
+
+    def _step_sync(self, actions) -> Tuple[np.ndarray | None, np.ndarray | None, np.ndarray, np.ndarray]:
+        if self._batched is not None:
+            batched_states, batched_observations, rewards, _, directions = self._batched.step(actions)
+            return batched_states, batched_observations, rewards, directions
+
+        n = self.num_envs
+        states: List[Any] = [None] * n
+        observations: List[Any] = [None] * n
+        rewards = np.zeros(n)
+        directions = np.zeros(n, dtype=np.int64)
+        for i, (env, a) in enumerate(zip(self.envs, actions)):
+            out = env.step(int(a))
+
+            # the grid world returns (s, o, r, direction), the picky eaters (s, o, r, done, direction)
+            s, o, r, d = out[0], out[1], out[2], out[-1]
+            if len(out) == 5 and out[3]:
+                s, o = env.reset()
+
+            states[i], observations[i], rewards[i] = s, o, r
+            directions[i] = getattr(d, 'value', d)
+
+        return _stack(states), _stack(observations), rewards, directions
+
+    # ---------------------
+    # -- Subprocess mode --
+    # ---------------------
+
+    def _init_subprocess(self, num_workers: int, start_method: str) -> None:
+        # a throwaway copy tells us the shapes and dtypes to allocate. The grid world draws from the
+        # global generator, which is put back so the caller's seeded run does not depend on mode
+        rng_state = np.random.get_state()
+        try:
+            states, observations = VectorRedBlueEnv(self.config, 1, seeds=self.seeds[:1]).reset()
+        finally:
+            np.random.set_state(rng_state)
+
+        n = self.num_envs
+        self._arrays: shm.Arrays = {
+            'actions': shm.create_array((n,), np.int64),
+            'rewards': shm.create_array((n,), np.float64),
+            'directions': shm.create_array((n,), np.int64),
+        }
+        # the observation mode may skip one of them
+        for name, sample in (('states', states), ('observations', observations)):
+            if sample is not None:
+                self._arrays[name] = shm.create_array((n,) + sample.shape[1:], sample.dtype)
+        layout = shm.layout(self._arrays)
+
+        ctx: Any = mp.get_context(start_method)  # typed as BaseContext for a str start method, which has no Process
+        self._conns = []
+        self._workers = []
+        for lo, hi in _slices(n, num_workers):
+            parent, child = ctx.Pipe()
+            worker = ctx.Process(target=_worker, args=(child, self.config, lo, hi, self.seeds[lo:hi], layout), daemon=True)
+            worker.start()
+            child.close()
+            self._conns.append(parent)
+            self._workers.append(worker)
+
+        self._closed = False
+
+    def _call(self, cmd: str) -> None:
+        for conn in self._conns:
+            conn.send(cmd)
+        for conn in self._conns:
+            reply = conn.recv()
+            if isinstance(reply, BaseException):
+                raise reply
+
+    def _result(self, *names: str) -> Tuple[np.ndarray | None, ...]:
+        # copies, the workers overwrite the shared arrays on the next call
+        return tuple(self._arrays[name][1].copy() if name in self._arrays else None for name in names)
+
+    # ------------
+    # -- Public --
+    # ------------
+
+    def reset(self) -> Tuple[np.ndarray | None, np.ndarray | None]:
+        if self.mode == 'sync':
+            return self._reset_sync()
+
+        self._call('reset')
+        states, observations = self._result('states', 'observations')
+        return states, observations
+
+    def step(self, actions) -> Tuple[np.ndarray | None, np.ndarray | None, np.ndarray, np.ndarray]:
+        if self.mode == 'sync':
+            return self._step_sync(actions)
+
+        self._arrays['actions'][1][:] = actions
+        self._call('step')
+        states, observations = self._result('states', 'observations')
+        rewards, directions = self._arrays['rewards'][1].copy(), self._arrays['directions'][1].copy()
+        return states, observations, rewards, directions
+
+    def close(self) -> None:
+        if self.mode == 'sync' or self._closed:
+            return
+        self._closed = True
+
+        self._call('close')
+        for worker in self._workers:
+            worker.join()
+        for conn in self._conns:
+            conn.close()
+
+        segments = [segment for segment, _ in self._arrays.values()]
+        self._arrays = {}
+        shm.release(segments, unlink=True)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _worker(conn, config: Dict, lo: int, hi: int, seeds: List[int], layout: shm.Layout) -> None:
+    np.random.seed(seeds[0])
+
+    attached = shm.attach(layout)
+    arrays = {name: arr for name, (_, arr) in attached.items()}
+    env = VectorRedBlueEnv(config, hi - lo, seeds=seeds)
+
+    while True:
+        cmd = conn.recv()
+        try:
+            if cmd == 'reset':
+                _publish(arrays, lo, hi, ('states', 'observations'), env.reset())
+                conn.send(None)
+
+            elif cmd == 'step':
+                out = env.step(arrays['actions'][lo:hi])
+                _publish(arrays, lo, hi, ('states', 'observations', 'rewards', 'directions'), out)
+                conn.send(None)
+
+            elif cmd == 'close':
+                arrays.clear()
+                segments = [segment for segment, _ in attached.values()]
+                attached.clear()
+                shm.release(segments, unlink=False)
+                conn.send(None)
+                return
+
+            else:
+                conn.send(ValueError(f'Unknown command: {cmd}'))
+
+        except Exception as e:
+            conn.send(e)
+
+def _publish(arrays: Dict[str, np.ndarray], lo: int, hi: int, names: Tuple[str, ...], values) -> None:
+    for name, value in zip(names, values):
+        if value is not None:
+            arrays[name][lo:hi] = value
+
+def _stack(items) -> np.ndarray | None:
+    # None for the part the observation mode skips
+    if items[0] is None:
+        return None
+    return np.stack(items)
+
+def _slices(n: int, parts: int) -> List[Tuple[int, int]]:
+    bounds = np.linspace(0, n, parts + 1).astype(int)
+    return [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
 
 
 if __name__ == '__main__':
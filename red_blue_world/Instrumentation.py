@@ -0,0 +1,216 @@
+import functools
+import threading
+import time
+from typing import Any, AnyStr, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from red_blue_world.StorageManager import Store
+
+# Counters, gauges and latency histograms for the hot paths of Quilt, its patches and its store.
+#
+# Stats is the recording implementation. NullStats has the same surface and does nothing,
+# and `instrument` leaves objects untouched when handed a NullStats, so a disabled
+# instrumentation adds no wrappers and no work to the step loop.
+
+
+class Histogram:
+    """
+    Latency histogram with logarithmic buckets: four buckets per power of two nanoseconds,
+    so percentiles are exact to within 25%.
+    """
+
+    _SUB = 4
+
+    def __init__(self) -> None:
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, ns: int) -> None:
+        b = self._bucket(ns)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def percentile(self, q: float) -> float:
+        """ Upper bound, in nanoseconds, of the bucket holding the q-th percentile. """
+        if self.count == 0:
+            return 0.0
+
+        rank = q / 100 * self.count
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= rank:
+                return float(min(self._upper(b), self.max_ns))
+        return float(self.max_ns)
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'mean_us': self.total_ns / self.count / 1e3 if self.count else 0.0,
+            'p50_us': self.percentile(50) / 1e3,
+            'p99_us': self.percentile(99) / 1e3,
+            'max_us': self.max_ns / 1e3,
+        }
+
+    @classmethod
+    def _bucket(cls, ns: int) -> int:
+        if ns < cls._SUB:
+            return ns
+        bits = ns.bit_length()
+        return (bits - 2) * cls._SUB + ((ns >> (bits - 3)) & (cls._SUB - 1))
+
+    @classmethod
+    def _upper(cls, b: int) -> int:
+        if b < cls._SUB:
+            return b
+        octave, sub = divmod(b, cls._SUB)
+        return ((cls._SUB + sub + 1) << (octave - 1)) - 1
+
+
+class Stats:
+    enabled = True
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {}
+        self._histograms: Dict[str, Histogram] = {}
+        self._gauges: Dict[str, Callable[[], Any]] = {}
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def record(self, name: str, ns: int) -> None:
+        """ Adds one latency sample, in nanoseconds, to the histogram called name. """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.record(ns)
+
+    def gauge(self, name: str, read: Callable[[], Any]) -> None:
+        """ Registers a gauge. read is only called when a snapshot is taken. """
+        self._gauges[name] = read
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {name: h.snapshot() for name, h in self._histograms.items()}
+        return {
+            'counters': counters,
+            'latency': histograms,
+            'gauges': {name: read() for name, read in self._gauges.items()},
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+class NullStats(Stats):
+    enabled = False
+
+    def __init__(self) -> None:
+        pass
+
+    def count(self, name: str, n: int = 1) -> None:
+        pass
+
+    def record(self, name: str, ns: int) -> None:
+        pass
+
+    def gauge(self, name: str, read: Callable[[], Any]) -> None:
+        pass
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {'counters': {}, 'latency': {}, 'gauges': {}}
+
+    def reset(self) -> None:
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+def instrument(obj: Any, methods: Dict[str, str], stats: Stats) -> None:
+    """
+    Times the given methods of obj into stats, by shadowing them with instance attributes.
+    methods maps a method name to the histogram it records into. A no-op for NullStats.
+    """
+    if not stats.enabled:
+        return
+
+    for method, name in methods.items():
+        setattr(obj, method, _timed(getattr(obj, method), name, stats))
+
+
+def _timed(fn: Callable, name: str, stats: Stats) -> Callable:
+    clock = time.perf_counter_ns
+
+    @functools.wraps(fn)
+    def timed(*args, **kwargs):
+        start = clock()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stats.record(name, clock() - start)
+
+    return timed
+
+
+class InstrumentedStore(Store):
+    """
+    Times every call into a store. A wrapper rather than instrument(), since a store can be
+    shared between quilts or outlive one and must not keep the timing once the quilt is gone.
+    """
+
+    def __init__(self, store: Store, stats: Stats, prefix: str = 'store') -> None:
+        self._store = store
+        self._stats = stats
+        self._prefix = prefix
+
+    def _call(self, method: str, *args):
+        start = time.perf_counter_ns()
+        try:
+            return getattr(self._store, method)(*args)
+        finally:
+            self._stats.record(f'{self._prefix}.{method}', time.perf_counter_ns() - start)
+
+    def patch_exists(self, patch_id: AnyStr) -> bool:
+        return self._call('patch_exists', patch_id)
+
+    def load_patch_states(self, patch_ids: List) -> List[Tuple[Any, Any]]:
+        return self._call('load_patch_states', patch_ids)
+
+    def load_patch_state(self, patch_id: AnyStr) -> Dict:
+        return self._call('load_patch_state', patch_id)
+
+    def store_patch(self, patch_id: AnyStr, patch_state: Dict) -> None:
+        return self._call('store_patch', patch_id, patch_state)
+
+    def store_patches(self, items: Iterable[Tuple[AnyStr, Dict]]) -> None:
+        return self._call('store_patches', items)
+
+    def patch_ids(self) -> Iterator:
+        return self._call('patch_ids')
+
+    def load_region(self, x0: int, y0: int, x1: int, y1: int) -> List[Tuple[Any, Any]]:
+        return self._call('load_region', x0, y0, x1, y1)
+
+    def flush(self) -> None:
+        return self._call('flush')
+
+    def close(self) -> None:
+        return self._call('close')
+
+
+def instrument_store(store: Store, stats: Stats) -> Store:
+    """ store itself for NullStats. """
+    if not stats.enabled:
+        return store
+    return InstrumentedStore(store, stats)
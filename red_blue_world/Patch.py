@@ -19,6 +19,12 @@ PatchState = Any
 
 
 class Patch:
+    # subclasses may declare __slots__ to stay small, __dict__ keeps every other attribute working
+    __slots__ = ('patch_id', '__dict__')
+
+    # where the agent stands in this patch, step_batch points it at each agent in turn
+    agent_loc: Any
+
     def __init__(self, id: str) -> None:
         self.patch_id = id
 
@@ -31,12 +37,76 @@ class Patch:
         ...
 
     @abstractmethod
-    def step(self, action: Action) -> Tuple[AgentState, Reward, Direction]:
+    def step(self, action: Action) -> Tuple[Any, ...]:
+        """ (state, observation, reward, direction), the picky eaters add a done flag before the direction. """
+        ...
+
+    @abstractmethod
+    def reset(self) -> Tuple[Any, Any]:
+        """ Places the agent at a random location, returns its (state, observation). """
         ...
 
+    def generate_observation(self, *args: Any, **kwargs: Any) -> np.ndarray:
+        """ The observation of the agent at agent_loc, see observe_into. """
+        raise NotImplementedError
+
     @abstractmethod
     def serialize(self) -> dict:
         ...
 
+    def serialize_diff(self) -> dict | None:
+        """
+        The part of the state that a freshly generated copy of this patch does not have,
+        or None when the patch is unchanged. Patches that cannot be regenerated return everything.
+        """
+        return self.serialize()
+
+    def step_batch(self, agent_locs: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Steps several agents that share this patch, one after another.
+        Returns their next locations, rewards and Direction values.
+        Patches override this with a vectorized version where they can.
+        """
+        saved = self.agent_loc
+        n = len(actions)
+        next_locs = np.array(agent_locs, copy=True)
+        rewards = np.zeros(n)
+        directions = np.full(n, Direction.none.value)
+        for i in range(n):
+            self.agent_loc = tuple(agent_locs[i])
+            s, _, r, d = self.step(int(actions[i]))
+            next_locs[i] = s
+            rewards[i] = r
+            directions[i] = d.value
+
+        self.agent_loc = saved
+        return next_locs, rewards, directions
+
+    def observe_into(self, agent_loc, out: np.ndarray) -> None:
+        """ Writes the observation of an agent standing at agent_loc into out. """
+        saved = self.agent_loc
+        self.agent_loc = tuple(agent_loc)
+        out[...] = self.generate_observation()
+        self.agent_loc = saved
+
     def get_patch_id(self)-> str:
         return self.patch_id
+
+
+# what step and reset compute: the state, the observation or both. The one that is skipped is returned as None
+OBSERVATION_MODES = ('both', 'state', 'observation')
+
+def check_observation_mode(mode: str) -> str:
+    if mode not in OBSERVATION_MODES:
+        raise NotImplementedError(f'Unknown observation mode: {mode}')
+    return mode
+
+
+def observation_view(buffer: np.ndarray, copy: bool) -> np.ndarray:
+    """ Returns a copy of a persistent observation buffer, or a read-only view of it. """
+    if copy:
+        return buffer.copy()
+
+    view = buffer.view()
+    view.flags.writeable = False
+    return view
@@ -1,133 +1,771 @@
-from concurrent.futures import ThreadPoolExecutor
+import sys
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from itertools import product
-from typing import Dict, Tuple
+from typing import Any, Collection, Dict, Iterable, List, Set, Tuple
 
 from red_blue_world.interfaces import Action, AgentState, Direction, Reward
 from red_blue_world.Patch import Patch
+from red_blue_world.StorageManager import Store, StoreFactory, patch_key
+from red_blue_world.Instrumentation import NULL_STATS, Stats, instrument, instrument_store
+from red_blue_world.Recorder import TrajectoryRecorder
 from red_blue_world import patch_loader
 
 # this is the coordination of individual patches
 # this has a state which is: "which patch is the agent currently in?"
 # when a patch says that the agent is leaving, it also says in which direction
 #   on the next step, the patchwork informs the next patch that the agent is entering
+#
+# only a working set of patches is kept in memory. When it grows past its budget
+# the least recently used patches are serialized into the store and rehydrated on re-entry
+#
+# while the agent walks around a patch, a background thread prefetches the neighbors it is
+# heading towards with a single batched store read, so transitions find their patch resident
+#
+# with a world_seed, every patch is generated from (world_seed, PatchID) alone, so its layout
+# does not depend on the order patches are visited in. Only what changed since generation
+# (Patch.serialize_diff) is written to the store, and patches without changes are evicted for free
+#
+# passing a Stats records latency histograms for stepping, transitions, loads, builds, write backs,
+# prefetches, patch steps/observations and every store call, plus counters and gauges. See stats_snapshot
+#
+# passing a TrajectoryRecorder records every transition as (patch id, state, action, reward, direction),
+# where the state is the location in the patch the action was taken in. The caller closes the recorder
+#
+# passing a snapshot store makes the quilt checkpointable. Patches are marked dirty when they are built,
+# stepped or entered, and checkpoint() writes only the patches dirtied since the previous checkpoint plus
+# the agent's position, under SNAPSHOT_KEY. The dirty patches are serialized on the calling thread, which
+# copies their state, and the copies are written from the background thread while stepping goes on.
+# Dirty patches evicted in between are captured as they are written back. restore() builds a quilt in the
+# state of the last checkpoint. The snapshot store also holds SNAPSHOT_KEY, which is not a patch key, so it
+# has to be one that takes any id, like SqliteBasicStorage
 
 PatchID = Tuple[int, int]
 
+# the id the quilt's own state is checkpointed under, next to the patch keys
+SNAPSHOT_KEY = 'quilt'
+
 class Quilt:
-    def __init__(self) -> None:
-        self._patches: Dict[PatchID, Patch] = {}
+    def __init__(self, store: Store | None = None, max_patches: int | None = 1024, max_bytes: int | None = None,
+                 prefetch: bool = True, edge_margin: int = 3, world_seed: int | None = None,
+                 stats: Stats | None = None, recorder: TrajectoryRecorder | None = None,
+                 snapshot: Store | None = None) -> None:
+        if store is None:
+            # most probes are for patches that were never stored, the index answers those from memory
+            store = StoreFactory.create_store('sqlite_basic', ':memory:', index='exact')
+        self._store = store
+
+        # without stats nothing is wrapped, so the disabled path is the plain code
+        self._stats = stats if stats is not None else NULL_STATS
+        instrument(self, _QUILT_METHODS, self._stats)
+        self._store = instrument_store(self._store, self._stats)
+
+        # working set budget, either limit can be disabled with None
+        self._max_patches = max_patches
+        self._max_bytes = max_bytes
+
+        # kept in least-recently-used order
+        self._patches: OrderedDict[PatchID, Patch] = OrderedDict()
+        self._patch_bytes: Dict[PatchID, int] = {}
+        self._bytes = 0
+
+        # evicted patches waiting to be written to the store
+        self._evicting: Dict[PatchID, Patch] = {}
+
+        self._world_seed = world_seed
+        self._recorder = recorder
+
+        # checkpoints go to a store of their own, the evictions to store keep moving past them.
+        # Nothing is tracked without one
+        self._snapshot = snapshot
+        self._dirty: Set[PatchID] | None = set() if snapshot is not None else None
+        # state of dirty patches at the time they were written back
+        self._evicted_states: Dict[PatchID, Dict | None] = {}
+
+        # guards the patch table, which the prefetch thread installs into and evicts from
+        self._lock = threading.RLock()
+        self._evict_lock = threading.Lock()
+
         self._active_patch_id: PatchID = (0, 0)
-        self._active_patch: Patch = self.build_patch(None)
+        # a persistent store may already hold the origin patch
+        self._active_patch: Patch = self._load_patches([self._active_patch_id])[self._active_patch_id]
 
         self._t = 0
         self.agent_loc = None
-        self._unload_clocks: Dict[PatchID, int] = {}
 
         self._back_thread = ThreadPoolExecutor(max_workers=1)
 
+        # neighbors are prefetched once the agent is within edge_margin cells of their edge
+        self._prefetch = prefetch
+        self._edge_margin = edge_margin
+        # patches requested from the prefetch thread and not yet installed
+        self._prefetch_pending: Dict[PatchID, Future] = {}
+        self._prefetch_key: Any = None
+        self._prefetch_stats = {'hits': 0, 'waits': 0, 'misses': 0, 'requests': 0, 'prefetched': 0}
+
         # ensure the initial patch is cached
-        self._patches[self._active_patch_id] = self._active_patch
+        self._cache_patch(self._active_patch_id, self._active_patch)
+
+        self._stats.gauge('quilt.cache_size', self.cache_size)
+        self._stats.gauge('quilt.evicting', lambda: len(self._evicting))
+        self._stats.gauge('quilt.bytes', lambda: self._bytes)
+        self._stats.gauge('quilt.prefetch', self.prefetch_stats)
+
+    def reset(self) -> AgentState:
+        """ Places the agent at a random location of the initial patch. """
+        s, _ = self._active_patch.reset()
+        self._mark_dirty((self._active_patch_id,))
+        return s
+
+    def observation(self) -> np.ndarray:
+        """ The observation of the agent in its current patch. Patches skip it while stepping, it is rendered here. """
+        return self._active_patch.generate_observation()
 
     def step(self, a: Action) -> Tuple[AgentState, Reward]:
-        s, r, d = self._active_patch.step(a)
+        s, _, r, d = self._active_patch.step(a)
+        self._t += 1
+        if self._dirty is not None:
+            self._dirty.add(self._active_patch_id)
+        if self._recorder is not None:
+            self._recorder.record(self._active_patch_id, s, None, a, r, d)
 
         # use direction signal coming from Patch.step to signal that it is time to transition
         if d != Direction.none:
-            self._maybe_unload(self._active_patch_id)
-            next_id = self._handle_patch_transition(self._active_patch_id, d, s)
+            next_id, next_loc = self._handle_patch_transition(self._active_patch_id, d, s)
 
-            self._active_patch_id = next_id
-            self._active_patch = self._patches[next_id]
+            # the prefetch thread evicts too, so switch patches before it can pick the new one
+            with self._lock:
+                self._active_patch_id = next_id
+                self._active_patch = self._ensure_load(next_id, next_loc)
+            self._active_patch.agent_loc = next_loc
             self._active_patch.on_enter(s)
-            
+            self._mark_dirty((next_id,))
+
+            self._maybe_unload()
+
+        if self._prefetch:
+            self._maybe_prefetch()
+
         return (s, r)
 
-    def _handle_patch_transition(self, patch_id: PatchID, d: Direction, agent_loc: AgentState) -> PatchID:
-        if d == Direction.up: next_id = _up(patch_id)
-        elif d == Direction.down: next_id = _down(patch_id)
-        elif d == Direction.left: next_id = _left(patch_id)
-        else:
-            assert d == Direction.right
-            next_id = _right(patch_id)
-        
+    def _handle_patch_transition(self, patch_id: PatchID, d: Direction, agent_loc: AgentState) -> Tuple[PatchID, AgentState]:
+        next_id = _neighbor(patch_id, d)
         next_loc = patch_loader.transit_agent(d, agent_loc)
-        
+
+        with self._lock:
+            resident = next_id in self._patches
+            pending = self._prefetch_pending.get(next_id)
+
+        if resident:
+            self._prefetch_stats['hits'] += 1
+        elif pending is not None:
+            # the prefetcher is already reading it, wait rather than load it twice
+            self._prefetch_stats['waits'] += 1
+            pending.result()
+        else:
+            self._prefetch_stats['misses'] += 1
+
         # *synchronously* ensure the next patch is loaded
         # if this is anything more than a no-op, we screwed up somewhere
         self._ensure_load(next_id, next_loc)
 
-        # asynchronously load the 3x3 square around the next patch
-        self._back_thread.submit(self._ensure_load3x3, (patch_id, next_loc))
+        return next_id, next_loc
+
+    def _ensure_load(self, patch_id: PatchID, agent_loc: AgentState | None) -> Patch:
+        with self._lock:
+            # shortcut if there is no work to be done
+            if patch_id in self._patches:
+                self._stats.count('ensure_load.hit')
+                self._patches.move_to_end(patch_id)
+                return self._patches[patch_id]
+
+            # evicted but not written back yet, the queued patch is newer than the store
+            if patch_id in self._evicting:
+                self._stats.count('ensure_load.evicting')
+                patch = self._evicting[patch_id]
+            else:
+                # a single read, a patch that was never stored is simply not returned
+                self._stats.count('ensure_load.read')
+                patch = self._load_patches([patch_id], agent_loc)[patch_id]
+
+            self._cache_patch(patch_id, patch)
+            return patch
+
+    def _ensure_loaded(self, patch_ids: Iterable[PatchID]) -> None:
+        """
+        Makes every patch in patch_ids resident. The ones that are not in memory are read with a
+        single store call, and only the ones the store does not have are built.
+        """
+        patch_ids = list(dict.fromkeys(patch_ids))
+        with self._lock:
+            pending = {self._prefetch_pending[patch_id] for patch_id in patch_ids if patch_id in self._prefetch_pending}
+
+        # the prefetcher is already reading these, wait rather than read them twice
+        for future in pending:
+            future.result()
+
+        with self._lock:
+            missing = []
+            for patch_id in patch_ids:
+                if patch_id in self._patches:
+                    self._patches.move_to_end(patch_id)
+                elif patch_id in self._evicting:
+                    self._cache_patch(patch_id, self._evicting[patch_id])
+                else:
+                    missing.append(patch_id)
+
+        patches = self._load_patches(missing)
+        with self._lock:
+            for patch_id, patch in patches.items():
+                if patch_id not in self._patches:
+                    self._cache_patch(patch_id, patch)
+
+    # ----------------
+    # -- Prefetching --
+    # ----------------
+
+    def _maybe_prefetch(self) -> None:
+        agent_loc = getattr(self._active_patch, 'agent_loc', None)
+        if agent_loc is None:
+            return
+
+        wanted = _predict_neighbors(self._active_patch_id, agent_loc, patch_loader.SIZE, self._edge_margin)
+
+        # only ask again when the prediction changes
+        key = (self._active_patch_id, tuple(wanted))
+        if key == self._prefetch_key:
+            return
+
+        self._prefetch_key = key
+        self._request_prefetch(wanted)
+
+    def _request_prefetch(self, wanted: List[PatchID]) -> None:
+        with self._lock:
+            missing = []
+            for patch_id in wanted:
+                if patch_id in self._evicting:
+                    # still in memory, take it back instead of reading a stale row
+                    self._cache_patch(patch_id, self._evicting[patch_id])
+                elif patch_id not in self._patches and patch_id not in self._prefetch_pending:
+                    missing.append(patch_id)
+
+            if not missing:
+                return
+
+            # requests queue up behind each other on the single worker
+            self._prefetch_stats['requests'] += 1
+            future = self._back_thread.submit(self._prefetch_patches, missing)
+            for patch_id in missing:
+                self._prefetch_pending[patch_id] = future
+
+    def _prefetch_patches(self, patch_ids: List[PatchID]) -> None:
+        # runs on the background thread. Reading and building happen outside the lock,
+        # the results are installed all at once
+        patches = self._load_patches(patch_ids)
+
+        with self._lock:
+            for patch_id, patch in patches.items():
+                if patch_id not in self._patches and patch_id not in self._evicting:
+                    self._cache_patch(patch_id, patch)
+                    self._prefetch_stats['prefetched'] += 1
+                self._prefetch_pending.pop(patch_id, None)
+
+        # make room off the stepping thread
+        self._maybe_unload()
+
+    def _load_patches(self, patch_ids: List[PatchID], agent_loc: AgentState | None = None) -> Dict[PatchID, Patch]:
+        """
+        Loads every stored patch with one store read and builds the rest. The read doubles as the
+        existence check. With an agent_loc the patches are handed that location, otherwise they
+        keep the stored one.
+        """
+        if not patch_ids:
+            return {}
+
+        keys = {patch_key(patch_id): patch_id for patch_id in patch_ids}
+        stored = self._read_patch_states(list(keys))
+        self._stats.count('load.stored', len(stored))
+        self._stats.count('load.built', len(keys) - len(stored))
+
+        # a built patch is not in the snapshot yet
+        with self._lock:
+            self._mark_dirty(patch_id for key, patch_id in keys.items() if key not in stored)
+
+        patches = {}
+        for key, patch_id in keys.items():
+            patch = self.build_patch(agent_loc, patch_id)
+            if key in stored:
+                patch.load(stored[key])
+                if agent_loc is not None:
+                    patch.agent_loc = agent_loc
+            patches[patch_id] = patch
+
+        return patches
+
+    def prefetch_stats(self) -> Dict[str, int]:
+        """
+        hits: transitions into an already resident patch
+        waits: transitions that waited on an in-flight prefetch
+        misses: transitions that loaded or built their patch synchronously
+        """
+        return dict(self._prefetch_stats)
+
+    def close(self) -> None:
+        # running checkpoints are finished first
+        self._back_thread.shutdown(wait=True)
+        self._drain_evictions()
+
+    # -----------------
+    # -- Checkpoints --
+    # -----------------
+
+    def checkpoint(self) -> Future:
+        """
+        Writes the patches dirtied since the previous checkpoint and the quilt's own state to the
+        snapshot store, from the background thread. Only the serialization of the dirty patches
+        happens here. The returned future is done once the checkpoint is in the store.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            raise ValueError('Quilt was created without a snapshot store')
+
+        with self._lock:
+            dirty: Set[PatchID] = self._dirty or set()
+            self._dirty = set()
+            evicted, self._evicted_states = self._evicted_states, {}
+
+            rows = []
+            for patch_id in dirty:
+                patch = self._patches.get(patch_id, self._evicting.get(patch_id))
+                patch_state = self._patch_state(patch) if patch is not None else evicted.get(patch_id)
+                # a patch that can be regenerated as is has nothing to write
+                if patch_state is not None:
+                    rows.append((patch_key(patch_id), patch_state))
+
+            self._stats.count('checkpoint.written', len(rows))
+            rows.append((SNAPSHOT_KEY, self._quilt_state()))
+
+        return self._back_thread.submit(snapshot.store_patches, rows)
+
+    def _quilt_state(self) -> Dict:
+        agent_loc = getattr(self._active_patch, 'agent_loc', None)
+        return {
+            'world_seed': self._world_seed,
+            't': self._t,
+            'active_patch_id': list(self._active_patch_id),
+            'agent_loc': None if agent_loc is None else [int(v) for v in agent_loc],
+        }
+
+    @classmethod
+    def restore(cls, snapshot: Store, store: Store | None = None, **kwargs) -> 'Quilt':
+        """
+        A quilt in the state of the last checkpoint written to snapshot, built with the given keyword
+        arguments and the checkpointed world_seed. The snapshot's patches are copied into store, the new quilt
+        keeps checkpointing into snapshot. Without a world_seed the patches first built after the
+        restore come from the global generator, and differ from the ones the original quilt built.
+        """
+        state = snapshot.load_patch_state(SNAPSHOT_KEY)
+        if not state:
+            raise ValueError('No checkpoint in the snapshot store')
+
+        kwargs.setdefault('world_seed', state['world_seed'])
+        quilt = cls(store=store, snapshot=snapshot, **kwargs)
+        quilt._restore(snapshot, state)
+        return quilt
+
+    def _restore(self, snapshot: Store, state: Dict) -> None:
+        keys = [key for key in snapshot.patch_ids() if key != SNAPSHOT_KEY]
+        for lo in range(0, len(keys), 1024):
+            self._store.store_patches(snapshot.load_patch_states(keys[lo:lo + 1024]))
+
+        # the patches built by __init__ are replaced by the checkpointed ones
+        with self._lock:
+            self._patches.clear()
+            self._patch_bytes.clear()
+            self._bytes = 0
+
+            x, y = state['active_patch_id']
+            self._active_patch_id = (x, y)
+            self._active_patch = self._ensure_load(self._active_patch_id, None)
+            # a patch that was regenerated has no location of its own
+            if state['agent_loc'] is not None:
+                self._active_patch.agent_loc = tuple(state['agent_loc'])
+
+        self._t = state['t']
+        self._dirty = set()
+        self._evicted_states = {}
+
+    def _mark_dirty(self, patch_ids: Iterable[PatchID]) -> None:
+        if self._dirty is not None:
+            self._dirty.update(patch_ids)
+
+    # the neighborhood has to fit the working set budget, or its first patches are evicted again
 
-        return next_id
-
-    def _ensure_load(self, patch_id: PatchID, agent_loc: AgentState) -> None:
-        # shortcut if there is no work to be done
-        if patch_id in self._patches: return
+    def _ensure_load3x3(self, patch_id: PatchID, agent_loc: AgentState) -> None:
+        self._ensure_loaded(_neighborhood(patch_id, 1))
 
-        if self.patch_exists(patch_id):
-            patch = self.load_patch(patch_id, agent_loc)
-        else:
-            patch = self.build_patch(agent_loc)
+    def _ensure_load9x9(self, patch_id: PatchID, agent_loc: AgentState) -> None:
+        self._ensure_loaded(_neighborhood(patch_id, 3))
 
+    def _cache_patch(self, patch_id: PatchID, patch: Patch) -> None:
+        self._evicting.pop(patch_id, None)
         self._patches[patch_id] = patch
 
-    def _ensure_load3x3(self, patch_id: PatchID, agent_loc: AgentState) -> None:
-        x, y = patch_id
+        # sizing a patch walks its attributes, so only pay for it under a byte budget
+        if self._max_bytes is not None:
+            self._patch_bytes[patch_id] = _patch_nbytes(patch)
+            self._bytes += self._patch_bytes[patch_id]
+
+        # the table never holds more than its budget, the queued patches are written back
+        # on the next _maybe_unload
+        self._evict_over_budget()
+
+    def _over_budget(self) -> bool:
+        if self._max_patches is not None and len(self._patches) > self._max_patches:
+            return True
+
+        return self._max_bytes is not None and self._bytes > self._max_bytes
+
+    def _maybe_unload(self) -> None:
+        with self._lock:
+            self._evict_over_budget()
+        self._drain_evictions()
+
+    def _evict_over_budget(self) -> None:
+        # evict least recently used patches until the working set fits its budget
+        # patches holding an agent always survive
+        # this only looks at the patches it evicts, not the whole working set
+        if not self._over_budget():
+            return
+
+        pinned = self._pinned_patches()
+        while len(self._patches) > len(pinned) and self._over_budget():
+            patch_id = next(iter(self._patches))
+            if patch_id in pinned:
+                self._patches.move_to_end(patch_id)
+                continue
+
+            self._queue_eviction(patch_id)
+
+    def _pinned_patches(self) -> Collection[PatchID]:
+        return (self._active_patch_id,)
+
+    def _queue_eviction(self, patch_id: PatchID) -> None:
+        # the patch leaves the table right away but stays readable from _evicting
+        # until its state has reached the store
+        self._evicting[patch_id] = self._patches.pop(patch_id)
+        self._bytes -= self._patch_bytes.pop(patch_id, 0)
+
+    def _drain_evictions(self) -> None:
+        # one drain at a time keeps the writes to the store in eviction order
+        with self._evict_lock:
+            with self._lock:
+                if not self._evicting:
+                    return
+                queued = list(self._evicting.items())
+                rows = []
+                for patch_id, patch in queued:
+                    patch_state = self._patch_state(patch)
+                    if patch_state is not None:
+                        rows.append((patch_key(patch_id), patch_state))
+                    # the next checkpoint needs it and the patch may be gone by then
+                    if self._dirty is not None and patch_id in self._dirty:
+                        self._evicted_states[patch_id] = patch_state
+
+                self._stats.count('evict.written', len(rows))
+                self._stats.count('evict.regenerable', len(queued) - len(rows))
+
+            # writing happens outside the table lock, so the other thread keeps stepping
+            self._store.store_patches(rows)
+
+            with self._lock:
+                for patch_id, patch in queued:
+                    # a patch taken back (or evicted again) in the meantime is left alone
+                    if self._evicting.get(patch_id) is patch:
+                        del self._evicting[patch_id]
+
+    def cache_size(self) -> int:
+        with self._lock:
+            return len(self._patches)
+
+    # ----------------------
+    # -- Storage plumbing --
+    # ----------------------
+
+    def _read_patch_states(self, keys: List[str]) -> Dict[str, Dict]:
+        # the stored states of keys, the ones that were never stored are left out
+        return dict(self._store.load_patch_states(keys))
 
-        for dx, dy in product(range(-1, 2), range(-1, 2)):
-            coord = (x + dx, y + dy)
-            self._ensure_load(coord, agent_loc)
+    def unload_patch(self, patch_id: PatchID) -> None:
+        with self._lock:
+            self._queue_eviction(patch_id)
+        self._drain_evictions()
 
-    def _ensure_load9x9(self, patch_id: PatchID, agent_loc: AgentState) -> None:
-        x, y = patch_id
+    def patch_exists(self, patch_id: PatchID) -> bool:
+        with self._lock:
+            if patch_id in self._patches or patch_id in self._evicting:
+                return True
+        return self._store.patch_exists(patch_key(patch_id))
+
+    def _patch_state(self, patch: Patch) -> Dict | None:
+        # what has to be stored for a patch, None when it can be regenerated as is
+        if self._world_seed is None:
+            return patch.serialize()
+        return patch.serialize_diff()
+
+    def build_patch(self, agent_loc, patch_id: PatchID | None = None) -> Patch:
+        # Calling patch_loader to initialize a new patch
+        rng = None
+        if self._world_seed is not None and patch_id is not None:
+            rng = patch_loader.patch_rng(self._world_seed, patch_id)
+        # Quilt.step only hands back the state, observations are rendered on request (observe_into)
+        patch = patch_loader.patch_loader('gw', agent_loc, rng, observation_mode='state')
+        instrument(patch, _PATCH_METHODS, self._stats)
+        return patch
 
-        for dx, dy in product(range(-3, 4), range(-3, 4)):
-            coord = (x + dx, y + dy)
-            self._ensure_load(coord, agent_loc)
+    def stats_snapshot(self) -> Dict[str, Dict]:
+        """ Counters, latency histograms (in microseconds) and gauges recorded so far. Empty without stats. """
+        return self._stats.snapshot()
 
-    def _maybe_unload(self, patch_id: PatchID) -> None:
-        # always reset the clock for the current patch
-        self._unload_clocks[patch_id] = 50
 
-        # assumes that `self._unload_clocks` is usually empty or very small
-        # otherwise, this would cause a performance degradation on every tick
-        for key in self._unload_clocks:
-            self._unload_clocks[key] -= 1
+class MultiAgentQuilt(Quilt):
+    """
+    Many agents walking one shared patch world.
 
-            if self._unload_clocks[key] == 0:
-                del self._unload_clocks[key]
-                self._back_thread.submit(self.unload_patch, key)
+    Patches are built, cached and stored once no matter how many agents visit them.
+    Every tick, the agents are grouped by the patch they are in and each patch is stepped
+    once with the whole group's actions (Patch.step_batch). Agents leaving their patch are
+    moved to its neighbor, and all the neighbors that are not resident are read with one
+    store call. Patches holding an agent are never evicted, so the working set is at least
+    the number of distinct occupied patches.
 
-    # -------------------
-    # TEMP: type stubs --
-    # -------------------
+    An agent can also be hosted somewhere else (see ShardedQuilt). Its patch id is then None,
+    it is skipped by step, and an agent walking onto a patch this quilt does not own (_owns)
+    is released and reported by take_handoffs instead of being moved.
+    """
 
-    def load_patch(self, patch_id: PatchID, agent_loc) -> Patch:
-        # this should call out to the patch_loader
-        # probably this can be inlined. Keeping as a type-stub for now
-        patch = self._patches[patch_id]
-        patch.agent_loc = agent_loc
-        return patch
+    def __init__(self, num_agents: int, store: Store | None = None, max_patches: int | None = 1024,
+                 max_bytes: int | None = None, prefetch: bool = True, edge_margin: int = 3,
+                 world_seed: int | None = None, stats: Stats | None = None,
+                 recorder: TrajectoryRecorder | None = None, snapshot: Store | None = None) -> None:
+        super().__init__(store, max_patches, max_bytes, prefetch, edge_margin, world_seed, stats, recorder, snapshot)
 
-    def unload_patch(self, patch_id: PatchID) -> None:
-        # this should call out to the patch_loader
-        # probably this can be inlined. Keeping as a type-stub for now
-        del self._patches[patch_id]
+        self.num_agents = num_agents
+        self._agent_patch_ids: List[PatchID | None] = [None] * num_agents
+        self._agent_locs = np.zeros((num_agents, 2), dtype=np.int64)
 
-    def patch_exists(self, patch_id: PatchID) -> bool:
-        # this should call out to the patch_loader
-        # probably this can be inlined. Keeping as a type-stub for now
-        return self._patches.get(patch_id, None) is not None
+        # number of agents in each occupied patch
+        self._occupancy: Dict[PatchID, int] = {}
 
-    def build_patch(self, agent_loc) -> Patch:
-        # Calling patch_loader to initialize a new patch
-        return patch_loader.patch_loader('gw', agent_loc)
+        # (agent, patch id, location, last state) of agents that walked off this quilt
+        self._handoffs: List[Tuple[int, PatchID, Tuple[int, int], List[int]]] = []
+
+        self._stats.gauge('quilt.occupied_patches', lambda: len(self._occupancy))
+        self._stats.gauge('quilt.hosted_agents', lambda: len(self.hosted_agents()))
+
+    def reset(self) -> np.ndarray:
+        """ Places every agent at a random location of the initial patch. """
+        self.reset_agents(range(self.num_agents), self._active_patch_id)
+        return self._agent_locs.copy()
+
+    def reset_agents(self, agents: Iterable[int], patch_id: PatchID) -> None:
+        """ Places the given agents at random locations of patch_id. """
+        agents = list(agents)
+        with self._lock:
+            for i in agents:
+                self._move_agent(i, patch_id)
+        self._enter_patches([patch_id])
+
+        patch = self._patches[patch_id]
+        for i in agents:
+            patch.reset()
+            self._agent_locs[i] = patch.agent_loc
+
+    def admit_agents(self, handoffs: List[Tuple[int, PatchID, Tuple[int, int], List[int]]]) -> None:
+        """ Takes over agents handed off by another quilt, as reported by its take_handoffs. """
+        with self._lock:
+            for i, patch_id, loc, _ in handoffs:
+                self._move_agent(i, patch_id)
+                self._agent_locs[i] = loc
+        self._enter_patches(dict.fromkeys(patch_id for _, patch_id, _, _ in handoffs))
+
+        for i, patch_id, loc, last_state in handoffs:
+            self._patches[patch_id].on_enter(np.asarray(last_state))
+
+    def take_handoffs(self) -> List[Tuple[int, PatchID, Tuple[int, int], List[int]]]:
+        handoffs, self._handoffs = self._handoffs, []
+        return handoffs
+
+    def hosted_agents(self) -> List[int]:
+        return [i for i, patch_id in enumerate(self._agent_patch_ids) if patch_id is not None]
+
+    # steps every agent at once, so it takes and returns arrays where Quilt.step has one agent
+    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:  # type: ignore[override]
+        actions = np.asarray(actions)
+        rewards = np.zeros(self.num_agents)
+        directions = np.full(self.num_agents, Direction.none.value, dtype=np.int64)
+
+        groups = self._group_agents()
+        for patch_id, agents in groups.items():
+            patch = self._patches[patch_id]
+            next_locs, r, d = patch.step_batch(self._agent_locs[agents], actions[agents])
+            self._agent_locs[agents] = next_locs
+            rewards[agents] = r
+            directions[agents] = d
+
+        self._t += 1
+        self._mark_dirty(groups)
+
+        if self._recorder is not None:
+            self._record(self._recorder, groups, actions, rewards, directions)
+
+        leaving = np.flatnonzero(directions != Direction.none.value)
+        if len(leaving):
+            self._handle_agent_transitions(leaving, directions[leaving])
+            self._maybe_unload()
+
+        if self._prefetch:
+            self._maybe_prefetch()
+
+        return self._agent_locs.copy(), rewards
+
+    def _record(self, recorder: TrajectoryRecorder, groups: Dict[PatchID, List[int]], actions: np.ndarray, rewards: np.ndarray,
+                directions: np.ndarray) -> None:
+        # one row per hosted agent, before any of them is moved to a neighbor
+        hosted = [i for agents in groups.values() for i in agents]
+        patch_ids = np.array([patch_id for patch_id, agents in groups.items() for _ in agents], dtype=np.int64)
+        recorder.record_batch(patch_ids, self._agent_locs[hosted], None, actions[hosted],
+                                    rewards[hosted], directions[hosted])
+
+    def agent_patch_ids(self) -> List[PatchID | None]:
+        return list(self._agent_patch_ids)
+
+    def _owns(self, patch_id: PatchID) -> bool:
+        return True
+
+    def _group_agents(self) -> Dict[PatchID, List[int]]:
+        groups: Dict[PatchID, List[int]] = {}
+        for i, patch_id in enumerate(self._agent_patch_ids):
+            if patch_id is not None:
+                groups.setdefault(patch_id, []).append(i)
+        return groups
+
+    def _move_agent(self, i: int, patch_id: PatchID | None) -> None:
+        prev_id = self._agent_patch_ids[i]
+        if prev_id is not None:
+            self._occupancy[prev_id] -= 1
+            if self._occupancy[prev_id] == 0:
+                del self._occupancy[prev_id]
+
+        self._agent_patch_ids[i] = patch_id
+        if patch_id is not None:
+            self._occupancy[patch_id] = self._occupancy.get(patch_id, 0) + 1
+
+    def _handle_agent_transitions(self, agents: np.ndarray, directions: np.ndarray) -> None:
+        entered = []
+        with self._lock:
+            for i, d in zip(agents, directions):
+                d = Direction(d)
+                last_state = self._agent_locs[i].copy()
+                next_id = _neighbor(self._agent_patch_ids[i], d)
+                self._agent_locs[i] = patch_loader.transit_agent(d, last_state)
+
+                if not self._owns(next_id):
+                    self._move_agent(i, None)
+                    x, y = self._agent_locs[i]
+                    self._handoffs.append((int(i), next_id, (int(x), int(y)), last_state.tolist()))
+                    continue
+
+                self._move_agent(i, next_id)
+                entered.append((i, next_id, last_state))
+
+                if next_id in self._patches:
+                    self._prefetch_stats['hits'] += 1
+                elif next_id in self._prefetch_pending:
+                    self._prefetch_stats['waits'] += 1
+                else:
+                    self._prefetch_stats['misses'] += 1
+
+        self._enter_patches(dict.fromkeys(patch_id for _, patch_id, _ in entered))
+
+        for i, patch_id, last_state in entered:
+            self._patches[patch_id].on_enter(last_state)
+
+    def _enter_patches(self, patch_ids: Iterable[PatchID]) -> None:
+        # the patches are occupied, and so pinned, before this is called, so loading one cannot evict another
+        # one store read for every patch entered this tick
+        patch_ids = list(patch_ids)
+        self._ensure_loaded(patch_ids)
+        self._mark_dirty(patch_ids)
+
+    def _quilt_state(self) -> Dict:
+        state = super()._quilt_state()
+        state['agent_patch_ids'] = [None if patch_id is None else list(patch_id) for patch_id in self._agent_patch_ids]
+        state['agent_locs'] = self._agent_locs.tolist()
+        return state
+
+    def _restore(self, snapshot: Store, state: Dict) -> None:
+        super()._restore(snapshot, state)
+
+        with self._lock:
+            for i, patch_id in enumerate(state['agent_patch_ids']):
+                self._move_agent(i, None if patch_id is None else tuple(patch_id))
+            self._agent_locs[:] = state['agent_locs']
+        self._ensure_loaded(self._occupancy)
+        self._dirty = set()
+
+    def _pinned_patches(self) -> Collection[PatchID]:
+        return self._occupancy
+
+    def _maybe_prefetch(self) -> None:
+        # only agents close to an edge contribute a prediction
+        size = patch_loader.SIZE
+        locs = self._agent_locs
+        dist = np.minimum(locs, size - 1 - locs).min(axis=1)
+
+        wanted: Dict[PatchID, None] = {}
+        for i in np.flatnonzero(dist <= self._edge_margin):
+            agent_patch_id = self._agent_patch_ids[i]
+            if agent_patch_id is None:
+                continue
+            for patch_id in _predict_neighbors(agent_patch_id, locs[i], size, self._edge_margin):
+                if self._owns(patch_id):
+                    wanted[patch_id] = None
+
+        # only ask again when the prediction changes
+        key = tuple(wanted)
+        if not wanted or key == self._prefetch_key:
+            return
+
+        self._prefetch_key = key
+        self._request_prefetch(list(wanted))
 
 # ------------------------
 # -- Internal utilities --
 # ------------------------
 
+# method -> histogram, see Instrumentation.instrument
+_QUILT_METHODS = {
+    'step': 'quilt.step',
+    '_handle_patch_transition': 'quilt.transition',
+    '_ensure_load': 'quilt.ensure_load',
+    '_ensure_loaded': 'quilt.ensure_loaded',
+    '_read_patch_states': 'quilt.storage_load',
+    'build_patch': 'quilt.build',
+    'unload_patch': 'quilt.unload',
+    '_drain_evictions': 'quilt.write_back',
+    '_prefetch_patches': 'quilt.prefetch',
+    'checkpoint': 'quilt.checkpoint',
+}
+
+_PATCH_METHODS = {
+    'step': 'patch.step',
+    'step_batch': 'patch.step_batch',
+    'generate_observation': 'patch.observation',
+}
+
 def _up(coords: PatchID) -> PatchID:
     x, y = coords
     return (x, y + 1)
@@ -143,3 +781,69 @@ def _right(coords: PatchID) -> PatchID:
 def _left(coords: PatchID) -> PatchID:
     x, y = coords
     return (x - 1, y)
+
+def _neighbor(coords: PatchID, d: Direction) -> PatchID:
+    if d == Direction.up: return _up(coords)
+    elif d == Direction.down: return _down(coords)
+    elif d == Direction.left: return _left(coords)
+
+    assert d == Direction.right
+    return _right(coords)
+
+def _neighborhood(patch_id: PatchID, radius: int) -> List[PatchID]:
+    # the (2 * radius + 1)^2 square centred on patch_id
+    x, y = patch_id
+    return [(x + dx, y + dy) for dx, dy in product(range(-radius, radius + 1), repeat=2)]
+
+def _predict_neighbors(patch_id: PatchID, agent_loc: AgentState, size: int, margin: int) -> List[PatchID]:
+    """
+    Neighbors the agent is heading towards, closest edge first.
+    A patch reports Direction.up when the agent leaves through x = 0 and Direction.left through y = 0.
+    """
+    x, y = agent_loc
+    edges = sorted([
+        (x, Direction.up),
+        (size - 1 - x, Direction.down),
+        (y, Direction.left),
+        (size - 1 - y, Direction.right),
+    ], key=lambda e: e[0])
+
+    # always the closest edge, plus any other edge within the margin
+    near = [d for i, (dist, d) in enumerate(edges) if i == 0 or dist <= margin]
+
+    step = {Direction.up: _up, Direction.down: _down, Direction.left: _left, Direction.right: _right}
+    wanted = [step[d](patch_id) for d in near]
+
+    # near a corner the diagonal patch is two transitions away
+    for (a, b) in [(Direction.up, Direction.left), (Direction.up, Direction.right),
+                   (Direction.down, Direction.left), (Direction.down, Direction.right)]:
+        if a in near and b in near:
+            wanted.append(step[b](step[a](patch_id)))
+
+    return wanted
+
+def _nbytes(obj: Any) -> int:
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_nbytes(k) + _nbytes(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_nbytes(v) for v in obj)
+
+    return size
+
+def _patch_nbytes(patch: Patch) -> int:
+    # rough estimate of the memory held by a patch, shared objects are counted once per patch
+    return sys.getsizeof(patch) + _nbytes(_attributes(patch))
+
+def _attributes(obj: Any) -> Dict[str, Any]:
+    # the instance dict plus the slots that are set
+    attrs = {}
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if name not in ('__dict__', '__weakref__') and hasattr(obj, name):
+                attrs[name] = getattr(obj, name)
+    attrs.update(getattr(obj, '__dict__', {}))
+    return attrs
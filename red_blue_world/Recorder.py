@@ -0,0 +1,213 @@
+import os
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Tuple
+
+from red_blue_world.interfaces import Direction
+
+# Streams transitions to disk for offline RL.
+#
+# rows are copied into preallocated column buffers, chunk_size rows per buffer. A full buffer is
+# handed to a background thread that writes it as one chunk while recording moves on to the next
+# buffer of the ring. Recording only waits when it comes back around to a buffer that is still
+# being written.
+#
+# a trajectory is a directory of chunks, chunk_000000, chunk_000001, ... either one compressed
+# .npz per chunk (format='npz') or one directory of .npy column files per chunk (format='npy'),
+# which read_trajectory memory-maps.
+
+COLUMNS = ('patch_id', 'state', 'observation', 'action', 'reward', 'direction')
+FORMATS = ('npz', 'npy')
+
+
+class TrajectoryRecorder:
+    def __init__(self, path: str, chunk_size: int = 4096, num_buffers: int = 2, format: str = 'npz') -> None:
+        if format not in FORMATS:
+            raise NotImplementedError(f'Unknown format: {format}')
+        if num_buffers < 2:
+            raise ValueError('Recording needs at least two buffers to overlap with writing')
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.format = format
+        self.chunk_size = chunk_size
+        self._num_buffers = num_buffers
+
+        # allocated on the first row, once the shapes and dtypes are known. Columns recorded as
+        # None (observations of a state-only env) are left out, and have to stay None
+        self._buffers: List[Dict[str, np.ndarray]] = []
+        # (position in a row, column) of every recorded column, per buffer
+        self._fields: List[List[Tuple[int, np.ndarray]]] = []
+        # positions of the columns that were left out
+        self._missing: List[int] = []
+        self._writes: List[Future | None] = [None] * num_buffers
+        self._current = 0
+        self._row = 0
+        self._chunk = 0
+
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._closed = False
+
+    def record(self, patch_id, state, observation, action, reward, direction) -> None:
+        """ Adds one transition. direction may be a Direction or its value. """
+        if self._closed:
+            raise ValueError('Cannot record to a closed TrajectoryRecorder')
+        if isinstance(direction, Direction):
+            direction = direction.value
+        row = (patch_id, state, observation, action, reward, direction)
+        if not self._buffers:
+            self._allocate(row, batched=False)
+        self._check_missing(row)
+
+        i = self._row
+        for k, column in self._fields[self._current]:
+            value = row[k]
+            if value is None:
+                self._missing_value(k)
+            column[i] = value
+
+        self._row = i + 1
+        if self._row == self.chunk_size:
+            self._submit()
+
+    def record_batch(self, patch_ids, states, observations, actions, rewards, directions) -> None:
+        """ Adds one transition per row of the arguments, e.g. the output of VectorRedBlueEnv.step. """
+        if self._closed:
+            raise ValueError('Cannot record to a closed TrajectoryRecorder')
+        rows = (patch_ids, states, observations, actions, rewards, directions)
+        if not self._buffers:
+            self._allocate(rows, batched=True)
+        self._check_missing(rows)
+        for k, column in self._fields[self._current]:
+            if rows[k] is None:
+                self._missing_value(k)
+
+        n = len(actions)
+        start = 0
+        while start < n:
+            take = min(n - start, self.chunk_size - self._row)
+            for k, column in self._fields[self._current]:
+                column[self._row:self._row + take] = rows[k][start:start + take]
+
+            self._row += take
+            start += take
+            if self._row == self.chunk_size:
+                self._submit()
+
+    def flush(self) -> None:
+        """ Writes the partial chunk and waits until everything recorded so far is on disk. """
+        if self._row > 0:
+            self._submit()
+        for i, write in enumerate(self._writes):
+            if write is not None:
+                self._writes[i] = None
+                write.result()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        self._writer.shutdown()
+
+    def __enter__(self) -> 'TrajectoryRecorder':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _allocate(self, row: Tuple, batched: bool) -> None:
+        for _ in range(self._num_buffers):
+            columns = {}
+            for name, value in zip(COLUMNS, row):
+                if value is None:
+                    continue
+                value = np.asarray(value)
+                shape = value.shape[1:] if batched else value.shape
+                columns[name] = np.zeros((self.chunk_size,) + shape, dtype=value.dtype)
+            self._buffers.append(columns)
+            self._fields.append([(COLUMNS.index(name), column) for name, column in columns.items()])
+        self._missing = [k for k, value in enumerate(row) if value is None]
+
+    def _check_missing(self, row: Tuple) -> None:
+        for k in self._missing:
+            if row[k] is not None:
+                raise ValueError(f'Column {COLUMNS[k]} was None in the first row and is not recorded')
+
+    def _missing_value(self, k: int) -> None:
+        raise ValueError(f'Column {COLUMNS[k]} is recorded but was given None')
+
+    def _submit(self) -> None:
+        index, rows = self._current, self._row
+        self._writes[index] = self._writer.submit(self._write, self._chunk, self._buffers[index], rows)
+        self._chunk += 1
+
+        # move on to the next buffer of the ring, once its previous chunk is written
+        self._current = (index + 1) % self._num_buffers
+        self._row = 0
+        write = self._writes[self._current]
+        if write is not None:
+            self._writes[self._current] = None
+            write.result()
+
+    def _write(self, chunk: int, columns: Dict[str, np.ndarray], rows: int) -> None:
+        name = os.path.join(self.path, f'chunk_{chunk:06d}')
+        if self.format == 'npz':
+            arrays: Dict[str, Any] = {column: values[:rows] for column, values in columns.items()}
+            np.savez_compressed(name, **arrays)
+            return
+
+        os.makedirs(name, exist_ok=True)
+        for column, values in columns.items():
+            np.save(os.path.join(name, f'{column}.npy'), values[:rows])
+
+
+def read_trajectory(path: str, batch_size: int | None = None) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Replays a recorded trajectory as dicts of columns, batch_size rows at a time (the last batch
+    may be shorter), or one chunk at a time when batch_size is None. .npy chunks are memory-mapped,
+    so a batch that does not straddle two chunks is a read-only view into the file.
+    """
+    pending: List[Dict[str, np.ndarray]] = []
+    size = 0
+    for chunk in _chunks(path):
+        if batch_size is None:
+            yield chunk
+            continue
+
+        rows = len(chunk['action'])
+        start = 0
+        while start < rows:
+            take = min(rows - start, batch_size - size)
+            pending.append({name: values[start:start + take] for name, values in chunk.items()})
+            size += take
+            start += take
+            if size == batch_size:
+                yield _concatenate(pending)
+                pending, size = [], 0
+
+    if pending:
+        yield _concatenate(pending)
+
+
+def _chunks(path: str) -> Iterator[Dict[str, np.ndarray]]:
+    for entry in sorted(os.listdir(path)):
+        if not entry.startswith('chunk_'):
+            continue
+
+        name = os.path.join(path, entry)
+        if entry.endswith('.npz'):
+            with np.load(name) as data:
+                yield {column: data[column] for column in data.files}
+        elif os.path.isdir(name):
+            yield {
+                column: np.load(os.path.join(name, f'{column}.npy'), mmap_mode='r')
+                for column in COLUMNS
+                if os.path.exists(os.path.join(name, f'{column}.npy'))
+            }
+
+
+def _concatenate(parts: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    if len(parts) == 1:
+        return parts[0]
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
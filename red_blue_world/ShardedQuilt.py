@@ -0,0 +1,230 @@
+import multiprocessing as mp
+import numpy as np
+from typing import Any, Dict, List, Tuple
+
+from red_blue_world.Patch import observation_view
+from red_blue_world.Quilt import MultiAgentQuilt, PatchID
+from red_blue_world import patch_loader, shm
+
+# a Quilt split across worker processes, so patch stepping is not serialized by one GIL
+#
+# the PatchID plane is cut into region_size x region_size regions and every region is owned
+# by one worker. A worker keeps the patches of its regions in its own MultiAgentQuilt and steps
+# the agents standing in them. When an agent walks onto a region owned by another worker it is
+# handed off, with the state it left in, and that worker calls on_enter for it.
+#
+# with a world_seed the layout of a patch does not depend on which worker generated it
+#
+# actions, states, rewards and observations live in shared memory, each worker writes the rows
+# of the agents it hosts and only the handoffs go through the pipes
+
+
+class ShardedQuilt:
+    def __init__(self, num_agents: int, num_workers: int, region_size: int = 8, max_patches: int | None = 1024,
+                 prefetch: bool = True, seed: int = 0, copy_observation: bool = True,
+                 start_method: str = 'spawn', world_seed: int | None = None) -> None:
+        self.num_agents = num_agents
+        self.num_workers = num_workers
+        self.region_size = region_size
+        self.copy_observation = copy_observation
+
+        size = patch_loader.SIZE
+        self._arrays: shm.Arrays = {}
+        self._actions = self._shared('actions', (num_agents,), np.int64)
+        self._states = self._shared('states', (num_agents, 2), np.int64)
+        self._rewards = self._shared('rewards', (num_agents,), np.float64)
+        self._observations = self._shared('observations', (num_agents, size, size), np.float64)
+
+        layout = shm.layout(self._arrays)
+
+        ctx: Any = mp.get_context(start_method)  # typed as BaseContext for a str start method, which has no Process
+        self._conns = []
+        self._workers = []
+        for index in range(num_workers):
+            parent, child = ctx.Pipe()
+            worker = ctx.Process(
+                target=_worker,
+                args=(child, index, num_agents, num_workers, region_size, max_patches, prefetch, seed, world_seed, layout),
+                daemon=True,
+            )
+            worker.start()
+            child.close()
+            self._conns.append(parent)
+            self._workers.append(worker)
+
+        self._closed = False
+
+    def _shared(self, name: str, shape: Tuple[int, ...], dtype) -> np.ndarray:
+        self._arrays[name] = shm.create_array(shape, dtype)
+        return self._arrays[name][1]
+
+    def reset(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Spreads the agents over the workers: agent i starts at a random location of the
+        patch in the middle of a region owned by worker i % num_workers.
+        """
+        placements: List[List[Tuple[int, PatchID]]] = [[] for _ in range(self.num_workers)]
+        for i in range(self.num_agents):
+            worker = i % self.num_workers
+            placements[worker].append((i, _start_patch(worker, self.region_size)))
+
+        self._call([('reset', p) for p in placements])
+        return self._states.copy(), observation_view(self._observations, self.copy_observation)
+
+    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Returns the states, observations and rewards of every agent. """
+        self._actions[:] = actions
+        replies = self._call([('step', None)] * self.num_workers)
+
+        # route the agents that walked onto another worker's regions
+        admits: List[List] = [[] for _ in range(self.num_workers)]
+        for handoffs in replies:
+            for handoff in handoffs:
+                admits[_owner(handoff[1], self.num_workers, self.region_size)].append(handoff)
+
+        if any(admits):
+            self._call([('admit', a) if a else None for a in admits])
+
+        return (
+            self._states.copy(),
+            observation_view(self._observations, self.copy_observation),
+            self._rewards.copy(),
+        )
+
+    def _call(self, messages: List) -> List:
+        # send everything first so the workers run in parallel, then collect
+        for conn, message in zip(self._conns, messages):
+            if message is not None:
+                conn.send(message)
+
+        replies = []
+        for conn, message in zip(self._conns, messages):
+            reply = conn.recv() if message is not None else None
+            if isinstance(reply, BaseException):
+                raise reply
+            replies.append(reply)
+
+        return replies
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+
+        self._call([('close', None)] * self.num_workers)
+        for worker in self._workers:
+            worker.join()
+        for conn in self._conns:
+            conn.close()
+
+        # drop our own views before releasing the segments
+        segments = [segment for segment, _ in self._arrays.values()]
+        self._arrays = {}
+        del self._actions, self._states, self._rewards, self._observations
+        shm.release(segments, unlink=True)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class _RegionQuilt(MultiAgentQuilt):
+    """ The part of a ShardedQuilt owned by one worker. """
+
+    def __init__(self, num_agents: int, index: int, num_workers: int, region_size: int,
+                 max_patches: int | None, prefetch: bool, world_seed: int | None) -> None:
+        self._index = index
+        self._num_workers = num_workers
+        self._region_size = region_size
+        super().__init__(num_agents, max_patches=max_patches, prefetch=prefetch, world_seed=world_seed)
+
+        # Quilt always builds the origin patch, another worker may own it
+        if not self._owns(self._active_patch_id):
+            with self._lock:
+                self._patches.pop(self._active_patch_id)
+                self._bytes -= self._patch_bytes.pop(self._active_patch_id, 0)
+
+    def _owns(self, patch_id: PatchID) -> bool:
+        return _owner(patch_id, self._num_workers, self._region_size) == self._index
+
+
+def _worker(conn, index: int, num_agents: int, num_workers: int, region_size: int,
+            max_patches: int | None, prefetch: bool, seed: int, world_seed: int | None, layout: Dict) -> None:
+    # patches draw from the global generator, so every worker gets its own stream
+    np.random.seed(seed + index)
+
+    attached = shm.attach(layout)
+    arrays = {name: arr for name, (_, arr) in attached.items()}
+
+    quilt = _RegionQuilt(num_agents, index, num_workers, region_size, max_patches, prefetch, world_seed)
+
+    def publish(agents) -> None:
+        patch_ids = quilt._agent_patch_ids
+        for i in agents:
+            loc = quilt._agent_locs[i]
+            arrays['states'][i] = loc
+            quilt._patches[patch_ids[i]].observe_into(loc, arrays['observations'][i])
+
+    while True:
+        cmd, arg = conn.recv()
+        try:
+            if cmd == 'step':
+                agents = quilt.hosted_agents()
+                states, rewards = quilt.step(arrays['actions'])
+                arrays['rewards'][agents] = rewards[agents]
+
+                handoffs = quilt.take_handoffs()
+                # agents that left keep their reward here, the worker admitting them writes the rest
+                publish(quilt.hosted_agents())
+                conn.send(handoffs)
+
+            elif cmd == 'admit':
+                quilt.admit_agents(arg)
+                publish([i for i, _, _, _ in arg])
+                conn.send(None)
+
+            elif cmd == 'reset':
+                with quilt._lock:
+                    for i in quilt.hosted_agents():
+                        quilt._move_agent(i, None)
+
+                by_patch: Dict[PatchID, List[int]] = {}
+                for i, patch_id in arg:
+                    by_patch.setdefault(patch_id, []).append(i)
+                for patch_id, agents in by_patch.items():
+                    quilt.reset_agents(agents, patch_id)
+
+                arrays['rewards'][[i for i, _ in arg]] = 0
+                publish([i for i, _ in arg])
+                conn.send(None)
+
+            elif cmd == 'close':
+                quilt.close()
+                arrays.clear()
+                segments = [segment for segment, _ in attached.values()]
+                attached.clear()
+                shm.release(segments, unlink=False)
+                conn.send(None)
+                return
+
+        except Exception as e:
+            conn.send(e)
+
+# ------------------------
+# -- Internal utilities --
+# ------------------------
+
+def _region(patch_id: PatchID, region_size: int) -> Tuple[int, int]:
+    x, y = patch_id
+    return x // region_size, y // region_size
+
+def _owner(patch_id: PatchID, num_workers: int, region_size: int) -> int:
+    # diagonal stripes, so the regions next to a region in either direction belong to other workers
+    rx, ry = _region(patch_id, region_size)
+    return (rx + ry) % num_workers
+
+def _start_patch(worker: int, region_size: int) -> PatchID:
+    middle = region_size // 2
+    return (worker * region_size + middle, middle)
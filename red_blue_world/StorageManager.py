@@ -1,9 +1,12 @@
 
 import sqlite3
-import os, errno
-from typing import List, Tuple, Any, Dict, AnyStr
+import mmap, struct, tempfile, threading, hashlib, math
+import os, errno, time
+import numpy as np
+from collections import defaultdict
+from typing import List, Tuple, Any, Dict, AnyStr, Iterable, Iterator
 from abc import ABCMeta, abstractmethod
-import simplejson
+from red_blue_world import Codec
 
 # This class and its method are used to instantiate a storage class
 # To keep things consistent, do not directly instantiate
@@ -11,13 +14,34 @@ import simplejson
 class StoreFactory:
 
     @staticmethod
-    def create_store(store_type: str, db_name: str = ''):
+    def create_store(store_type: str, db_name: str = '', index: str | None = None, index_args: Dict | None = None, **kwargs):
+        """ index ('exact' or 'bloom') puts an IndexedStore, built with index_args, in front of the store. """
+        store: Store
         if(store_type == "sqlite_basic"):
-            return SqliteBasicStorage(db_name=db_name)
+            store = SqliteBasicStorage(db_name=db_name, **kwargs)
+        elif(store_type == "mmap_tiled"):
+            store = MmapTiledStorage(db_name=db_name, **kwargs)
         else:
             raise NotImplementedError
+
+        if index is None:
+            return store
+        return IndexedStore(store, index, **(index_args or {}))
         
 
+# Quilt addresses patches by (x, y) PatchID; stores key them by this string
+def patch_key(coords: Tuple[int, int]) -> str:
+    x, y = coords
+    return f'{x},{y}'
+
+def parse_patch_key(patch_id: str | bytes | Tuple[int, int]) -> Tuple[int, int]:
+    if isinstance(patch_id, tuple):
+        return patch_id
+    key = patch_id.decode('utf-8') if isinstance(patch_id, bytes) else patch_id
+    x, y = key.split(',')
+    return int(x), int(y)
+
+
 class Store(metaclass=ABCMeta):
 
     @abstractmethod
@@ -36,64 +60,628 @@ class Store(metaclass=ABCMeta):
     def store_patch(self, patch_id: AnyStr, patch_state: Dict) -> None:
         pass
 
+    def store_patches(self, items: Iterable[Tuple[AnyStr, Dict]]) -> None:
+        for patch_id, patch_state in items:
+            self.store_patch(patch_id, patch_state)
+
+    def patch_ids(self) -> Iterator:
+        """ Every stored patch id, in no particular order. """
+        raise NotImplementedError
+
+    def load_region(self, x0: int, y0: int, x1: int, y1: int) -> List[Tuple[Any, Any]]:
+        """ The stored patches with x0 <= x <= x1 and y0 <= y <= y1, like load_patch_states. """
+        return self.load_patch_states([patch_key((x, y)) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)])
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
 class SqliteBasicStorage(Store):
-    _instances : Dict[Any, Any] = {}
+    """
+    Rows are clustered on the Morton (Z-order) key of their (x, y) patch id, in a WITHOUT ROWID
+    table keyed by (zkey, patch_id). Patches that are close on the plane are mostly close in the
+    table, so a region is read with a few range scans (load_region). Ids that are not "x,y" keys
+    share one zkey and are only found by their id.
+    """
+
+    # bumped whenever the patches table changes, stored in the database's user_version
+    SCHEMA_VERSION = 2
+
+    _insert_cmd = '''INSERT INTO patches(zkey, patch_id, patch_state) VALUES(?,?,?)
+        ON CONFLICT(zkey, patch_id) DO UPDATE SET patch_state=excluded.patch_state'''
 
-    def __new__(cls, db_name):
-        if cls not in cls._instances:
-            cls._instances[cls] = super(SqliteBasicStorage, cls).__new__(cls)
+    _columns = [('zkey', 'INTEGER'), ('patch_id', 'TEXT'), ('patch_state', 'BLOB')]
+    # tables keyed by patch_id alone: version 1, and the json text table of the databases written
+    # before the version was recorded (version 0). Codec.decode reads the text rows as they are
+    _legacy_columns = (
+        [('patch_id', 'TEXT'), ('patch_state', 'BLOB')],
+        [('patch_id', 'TEXT'), ('patch_state', 'TEXT')],
+    )
 
-        return cls._instances[cls]
+    def __init__(self, db_name, buffer_size: int = 0, flush_interval: float | None = None, codec: str = 'json',
+                 persistent: bool = False) -> None:
+        """
+        Patch states are written with the named codec (see Codec.py) and read back with
+        whichever codec wrote them.
 
-    def __init__(self, db_name) -> None:
+        With buffer_size > 0, store_patch only queues the write. Queued writes go to the
+        database in one transaction once buffer_size patches are pending, once
+        flush_interval seconds have passed since the last flush, or on flush/close.
+
+        By default a database left behind at db_name is deleted. With persistent=True it is
+        opened instead, after checking its schema version, so a world can be resumed. Nothing
+        but the schema is read when opening, see IndexedStore for an existence index built from
+        the stored ids.
+
+        Every instance has its own connection, one store per world or shard.
+        """
         super().__init__()
+
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._codec = Codec.get_codec(codec)
+        self._pending: Dict[Any, bytes] = {}
+        self._last_flush = time.monotonic()
+
+        # Quilt reads from its prefetch thread, so the connection is shared between threads
+        # and every access goes through this lock
+        self._lock = threading.RLock()
         
-        # if the agent terminates and leaves behind a db, we delete that db
-        try:
-            os.remove(db_name)
-        except OSError as e:
-            if e.errno != errno.ENOENT: # an error other than that the file does not exist
-                raise 
+        # if the agent terminates and leaves behind a db, we delete that db (and its write-ahead log)
+        if not persistent:
+            for path in (db_name, db_name + '-wal', db_name + '-shm'):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT: # an error other than that the file does not exist
+                        raise 
 
         # creates the env db
-        self.con = sqlite3.connect(db_name)
+        # statements are reused through the connection's prepared statement cache
+        self.con = sqlite3.connect(db_name, cached_statements=256, check_same_thread=False)
+
+        # one fsync per checkpoint instead of one per commit
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+
+        self._open_schema(db_name)
+
+    def _open_schema(self, db_name) -> None:
+        """ Creates the patches table in a new database, or checks the one of an existing database. """
+        version = self.con.execute("PRAGMA user_version").fetchone()[0]
+        columns = [(row[1], row[2]) for row in self.con.execute("PRAGMA table_info(patches)")]
+
+        if not columns:
+            with self.con:
+                self._create_table()
+            return
+
+        if version in (0, 1) and columns in self._legacy_columns:
+            self._migrate_legacy()
+            return
+
+        if version != self.SCHEMA_VERSION or columns != self._columns:
+            self.con.close()
+            raise ValueError(f'{db_name} has schema version {version} with columns {columns}, '
+                             f'expected version {self.SCHEMA_VERSION} with columns {self._columns}')
+
+    def _create_table(self) -> None:
+        self.con.execute('''CREATE TABLE patches(
+            zkey INTEGER NOT NULL, patch_id TEXT NOT NULL, patch_state BLOB NOT NULL,
+            PRIMARY KEY(zkey, patch_id)) WITHOUT ROWID''')
+        self.con.execute(f"PRAGMA user_version={self.SCHEMA_VERSION}")
 
-        # creates the patches table
-        cur = self.con.cursor()
-        cur.execute("CREATE TABLE patches(patch_id TEXT PRIMARY KEY, patch_state TEXT NOT NULL)")
+    def _migrate_legacy(self) -> None:
+        self.con.create_function('zkey', 1, _zkey, deterministic=True)
+        with self.con:
+            self.con.execute("ALTER TABLE patches RENAME TO patches_legacy")
+            self._create_table()
+            self.con.execute("INSERT INTO patches SELECT zkey(patch_id), patch_id, patch_state FROM patches_legacy")
+            self.con.execute("DROP TABLE patches_legacy")
 
 
     def patch_exists(self, patch_id: AnyStr) -> bool:
-        cur = self.con.cursor()
-        exist_cmd = '''SELECT 1 FROM patches WHERE patch_id=? LIMIT 1'''
-        cur.execute(exist_cmd, (patch_id,))
-        exists = cur.fetchone() is not None
-        return exists
+        with self._lock:
+            if patch_id in self._pending:
+                return True
+
+            cur = self.con.cursor()
+            exist_cmd = '''SELECT 1 FROM patches WHERE zkey=? AND patch_id=? LIMIT 1'''
+            cur.execute(exist_cmd, (_zkey(patch_id), patch_id))
+            exists = cur.fetchone() is not None
+            return exists
 
     def load_patch_states(self, patch_ids: List) -> List[Tuple[Any, Any]]:
-        cur = self.con.cursor()
-        load_cmd = '''SELECT * FROM patches WHERE patch_id IN (%s)'''
-        cur.execute(load_cmd % ','.join('?'*len(patch_ids)), patch_ids)
-        ids_and_patch_states = cur.fetchall()
-        json_loaded = [(patch_id, simplejson.loads(state_json)) for patch_id, state_json in ids_and_patch_states]
-        return json_loaded 
+        if not patch_ids:
+            return []
+
+        with self._lock:
+            # queued writes are newer than anything in the database
+            self.flush()
+            # the zkeys seek into the clustered table, the ids pick the rows out of them
+            zkeys = sorted({_zkey(patch_id) for patch_id in patch_ids})
+            cur = self.con.cursor()
+            load_cmd = '''SELECT patch_id, patch_state FROM patches WHERE zkey IN (%s) AND patch_id IN (%s)'''
+            cur.execute(load_cmd % (','.join('?'*len(zkeys)), ','.join('?'*len(patch_ids))), zkeys + list(patch_ids))
+            ids_and_patch_states = cur.fetchall()
+        decoded = [(patch_id, Codec.decode(data)) for patch_id, data in ids_and_patch_states]
+        return decoded
+
+    def load_region(self, x0: int, y0: int, x1: int, y1: int) -> List[Tuple[Any, Any]]:
+        """ In Z-order. The region is covered by a few zkey ranges, scanned one after the other. """
+        if x0 > x1 or y0 > y1:
+            return []
+
+        with self._lock:
+            self.flush()
+            cur = self.con.cursor()
+            rows = []
+            for lo, hi in _zranges(x0, y0, x1, y1):
+                cur.execute('''SELECT patch_id, patch_state FROM patches WHERE zkey BETWEEN ? AND ?''', (lo, hi))
+                rows.extend(cur.fetchall())
+
+        # the ranges may run past the region where it cuts through a Z-order block
+        decoded = []
+        for patch_id, data in rows:
+            try:
+                x, y = parse_patch_key(patch_id)
+            except ValueError:
+                continue
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                decoded.append((patch_id, Codec.decode(data)))
+        return decoded
 
     def load_patch_state(self, patch_id: AnyStr) -> Dict: 
-        cur = self.con.cursor()
-        load_cmd = '''SELECT patch_state FROM patches WHERE patch_id=?'''
-        cur.execute(load_cmd, (patch_id,))
-        str_patch_state = cur.fetchone()
-        if(str_patch_state is None):
+        with self._lock:
+            if patch_id in self._pending:
+                return Codec.decode(self._pending[patch_id])
+
+            cur = self.con.cursor()
+            load_cmd = '''SELECT patch_state FROM patches WHERE zkey=? AND patch_id=?'''
+            cur.execute(load_cmd, (_zkey(patch_id), patch_id))
+            row = cur.fetchone()
+        if(row is None):
             return {}
-        json_loaded = simplejson.loads(str_patch_state[0])
-        return json_loaded
+        return Codec.decode(row[0])
 
     def store_patch(self, patch_id: AnyStr, patch_state: Dict) -> None:
-        json_rep = simplejson.dumps(patch_state)
-        insert_cmd = '''INSERT INTO patches(patch_id, patch_state) VALUES(?,?) 
-        ON CONFLICT(patch_id) DO UPDATE SET patch_state=excluded.patch_state'''
-        cur = self.con.cursor()
-        cur.execute(insert_cmd, (patch_id, json_rep))
-        self.con.commit()
+        data = self._codec.encode(patch_state)
+        with self._lock:
+            if self._buffer_size > 0:
+                self._pending[patch_id] = data
+                self._maybe_flush()
+                return
+
+            cur = self.con.cursor()
+            cur.execute(self._insert_cmd, (_zkey(patch_id), patch_id, data))
+            self.con.commit()
+
+    def store_patches(self, items: Iterable[Tuple[AnyStr, Dict]]) -> None:
+        rows = [(patch_id, self._codec.encode(patch_state)) for patch_id, patch_state in items]
+        with self._lock:
+            if self._buffer_size > 0:
+                self._pending.update(rows)
+                self._maybe_flush()
+                return
+
+            self._write(rows)
+
+    def _maybe_flush(self) -> None:
+        if len(self._pending) >= self._buffer_size:
+            self.flush()
+        elif self._flush_interval is not None and time.monotonic() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._pending:
+                return
+
+            rows = list(self._pending.items())
+            self._pending.clear()
+            self._write(rows)
+
+    def _write(self, rows: List[Tuple[Any, bytes]]) -> None:
+        # a single transaction for the whole batch, in key order so the inserts walk the table once
+        keyed = sorted((_zkey(patch_id), patch_id, data) for patch_id, data in rows)
+        with self.con:
+            self.con.executemany(self._insert_cmd, keyed)
+
+    def patch_ids(self) -> Iterator:
+        with self._lock:
+            ids = [row[0] for row in self.con.execute('SELECT patch_id FROM patches')]
+            stored = set(ids)
+            ids.extend(patch_id for patch_id in self._pending if patch_id not in stored)
+        return iter(ids)
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            self.con.close()
         
 
+
+
+class MmapTiledStorage(Store):
+    """
+    Keeps fixed-size patch records in a memory-mapped file.
+
+    The PatchID plane is cut into tile_size x tile_size tiles. Each tile is one contiguous
+    block of records in the file, so neighboring patches sit next to each other on disk and
+    a 3x3 or 7x7 neighborhood is read from a handful of contiguous pages.
+
+    A record is a uint32 length (0 for an empty slot) followed by the encoded patch state.
+    Patch ids are (x, y) tuples or "x,y" keys as produced by patch_key, any other id raises
+    ValueError. Quilt's SNAPSHOT_KEY is not one, so this store cannot hold checkpoints.
+    """
+
+    _header = struct.Struct('<I')
+
+    def __init__(self, db_name, record_size: int = 1024, tile_size: int = 8, codec: str = 'binary') -> None:
+        super().__init__()
+
+        self._record_size = record_size
+        self._tile_size = tile_size
+        self._tile_bytes = record_size * tile_size * tile_size
+        self._codec = Codec.get_codec(codec)
+
+        # tile coordinates -> slot of the tile in the file, tiles are appended as they are first written
+        self._tiles: Dict[Tuple[int, int], int] = {}
+
+        # growing the file remaps it, so readers on other threads must not run concurrently
+        self._lock = threading.RLock()
+
+        # like the sqlite store, a file left behind by a previous run is discarded
+        if db_name in ('', ':memory:'):
+            self._file = tempfile.TemporaryFile()
+        else:
+            self._file = open(db_name, 'w+b')
+
+        self._capacity = 0
+        self._mm = self._map(1)
+
+    def _map(self, capacity: int) -> mmap.mmap:
+        self._file.truncate(capacity * self._tile_bytes)
+        self._capacity = capacity
+        return mmap.mmap(self._file.fileno(), capacity * self._tile_bytes)
+
+    def _grow(self, min_tiles: int) -> None:
+        capacity = max(min_tiles, 2 * self._capacity)
+        self._mm.close()
+        self._mm = self._map(capacity)
+
+    def _locate(self, patch_id) -> Tuple[Tuple[int, int], int]:
+        try:
+            x, y = parse_patch_key(patch_id)
+        except ValueError:
+            raise ValueError(f'MmapTiledStorage only stores (x, y) or "x,y" patch ids, got {patch_id!r}') from None
+        t = self._tile_size
+        tile = (x // t, y // t)
+        return tile, ((y % t) * t + (x % t)) * self._record_size
+
+    def _read(self, patch_id) -> bytes | None:
+        tile, offset = self._locate(patch_id)
+        with self._lock:
+            slot = self._tiles.get(tile)
+            if slot is None:
+                return None
+
+            start = slot * self._tile_bytes + offset
+            (length,) = self._header.unpack_from(self._mm, start)
+            if length == 0:
+                return None
+
+            start += self._header.size
+            return self._mm[start:start + length]
+
+    def patch_exists(self, patch_id) -> bool:
+        tile, offset = self._locate(patch_id)
+        with self._lock:
+            slot = self._tiles.get(tile)
+            if slot is None:
+                return False
+
+            (length,) = self._header.unpack_from(self._mm, slot * self._tile_bytes + offset)
+            return length > 0
+
+    def load_patch_states(self, patch_ids: List) -> List[Tuple[Any, Any]]:
+        # group by tile so every tile block is read once, front to back
+        by_tile = defaultdict(list)
+        rows = []
+        with self._lock:
+            # under the lock, a concurrent store_patch may add tiles
+            for patch_id in patch_ids:
+                tile, offset = self._locate(patch_id)
+                if tile in self._tiles:
+                    by_tile[self._tiles[tile]].append((offset, patch_id))
+
+            for slot in sorted(by_tile):
+                block = memoryview(self._mm)[slot * self._tile_bytes:(slot + 1) * self._tile_bytes]
+                for offset, patch_id in sorted(by_tile[slot]):
+                    (length,) = self._header.unpack_from(block, offset)
+                    if length > 0:
+                        start = offset + self._header.size
+                        rows.append((patch_id, bytes(block[start:start + length])))
+                block.release()
+
+        return [(patch_id, Codec.decode(data)) for patch_id, data in rows]
+
+    def load_patch_state(self, patch_id) -> Dict:
+        data = self._read(patch_id)
+        if data is None:
+            return {}
+        return Codec.decode(data)
+
+    def store_patch(self, patch_id, patch_state: Dict) -> None:
+        data = self._codec.encode(patch_state)
+        if len(data) + self._header.size > self._record_size:
+            raise ValueError(f'Patch state of {len(data)} bytes does not fit in a {self._record_size} byte record')
+
+        tile, offset = self._locate(patch_id)
+        with self._lock:
+            slot = self._tiles.get(tile)
+            if slot is None:
+                slot = len(self._tiles)
+                if slot >= self._capacity:
+                    self._grow(slot + 1)
+                self._tiles[tile] = slot
+
+            start = slot * self._tile_bytes + offset
+            self._header.pack_into(self._mm, start, len(data))
+            start += self._header.size
+            self._mm[start:start + len(data)] = data
+
+    def patch_ids(self) -> Iterator[Tuple[int, int]]:
+        t = self._tile_size
+        with self._lock:
+            lengths = {
+                tile: np.ndarray((t * t,), dtype='<u4', buffer=self._mm, offset=slot * self._tile_bytes,
+                                 strides=(self._record_size,)).copy()
+                for tile, slot in self._tiles.items()
+            }
+
+        for (tx, ty), length in lengths.items():
+            for record in np.flatnonzero(length):
+                y, x = divmod(int(record), t)
+                yield tx * t + x, ty * t + y
+
+    def flush(self) -> None:
+        with self._lock:
+            self._mm.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            self._mm.close()
+            self._file.close()
+
+
+class IndexedStore(Store):
+    """
+    Answers existence questions about a wrapped store from memory, so probing for a patch
+    that was never stored costs no read.
+
+    index='exact' keeps the id of every stored patch, (x, y) ids packed into one int.
+    index='bloom' keeps a Bloom filter sized for expected_patches at false_positive_rate.
+    It uses about 10 bits per patch at 1%, and a positive answer is confirmed by the store.
+
+    Every write goes through the wrapper, which keeps the index in step. The index is built
+    from the ids the store already holds (Store.patch_ids) when the wrapper is created.
+    """
+
+    def __init__(self, store: Store, index: str = 'exact', expected_patches: int = 1 << 20,
+                 false_positive_rate: float = 0.01) -> None:
+        if index == 'exact':
+            self._index: _ExactIndex | _BloomFilter = _ExactIndex()
+        elif index == 'bloom':
+            self._index = _BloomFilter(expected_patches, false_positive_rate)
+        else:
+            raise NotImplementedError(f'Unknown index: {index}')
+
+        self._store = store
+        self._exact = index == 'exact'
+        self._lock = threading.Lock()
+        self._index.add_many(store.patch_ids())
+
+    def patch_exists(self, patch_id: AnyStr) -> bool:
+        if not self._index.contains(patch_id):
+            return False
+        return self._exact or self._store.patch_exists(patch_id)
+
+    def load_patch_states(self, patch_ids: List) -> List[Tuple[Any, Any]]:
+        present = [patch_id for patch_id in patch_ids if self._index.contains(patch_id)]
+        if not present:
+            return []
+        return self._store.load_patch_states(present)
+
+    def load_patch_state(self, patch_id: AnyStr) -> Dict:
+        if not self._index.contains(patch_id):
+            return {}
+        return self._store.load_patch_state(patch_id)
+
+    def store_patch(self, patch_id: AnyStr, patch_state: Dict) -> None:
+        # indexed before the write, so a reader never misses a patch that is being stored
+        with self._lock:
+            self._index.add(patch_id)
+        self._store.store_patch(patch_id, patch_state)
+
+    def store_patches(self, items: Iterable[Tuple[AnyStr, Dict]]) -> None:
+        items = list(items)
+        with self._lock:
+            self._index.add_many(patch_id for patch_id, _ in items)
+        self._store.store_patches(items)
+
+    def patch_ids(self) -> Iterator:
+        return self._store.patch_ids()
+
+    def load_region(self, x0: int, y0: int, x1: int, y1: int) -> List[Tuple[Any, Any]]:
+        return self._store.load_region(x0, y0, x1, y1)
+
+    def flush(self) -> None:
+        self._store.flush()
+
+    def close(self) -> None:
+        self._store.close()
+
+
+# Morton (Z-order) keys interleave the bits of x and y, x in the even bits. Coordinates are
+# offset by 2**31 so they are unsigned, and the key by -2**63 so it fits sqlite's signed integers
+_ZBIAS = 1 << 31
+_ZOFFSET = 1 << 63
+# ids that are not "x,y" keys in the int32 range
+_OPAQUE_ZKEY = -_ZOFFSET
+
+def _spread(v: int) -> int:
+    # the 32 bits of v moved to the even bits of a 64 bit int
+    v = (v | (v << 16)) & 0x0000ffff0000ffff
+    v = (v | (v << 8)) & 0x00ff00ff00ff00ff
+    v = (v | (v << 4)) & 0x0f0f0f0f0f0f0f0f
+    v = (v | (v << 2)) & 0x3333333333333333
+    return (v | (v << 1)) & 0x5555555555555555
+
+def _interleave(x: int, y: int) -> int:
+    # x and y already offset
+    return _spread(x) | (_spread(y) << 1)
+
+def _zkey(patch_id) -> int:
+    try:
+        x, y = parse_patch_key(patch_id)
+    except ValueError:
+        return _OPAQUE_ZKEY
+    x += _ZBIAS
+    y += _ZBIAS
+    if not (0 <= x < 1 << 32 and 0 <= y < 1 << 32):
+        return _OPAQUE_ZKEY
+    return _interleave(x, y) - _ZOFFSET
+
+def _zranges(x0: int, y0: int, x1: int, y1: int) -> List[Tuple[int, int]]:
+    """
+    Inclusive zkey ranges covering the inclusive region. Z-order blocks inside the region are
+    taken whole and the ones on its border are split, down to blocks of about 1/8 of the region's
+    side, so there are a few dozen ranges at most and the part outside the region stays small.
+    """
+    x0, y0, x1, y1 = (max(0, min(v + _ZBIAS, (1 << 32) - 1)) for v in (x0, y0, x1, y1))
+    min_level = max(0, (max(x1 - x0, y1 - y0) + 1).bit_length() - 3)
+    ranges: List[Tuple[int, int]] = []
+
+    def visit(bx: int, by: int, level: int) -> None:
+        size = 1 << level
+        if bx > x1 or by > y1 or bx + size <= x0 or by + size <= y0:
+            return
+
+        inside = x0 <= bx and bx + size - 1 <= x1 and y0 <= by and by + size - 1 <= y1
+        if inside or level <= min_level:
+            lo = _interleave(bx, by) - _ZOFFSET
+            hi = lo + size * size - 1
+            if ranges and ranges[-1][1] + 1 == lo:
+                ranges[-1] = (ranges[-1][0], hi)
+            else:
+                ranges.append((lo, hi))
+            return
+
+        # the quadrants in Z-order, x first
+        half = size >> 1
+        for dy in (0, half):
+            for dx in (0, half):
+                visit(bx + dx, by + dy, level - 1)
+
+    visit(0, 0, 32)
+    return ranges
+
+
+def _index_key(patch_id) -> int | str:
+    # (x, y) ids, as tuples or patch_key strings, packed into one int
+    try:
+        x, y = parse_patch_key(patch_id)
+    except ValueError:
+        return patch_id.decode('utf-8') if isinstance(patch_id, bytes) else patch_id
+    return ((x & 0xffffffff) << 32) | (y & 0xffffffff)
+
+
+class _ExactIndex:
+    def __init__(self) -> None:
+        self._keys: set = set()
+
+    def add(self, patch_id) -> None:
+        self._keys.add(_index_key(patch_id))
+
+    def add_many(self, patch_ids: Iterable) -> None:
+        self._keys.update(map(_index_key, patch_ids))
+
+    def contains(self, patch_id) -> bool:
+        return _index_key(patch_id) in self._keys
+
+
+_MASK64 = (1 << 64) - 1
+
+
+class _BloomFilter:
+    """
+    Double hashing over splitmix64 of the packed id. Single ids are hashed with Python ints,
+    batches (the rebuild) with numpy, both giving the same bits.
+    """
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        capacity = max(capacity, 1)
+        self._bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 64)
+        self._hashes = max(int(round(self._bits / capacity * math.log(2))), 1)
+        # a bytearray is much cheaper to index from Python, numpy writes the batches through a view
+        self._array = bytearray((self._bits + 7) // 8)
+
+    def add(self, patch_id) -> None:
+        h1 = _splitmix64(_bloom_key(patch_id))
+        h2 = _splitmix64(h1) | 1
+        for i in range(self._hashes):
+            p = ((h1 + i * h2) & _MASK64) % self._bits
+            self._array[p >> 3] |= 1 << (p & 7)
+
+    def add_many(self, patch_ids: Iterable) -> None:
+        keys = np.fromiter((_bloom_key(patch_id) for patch_id in patch_ids), dtype=np.uint64)
+        if len(keys) == 0:
+            return
+
+        array = np.frombuffer(self._array, dtype=np.uint8)
+        with np.errstate(over='ignore'):
+            h1 = _splitmix64_array(keys)
+            h2 = _splitmix64_array(h1) | np.uint64(1)
+            for i in range(self._hashes):
+                p = (h1 + np.uint64(i) * h2) % np.uint64(self._bits)
+                np.bitwise_or.at(array, (p >> np.uint64(3)).astype(np.int64),
+                                 (np.uint8(1) << (p & np.uint64(7)).astype(np.uint8)))
+
+    def contains(self, patch_id) -> bool:
+        array, bits = self._array, self._bits
+        h1 = _splitmix64(_bloom_key(patch_id))
+        # most lookups are misses, test the first bit before deriving the others
+        p = h1 % bits
+        if not array[p >> 3] & (1 << (p & 7)):
+            return False
+
+        h2 = _splitmix64(h1) | 1
+        for i in range(1, self._hashes):
+            p = ((h1 + i * h2) & _MASK64) % bits
+            if not array[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+def _bloom_key(patch_id) -> int:
+    key = _index_key(patch_id)
+    if isinstance(key, int):
+        return key
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def _splitmix64(z: int) -> int:
+    z = (z + 0x9e3779b97f4a7c15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return z ^ (z >> 31)
+
+def _splitmix64_array(z: np.ndarray) -> np.ndarray:
+    z = z + np.uint64(0x9e3779b97f4a7c15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
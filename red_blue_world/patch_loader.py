@@ -5,6 +5,8 @@
 #   - Thread, not process. Let the GIL be our locking mechanism
 #   - Should be io bound and not compute bound
 
+import numpy as np
+
 from red_blue_world.patches.gw import ContinualGridWorld
 from red_blue_world.patches.pickyeater import ContinualCollectRGB, ContinualCollectPartial
 from red_blue_world.interfaces import AgentState, Direction
@@ -13,11 +15,17 @@ from red_blue_world.interfaces import AgentState, Direction
 # TODO: should change this later
 SIZE = 15
 
-def patch_loader(name, agent_loc):
+def patch_loader(name, agent_loc, rng: np.random.Generator | None = None, observation_mode: str = 'both'):
     if name == 'gw':
         size = SIZE #some number
-        return ContinualGridWorld(size, agent_loc)
-    
+        return ContinualGridWorld(size, agent_loc, rng=rng, observation_mode=observation_mode)
+
+def patch_rng(world_seed: int, patch_id) -> np.random.Generator:
+    """ The generator a patch is built from. It only depends on the world seed and the PatchID. """
+    x, y = patch_id
+    # SeedSequence only takes non-negative entropy, so fold the sign into the low bit
+    return np.random.default_rng([world_seed, _zigzag(x), _zigzag(y)])
+
 def transit_agent(d: Direction, agent_loc: AgentState):
     env_x, env_y = SIZE, SIZE
     x, y = agent_loc
@@ -30,4 +38,7 @@ def transit_agent(d: Direction, agent_loc: AgentState):
     else:
         assert d == Direction.right
         next_loc = (0, y)
-    return next_loc
\ No newline at end of file
+    return next_loc
+
+def _zigzag(v: int) -> int:
+    return 2 * v if v >= 0 else -2 * v - 1
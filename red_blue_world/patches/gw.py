@@ -1,10 +1,11 @@
 import numpy as np
 import enum
 import pygame
-from typing import Tuple, NamedTuple
+from typing import Any, Tuple, NamedTuple
 
-from red_blue_world.Patch import Patch
+from red_blue_world.Patch import Patch, check_observation_mode, observation_view
 from red_blue_world.interfaces import Direction
+from red_blue_world.patches import kernels
 
 
 OBJECT_PERCENTAGE = 0.1
@@ -21,6 +22,10 @@ class Action(enum.Enum):
     stay = 4
 
 
+# (dx, dy) of every action, indexed by action value
+_MOVES = np.array([(-1, 0), (0, 1), (1, 0), (0, -1), (0, 0)], dtype=np.int64)
+
+
 class PatchConfig(NamedTuple):
     """
         A named tuple that represents the configuration of a patch coordinates.
@@ -31,44 +36,77 @@ class PatchConfig(NamedTuple):
 
 
 class ContinualGridWorld(Patch):
-    def __init__(self, size: int, agent_loc: Tuple[int, int] = None):
+    # millions of these can be cached at once, so a patch only holds its own state: the action,
+    # direction and reward tables are shared by the class, the object layout is a flat uint8 grid
+    # of labels and the observation buffer is only allocated once an observation is rendered.
+    # __dict__ (from Patch) is only created when something like instrument() adds an attribute
+    __slots__ = ('_size', 'observation_mode', '_rng', 'agent_loc', '_cell_num', '_labels',
+                 'copy_observation', '_observation', '_painted_agent', '_jit')
+
+    _action_dim = 5
+    _actions = {
+        Action.right.value: (0, 1),
+        Action.down.value: (1, 0),
+        Action.left.value: (0, -1),
+        Action.up.value: (-1, 0),
+        Action.stay.value: (0, 0)
+    }
+
+    _dir_mapping = {
+        Action.right.value: Direction.right,
+        Action.down.value: Direction.down,
+        Action.left.value: Direction.left,
+        Action.up.value: Direction.up
+    }
+
+    # reward of each label, indexed by label
+    _rewards = np.zeros(max(FLOWER, WEED) + 1, dtype=np.int64)
+    _rewards[FLOWER] = 1
+    _rewards[WEED] = -1
+    _rewards.flags.writeable = False
+
+    def __init__(self, size: int, agent_loc: Tuple[int, int] | None = None, jit: bool = False, copy_observation: bool = True,
+                 rng: np.random.Generator | None = None, observation_mode: str = 'both'):
         self._size = size
-        self._state = np.zeros(2)
+        self.observation_mode = check_observation_mode(observation_mode)
+
+        # with a generator of its own the layout is reproducible from that generator's seed
+        # and never changes, otherwise the patch draws from the global np.random state
+        self._rng = rng
         self.agent_loc = agent_loc
 
         # getting the total number of cells in the grid
         self._cell_num = self._size ** 2
 
-        self._action_dim = 5
-        self._actions = {
-            Action.right.value: (0, 1),
-            Action.down.value: (1, 0),
-            Action.left.value: (0, -1),
-            Action.up.value: (-1, 0),
-            Action.stay.value: (0, 0)
-        }
+        self._labels = self._get_labels()
 
-        self._dir_mapping = {
-            Action.right.value: Direction.right,
-            Action.down.value: Direction.down,
-            Action.left.value: Direction.left,
-            Action.up.value: Direction.up
-        }
+        # the observation is kept in a persistent buffer and only the agent cells are repainted.
+        # when copy_observation is False, callers get a read-only view of that buffer
+        self.copy_observation = copy_observation
+        self._reset_observation()
+
+        # optional numba backend for take_action/get_reward
+        self._jit = kernels.use_jit(jit)
 
-        self._rewards = {
-            FLOWER: 1,
-            WEED: -1
+    @property
+    def config(self) -> dict:
+        """ The objects as a dict of PatchConfig keyed by their unnormalized indices. """
+        return {
+            int(coord_idx): PatchConfig(int(self._labels[coord_idx]), *self._to_coords(int(coord_idx)))
+            for coord_idx in np.flatnonzero(self._labels)
         }
 
-        self.config = self._get_config()
-        print(self.config)
+    def _reset_observation(self) -> None:
+        self._observation: np.ndarray | None = None
+        self._painted_agent: Tuple[int, int] | None = None
 
     def _choose_objects(self) -> Tuple[np.ndarray, np.ndarray]:
         """ Returns a tuple of coordinates and corresponding labels of both jelly beans and onions. """
         object_num = min(
             max(int(self._cell_num * OBJECT_PERCENTAGE), 1), self._cell_num)
-        choosen_coords = np.random.choice(self._cell_num, object_num)
-        labels = np.random.choice(
+        random = np.random if self._rng is None else self._rng
+        choosen_coords = random.choice(self._cell_num, object_num)
+        labels = random.choice(
             [FLOWER, WEED], size=object_num)
         return choosen_coords, labels
 
@@ -83,29 +121,65 @@ class ContinualGridWorld(Patch):
 
     def _get_random_coordinate(self) -> Tuple[int, int]:
         """ Randomly chooses a coordinate that is not occupied. """
-        rand_state = np.random.randint(low=0, high=self._cell_num)
-        while rand_state in self.config.keys():
-            rand_state = np.random.randint(low=0, high=self._cell_num)
+        randint = np.random.randint if self._rng is None else self._rng.integers
+        rand_state = randint(low=0, high=self._cell_num)
+        while self._labels[rand_state]:
+            rand_state = randint(low=0, high=self._cell_num)
 
-        return self._to_coords(rand_state)
+        return self._to_coords(int(rand_state))
 
-    def _get_config(self) -> dict:
-        """ Returns a dict of PatchConfig objects where each corresponds to 
-        the object label and coordinates and the keys are unnormalized indices. """
+    def _get_labels(self) -> np.ndarray:
+        """ Returns the label of the object on every cell, 0 for empty cells, indexed by unnormalized index. """
         choosen_coords, labels = self._choose_objects()
 
-        config = {}
+        grid = np.zeros(self._cell_num, dtype=np.uint8)
+        # when a cell is chosen twice the last label wins
         for coord_idx, label in zip(choosen_coords, labels):
-            coords = self._to_coords(coord_idx)
-            config[coord_idx] = PatchConfig(label, *coords)
-        return config
+            grid[coord_idx] = label
+        return grid
+
+    def load(self, patch_state: dict) -> None:
+        """ Restores a patch from the output of `serialize` or `serialize_diff`. """
+        agent_loc = patch_state.get('agent_loc')
+        self.agent_loc = None if agent_loc is None else tuple(agent_loc)
+        if 'objects' in patch_state:
+            self._labels = np.zeros(self._cell_num, dtype=np.uint8)
+            for coord_idx, label, _, _ in patch_state['objects']:
+                self._labels[coord_idx] = label
+
+        self._reset_observation()
+
+    def on_enter(self, last_agent_state: np.ndarray) -> None:
+        """ The grid world keeps nothing from the patch the agent came from, the caller places the agent. """
+        return
+
+    def serialize(self) -> dict:
+        """ Returns a json friendly representation of the patch state. """
+        return {
+            'agent_loc': None if self.agent_loc is None else [int(v) for v in self.agent_loc],
+            'objects': [
+                [coord_idx, value.label, value.x, value.y]
+                for coord_idx, value in self.config.items()
+            ],
+        }
 
-    def reset(self) -> None:
+    def serialize_diff(self) -> dict | None:
+        """ A generated layout never changes and the agent is placed again on entry, so there is nothing to keep. """
+        if self._rng is None:
+            return self.serialize()
+        return None
+
+    def reset(self) -> Tuple[Any, Any]:
         """ Should only call this function once, at the very beginning of each run
         to give the strt position of the agent. """
         rand_state = self._get_random_coordinate()
         self.agent_loc = rand_state
-        return self.generate_state(), self.generate_observation()
+        return self._state_and_observation()
+
+    def _state_and_observation(self):
+        state = None if self.observation_mode == 'observation' else self.generate_state()
+        observation = None if self.observation_mode == 'state' else self.generate_observation()
+        return state, observation
 
     def generate_state(self) -> tuple:
         """ Getting the state of the grid world. """
@@ -113,10 +187,11 @@ class ContinualGridWorld(Patch):
 
     def get_reward(self) -> int:
         """ Getting the reward of the grid world. """
-        current_idx = self._to_idx(*self.agent_loc)
-        current_state = self.config.get(current_idx)
+        x, y = self.agent_loc
+        if self._jit:
+            return kernels.gw_get_reward(x, y, self._size, self._labels, self._rewards)
 
-        return self._rewards[current_state.label] if current_state else 0
+        return int(self._rewards[self._labels[self._to_idx(x, y)]])
 
     def get_action_dim(self) -> int:
         """ Getting the action dimension of the grid world."""
@@ -124,12 +199,17 @@ class ContinualGridWorld(Patch):
 
     def generate_observation(self) -> np.ndarray:
         """ Getting the observation of the grid world. """
-        grid = np.zeros((self._size, self._size))
-        for value in self.config.values():
-            grid[value.x, value.y] = value.label
+        grid = self._observation
+        if grid is None:
+            grid = self._observation = np.ascontiguousarray(
+                self._labels.reshape(self._size, self._size).T, dtype=np.float64)
+        elif self._painted_agent is not None:
+            px, py = self._painted_agent
+            grid[px, py] = self._labels[self._to_idx(px, py)]
 
         grid[self.agent_loc[0], self.agent_loc[1]] = AGENT
-        return grid
+        self._painted_agent = (self.agent_loc[0], self.agent_loc[1])
+        return observation_view(grid, self.copy_observation)
 
     def _check_bounds(self, x, y) -> Direction:
         return 0 <= x < self._size and 0 <= y < self._size
@@ -140,13 +220,39 @@ class ContinualGridWorld(Patch):
 
         # Ensuring the next position is within bounds
         reward = self.get_reward()
-        state = self.generate_state()
-        observation = self.generate_observation()
+        state, observation = self._state_and_observation()
 
         return state, observation, np.asarray(reward), direction
 
+    def step_batch(self, agent_locs: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Moves every agent in this patch at once. The patch's own agent_loc is left alone. """
+        actions = np.asarray(actions)
+        if ((actions < 0) | (actions >= self._action_dim)).any():
+            raise Exception(f'Unknown action: {actions[(actions < 0) | (actions >= self._action_dim)][0]}')
+
+        moved = agent_locs + _MOVES[actions]
+        inside = ((moved >= 0) & (moved < self._size)).all(axis=1)
+        next_locs = np.where(inside[:, None], moved, agent_locs)
+
+        # leaving through an edge reports the direction of the action, as in take_action
+        directions = np.where(inside, Direction.none.value, actions)
+
+        labels = self._labels[next_locs[:, 0] + next_locs[:, 1] * self._size]
+        rewards = self._rewards[labels].astype(np.float64)
+
+        return next_locs, rewards, directions
+
     def take_action(self, action: int):
         """ Takes an action and returns the new state. """
+        if self._jit:
+            if action not in self._actions.keys():
+                raise Exception(f'Unknown action: {action}')
+
+            x, y = self.agent_loc
+            x, y, d = kernels.gw_take_action(x, y, action, self._size, _MOVES)
+            self.agent_loc = x, y
+            return Direction(d)
+
         x, y = self.agent_loc
         if action in self._actions.keys():
             x += self._actions[action][0]
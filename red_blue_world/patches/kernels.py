@@ -0,0 +1,96 @@
+import numpy as np
+
+# numba is optional at runtime. Without it the kernels below are plain python
+# functions and the patches keep using their pure-python step implementations.
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):  # type: ignore[no-redef]
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+# Direction.none
+NO_DIRECTION = 4
+
+
+def use_jit(requested: bool) -> bool:
+    """ Returns whether the jit backend can actually be used. """
+    if requested and not NUMBA_AVAILABLE:
+        import warnings
+        warnings.warn('numba is not available, falling back to the pure-python step')
+        return False
+    return requested
+
+
+# ----------------------
+# -- ContinualGridWorld --
+# ----------------------
+
+@njit(cache=True)
+def gw_take_action(x, y, action, size, moves):
+    """ Returns the next (x, y) and the direction the agent is leaving in. """
+    nx = x + moves[action, 0]
+    ny = y + moves[action, 1]
+    if 0 <= nx < size and 0 <= ny < size:
+        return nx, ny, NO_DIRECTION
+
+    return x, y, action
+
+
+@njit(cache=True)
+def gw_get_reward(x, y, size, labels, rewards):
+    """ labels is a flat grid of object labels indexed like ContinualGridWorld._to_idx. """
+    return rewards[labels[x + y * size]]
+
+
+# -------------------------
+# -- ContinualCollectXY --
+# -------------------------
+
+@njit(cache=True)
+def collect_step(x, y, action, moves, obstacles, object_index, object_status, cell_reward):
+    """
+    Moves the agent and picks up the object under it, updating object_status in place.
+    object_index holds the index of the first object on each cell or -1 for empty cells.
+    Returns the next (x, y), the direction and the reward.
+    """
+    size = obstacles.shape[0]
+    nx = min(max(x + moves[action, 0], 0), size - 1)
+    ny = min(max(y + moves[action, 1], 0), size - 1)
+    if obstacles[nx, ny]:
+        nx, ny = x, y
+
+    direction = action
+    if nx == x and ny == y:
+        direction = NO_DIRECTION
+
+    reward = 0.0
+    object_idx = object_index[nx, ny]
+    if object_idx >= 0 and object_status[object_idx]:
+        object_status[object_idx] = 0.0
+        reward = cell_reward[nx, ny]
+
+    return nx, ny, direction, reward
+
+
+@njit(cache=True)
+def collect_no_rewarding_left(object_status, rewarding_objects):
+    """ True when every rewarding object has been picked up. """
+    for k in range(object_status.shape[0]):
+        if rewarding_objects[k] and object_status[k]:
+            return False
+    return True
+
+
+def build_object_index(object_coords, size: int) -> np.ndarray:
+    """ Grid of the first object index on every cell, mirroring object_coords.index. """
+    object_index = np.full((size, size), -1, dtype=np.int64)
+    for k in reversed(range(len(object_coords))):
+        ox, oy = object_coords[k]
+        object_index[ox, oy] = k
+    return object_index
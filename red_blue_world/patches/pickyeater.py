@@ -1,23 +1,116 @@
+import functools
 import numpy as np
 import matplotlib.pyplot as plt
+from typing import NamedTuple
 from red_blue_world.Patch import *
+from red_blue_world.patches import kernels
 
 PatchState = object
 
+GRAY = np.array([128., 128., 128.])
+RED = np.array([255., 0., 0.])
+BLUE = np.array([0., 0., 255.])
+YELLOW = np.array([255., 255., 0.])
+
+# every map is size x size cells, the patches are 15 x 15
+MAP_SIZE = 15
+
+# object coordinates are held as (k, 2) arrays of this dtype
+COORD_DTYPE = np.int16
+
+
+def four_rooms(size: int) -> np.ndarray:
+    """
+    Four rooms split by a wall through the middle row and column, with two doorways of two
+    cells in each wall. The last row and column are walls with the same doorways, so tiled
+    patches connect through them.
+    """
+    c = size // 2
+    first = c // 2 - 1
+    second = c + 1 + (size - c - 2) // 2
+    wall = np.ones(size)
+    wall[[first, first + 1, second, second + 1]] = 0.0
+
+    _map = np.zeros([size, size])
+    _map[c, :] = wall
+    _map[:, c] = wall
+    #bottom and right walls
+    _map[:, size - 1] = wall
+    _map[size - 1, :] = wall
+    return _map
+
+
+def open_room(size: int) -> np.ndarray:
+    """ No walls. """
+    return np.zeros([size, size])
+
+
+# named obstacle maps, built by shared_obstacles_map
+MAP_LAYOUTS = {
+    'four_rooms': four_rooms,
+    'open': open_room,
+}
+
+
+def shared_obstacles_map(layout: str = 'four_rooms', size: int = MAP_SIZE) -> np.ndarray:
+    """ The obstacle map of a layout, built once and shared (read-only) by every patch using it. """
+    return _obstacles_map(layout, size)
+
+
+def shared_empty_cells(layout: str = 'four_rooms', size: int = MAP_SIZE) -> np.ndarray:
+    """ The [x, y] of every cell of a layout that is not a wall, in row-major order. """
+    return _empty_cells(layout, size)
+
+
+def shared_main_template(layout: str = 'four_rooms', size: int = MAP_SIZE) -> np.ndarray:
+    """ The image of an empty map: black walls on a gray floor. """
+    return _main_template(layout, size)
+
+
+# the caches behind the shared_* functions, called positionally so every call hits the same key
+
+@functools.lru_cache(maxsize=None)
+def _obstacles_map(layout: str, size: int) -> np.ndarray:
+    if layout not in MAP_LAYOUTS:
+        raise NotImplementedError(f'Unknown map layout: {layout}')
+
+    _map = MAP_LAYOUTS[layout](size)
+    _map.flags.writeable = False
+    return _map
+
+
+@functools.lru_cache(maxsize=None)
+def _empty_cells(layout: str, size: int) -> np.ndarray:
+    cells = np.argwhere(_obstacles_map(layout, size) != 1.0)
+    cells.flags.writeable = False
+    return cells
+
+
+@functools.lru_cache(maxsize=None)
+def _main_template(layout: str, size: int) -> np.ndarray:
+    template = np.where(_obstacles_map(layout, size)[..., None] != 0, 0., GRAY)
+    template.flags.writeable = False
+    return template
+
 
 class CCPatch(Patch):
+    # millions of these can be cached at once, see ContinualGridWorld. The object coordinates
+    # (reds, blues and the blocks) are (k, 2) COORD_DTYPE arrays
+    __slots__ = ('last_agent_state', 'rewarding_color', 'rewarding_blocks', 'penalty_color', 'penalty_blocks',
+                 'reds', 'blues', 'object_status', 'agent_loc')
+
     def __init__(self, id: str):
         super(CCPatch, self).__init__(id)
         self.last_agent_state: np.ndarray | None = None
 
     def load(self, patch_state: PatchState) -> None:
         self.rewarding_color = patch_state['rewarding_color']
-        self.rewarding_blocks = patch_state['rewarding_blocks']
+        self.rewarding_blocks = _coords(patch_state['rewarding_blocks'])
         self.penalty_color = patch_state['penalty_color']
-        self.penalty_blocks = patch_state['penalty_blocks']
-        self.reds = patch_state['reds']
-        self.blues = patch_state['blues']
-        self.object_status = patch_state['object_status']
+        self.penalty_blocks = _coords(patch_state['penalty_blocks'])
+        self.reds = _coords(patch_state['reds'])
+        self.blues = _coords(patch_state['blues'])
+        self.object_status = np.array(patch_state['object_status'], dtype=np.float64)
         self.agent_loc = patch_state['agent_loc']
         self.last_agent_state = patch_state['last_agent_state']
         return
@@ -26,17 +119,22 @@ class CCPatch(Patch):
         self.last_agent_state = last_agent_state
         return
 
+    def observe_into(self, agent_loc, out: np.ndarray) -> None:
+        # the picky eaters render from their arguments, so agent_loc is left alone
+        out[...] = self.generate_observation(agent_loc, self.object_status, self.reds, self.blues)
+
     def serialize(self) -> PatchState:
+        # copies, a checkpoint holds on to this while the patch keeps stepping
         object = {
             "rewarding_color": self.rewarding_color,
-            "rewarding_blocks": self.rewarding_blocks,
+            "rewarding_blocks": _copy(self.rewarding_blocks),
             "penalty_color": self.penalty_color,
-            "penalty_blocks": self.penalty_blocks,
-            "reds": self.reds,
-            "blues": self.blues,
-            "object_status": self.object_status,
+            "penalty_blocks": _copy(self.penalty_blocks),
+            "reds": _copy(self.reds),
+            "blues": _copy(self.blues),
+            "object_status": _copy(self.object_status),
             "agent_loc": self.agent_loc,
-            "last_agent_state": self.last_agent_state
+            "last_agent_state": _copy(self.last_agent_state)
         }
         return object
 
@@ -49,23 +147,38 @@ class ContinualCollectXY(CCPatch):
     Reset fruit when there is no more fruit to pick
     """
 
-    def __init__(self, id: str, seed=np.random.randint(int(1e5)), num_objects=8):
+    # shared by every patch, as are the obstacle map and the templates
+    actions = [(0, 1), (1, 0), (0, -1), (-1, 0),
+               (0, 0)]  # right, down, left, up, stay
+    _moves = np.array(actions, dtype=np.int64)
+    _moves.flags.writeable = False
+
+    __slots__ = ('observation_mode', 'layout', '_rng', 'obstacles_map', 'object_coords', 'action_dim',
+                 'min_x', 'max_x', 'min_y', 'max_y', '_jit', '_object_index', '_cell_reward', '_rewarding_objects')
+
+    def __init__(self, id: str, seed=np.random.randint(int(1e5)), num_objects=8, jit=False,
+                 rng: np.random.Generator | None = None, observation_mode: str = 'both', layout: str = 'four_rooms'):
         super(ContinualCollectXY, self).__init__(id)
-        np.random.seed(seed)
-        self.obstacles_map = self.get_obstacles_map()
+        self.observation_mode = check_observation_mode(observation_mode)
+        self.layout = layout
+
+        # with a generator of its own the patch leaves the global np.random state alone
+        # and everything it draws is reproducible from that generator's seed
+        self._rng = rng
+        if rng is None:
+            np.random.seed(seed)
+        self.obstacles_map = shared_obstacles_map(layout)
         self.randomize_object_locations(num_objects)
 
         # one indiciate the object is available to be picked up
         self.object_status = np.ones(len(self.object_coords))
         self.action_dim = 4
 
-        self.actions = [(0, 1), (1, 0), (0, -1), (-1, 0),
-                        (0, 0)]  # right, down, left, up, stay
-
         self.agent_loc = (0, 0)
         self.object_status = np.ones(len(self.object_coords))
 
-        self.min_x, self.max_x, self.min_y, self.max_y = 0, 14, 0, 14
+        d = len(self.obstacles_map)
+        self.min_x, self.max_x, self.min_y, self.max_y = 0, d - 1, 0, d - 1
 
         self.blues, self.reds = None, None
         self.rewarding_color = 'red'
@@ -73,6 +186,28 @@ class ContinualCollectXY(CCPatch):
         self.penalty_color = 'blue'
         self.penalty_blocks = None
 
+        # optional numba backend for step/check_fruit_resetting
+        self._jit = kernels.use_jit(jit)
+        if self._jit:
+            self._object_index = kernels.build_object_index(self.object_coords, len(self.obstacles_map))
+
+    def _build_jit_tables(self):
+        """ Per-cell reward and rewarding-object tables used by the numba kernels. """
+        self._cell_reward = np.zeros(self.obstacles_map.shape)
+        for x, y in self.penalty_blocks:
+            self._cell_reward[x, y] = -1.0
+        for x, y in self.rewarding_blocks:
+            self._cell_reward[x, y] = 1.0
+
+        self._rewarding_objects = np.zeros(len(self.object_coords), dtype=bool)
+        for x, y in self.rewarding_blocks:
+            self._rewarding_objects[self._object_index[x, y]] = True
+
+    def load(self, patch_state: PatchState) -> None:
+        super().load(patch_state)
+        if self._jit:
+            self._build_jit_tables()
+
     def get_action_dim(self):
         return len(self.actions)
 
@@ -95,25 +230,37 @@ class ContinualCollectXY(CCPatch):
         """
         self.reset_fruit()
         while True:
-            rand_state = np.random.randint(low=0, high=15, size=2)
+            rand_state = self._randint(low=0, high=len(self.obstacles_map), size=2)
             rx, ry = rand_state
             if not int(self.obstacles_map[rx][ry]) and \
-                    not (rx, ry) in self.object_coords:
+                    not [rx, ry] in self.object_coords.tolist():
                 self.agent_loc = rx, ry
-                return self.generate_state(self.agent_loc, self.object_status, self.reds, self.blues), \
-                    self.generate_observation(
-                        self.agent_loc, self.object_status, self.reds, self.blues)
+                return self._state_and_observation()
+
+    def _state_and_observation(self):
+        state, observation = None, None
+        if self.observation_mode != 'observation':
+            state = self.generate_state(self.agent_loc, self.object_status, self.reds, self.blues)
+
+        if self.observation_mode == 'state':
+            pass
+        elif state is not None and type(self).generate_observation is ContinualCollectXY.generate_observation:
+            # the xy observation is the state, no need to build it twice
+            observation = state.copy()
+        else:
+            observation = self.generate_observation(self.agent_loc, self.object_status, self.reds, self.blues)
+        return state, observation
 
     def reset_fruit(self):
         obj_ids = np.arange(len(self.object_coords))
-        obj_ids = np.random.permutation(obj_ids)
+        obj_ids = self._random().permutation(obj_ids)
 
         red_ids, blue_ids = obj_ids[:len(
             obj_ids)//2], obj_ids[len(obj_ids)//2:]
 
-        self.reds = [self.object_coords[k] for k in red_ids]
-        self.blues = [self.object_coords[k] for k in blue_ids]
-        self.rewarding_color = np.random.choice(['red', 'blue'])
+        self.reds = self.object_coords[red_ids]
+        self.blues = self.object_coords[blue_ids]
+        self.rewarding_color = self._random().choice(['red', 'blue'])
         if self.rewarding_color == 'red':
             self.rewarding_blocks = self.reds
             self.penalty_blocks = self.blues
@@ -123,19 +270,59 @@ class ContinualCollectXY(CCPatch):
         else:
             raise NotImplementedError
         self.object_status = np.ones(len(self.object_coords))
+        if self._jit:
+            self._build_jit_tables()
         return
 
     def check_fruit_resetting(self):
-        non_rewarding = True
-        for [x, y] in self.rewarding_blocks:
-            object_idx = self.object_coords.index([x, y])
-            if self.object_status[object_idx]:
-                non_rewarding = False
+        if self._jit:
+            non_rewarding = kernels.collect_no_rewarding_left(self.object_status, self._rewarding_objects)
+        else:
+            non_rewarding = True
+            object_coords = self.object_coords.tolist()
+            for [x, y] in self.rewarding_blocks.tolist():
+                object_idx = object_coords.index([x, y])
+                if self.object_status[object_idx]:
+                    non_rewarding = False
         if non_rewarding:
             self.reset_fruit()
         return non_rewarding
 
     def step(self, a):
+        x, y, direction, reward = self._move(a)
+
+        self.agent_loc = x, y
+        self.check_fruit_resetting()
+
+        state, observation = self._state_and_observation()
+        return state, observation, np.asarray(reward), np.asarray(False), direction
+
+    def step_batch(self, agent_locs: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Moves every agent in this patch in turn, so they pick up from the same objects.
+        Walls and the map edge keep the agents inside the patch, so every direction is Direction.none.
+        """
+        saved = self.agent_loc
+        next_locs = np.array(agent_locs, copy=True)
+        rewards = np.zeros(len(actions))
+        for i in range(len(actions)):
+            self.agent_loc = tuple(agent_locs[i])
+            x, y, _, rewards[i] = self._move(int(actions[i]))
+            next_locs[i] = x, y
+            self.check_fruit_resetting()
+
+        self.agent_loc = saved
+        return next_locs, rewards, np.full(len(actions), Direction.none.value)
+
+    def _move(self, a):
+        if self._jit:
+            return kernels.collect_step(
+                *self.agent_loc, a, self._moves, self.obstacles_map,
+                self._object_index, self.object_status, self._cell_reward)
+        return self._take_action(a)
+
+    def _take_action(self, a):
+        """ Moves the agent and picks up objects. Returns the next (x, y), the direction and the reward. """
         dx, dy = self.actions[a]
         x, y = self.agent_loc
 
@@ -154,74 +341,60 @@ class ContinualCollectXY(CCPatch):
             direction = a
 
         reward = 0.0
-        if (x, y) in self.object_coords:
-            object_idx = self.object_coords.index((x, y))
+        # a handful of objects is searched faster as lists than with numpy
+        object_coords = self.object_coords.tolist()
+        if [x, y] in object_coords:
+            object_idx = object_coords.index([x, y])
             if self.object_status[object_idx]:
                 # the object is available for picking
                 self.object_status[object_idx] = 0.0
-                if (x, y) in self.rewarding_blocks:
+                if [x, y] in self.rewarding_blocks.tolist():
                     reward += 1.0
-                elif (x, y) in self.penalty_blocks:
+                elif [x, y] in self.penalty_blocks.tolist():
                     reward += -1.0
 
-        self.agent_loc = x, y
-        self.check_fruit_resetting()
-
-        state = self.generate_state(
-            self.agent_loc, self.object_status, self.reds, self.blues)
-        observation = self.generate_observation(
-            self.agent_loc, self.object_status, self.reds, self.blues)
-        return state, observation, np.asarray(reward), np.asarray(False), direction
+        return x, y, direction, reward
 
     def get_visualization_segment(self):
         raise NotImplementedError
 
-    def get_obstacles_map(self):
-        _map = np.zeros([15, 15])
-        _map[7, 0:2] = 1.0
-        _map[7, 4:11] = 1.0
-        _map[7, 13:] = 1.0
-
-        _map[0:2, 7] = 1.0
-        _map[4:11, 7] = 1.0
-        _map[13:, 7] = 1.0
-
-        #bottom wall
-        _map[0:2, 14] = 1.0
-        _map[4:7, 14] = 1.0
-        _map[7:11, 14] = 1.0
-        _map[13:15, 14] = 1.0
-
-        #right wall
-        _map[14, 0:2] = 1.0
-        _map[14, 4:7] = 1.0
-        _map[14, 7:11] = 1.0
-        _map[14, 13:15] = 1.0
-        return _map
+    @staticmethod
+    def get_obstacles_map():
+        """ A writable copy of the default map, patches use the shared one. """
+        return four_rooms(MAP_SIZE)
+
+    def _random(self):
+        return np.random if self._rng is None else self._rng
+
+    def _randint(self, low, high, size=None):
+        if self._rng is None:
+            return np.random.randint(low=low, high=high, size=size)
+        return self._rng.integers(low=low, high=high, size=size)
 
     def randomize_object_locations(self, total_objects):
         # get list of empty spaces, and randomly pick some spots to place fruits
-        empty_space = np.argwhere(self.obstacles_map != 1.0)
+        empty_space = shared_empty_cells(self.layout, len(self.obstacles_map))
         empty_space_ids = np.arange(len(empty_space))
-        object_locations = np.random.choice(empty_space_ids, total_objects)
-        self.object_coords = empty_space[object_locations].tolist()
+        object_locations = self._random().choice(empty_space_ids, total_objects)
+        self.object_coords = empty_space[object_locations].astype(COORD_DTYPE)
 
 
 class ContinualCollectRGB(ContinualCollectXY):
-    def __init__(self, id: str, seed=np.random.randint(int(1e5)), num_objects=8):
-        super().__init__(id, seed)
-        np.random.seed(seed)
+    __slots__ = ('copy_observation', 'state_dim', 'main_template', '_background', '_observation',
+                 '_painted_status', '_painted_agent')
+
+    def __init__(self, id: str, seed=np.random.randint(int(1e5)), num_objects=8, jit=False, copy_observation=True,
+                 rng: np.random.Generator | None = None, observation_mode: str = 'both', layout: str = 'four_rooms'):
+        super().__init__(id, seed, num_objects, jit, rng, observation_mode, layout)
+        if rng is None:
+            np.random.seed(seed)
+
+        # when False, observations are read-only views of a buffer that is updated in place
+        self.copy_observation = copy_observation
         d = len(self.obstacles_map)
         self.state_dim = (d, d, 3)
-        self.main_template = np.zeros(self.state_dim)
-        for x in range(d):
-            for y in range(d):
-                if self.obstacles_map[x][y]:
-                    self.main_template[x][y] = np.array([0, 0, 0])
-                else:
-                    self.main_template[x][y] = np.array([128, 128, 128])
-
-        self.episode_template = None
+        self.main_template = shared_main_template(layout, d)
+        self._reset_observation()
 
     def get_episode_template(self, reds, blues):
         episode_template = np.copy(self.main_template)
@@ -233,33 +406,68 @@ class ContinualCollectRGB(ContinualCollectXY):
 
     def reset_fruit(self):
         super(ContinualCollectRGB, self).reset_fruit()
-        self.episode_template = self.get_episode_template(
-            self.reds, self.blues)
+        self._reset_observation()
+
+    def load(self, patch_state: PatchState) -> None:
+        super().load(patch_state)
+        self._reset_observation()
+
+    def _reset_observation(self):
+        # the background is the episode template with consumed objects grayed out,
+        # the observation is the background with the agent painted on top.
+        # both are built on the first render, patches that are never looked at do not carry them
+        self._background = None
+        self._observation = None
+        self._painted_status = None
+        self._painted_agent = None
+
+    def _render_observation(self, agent_loc):
+        """ Repaints only the cells that changed since the last call and returns the persistent buffer. """
+        object_status = np.asarray(self.object_status)
+        if self._observation is not None:
+            changed = np.flatnonzero(self._painted_status != object_status)
+            if np.any(object_status[changed]):
+                # objects only come back through a fruit reset, so start over from the template
+                self._reset_observation()
+
+        if self._observation is None:
+            self._background = self.get_episode_template(self.reds, self.blues)
+            self._observation = np.copy(self._background)
+            self._painted_status = np.ones(len(self.object_coords))
+        changed = np.flatnonzero(self._painted_status != object_status)
+
+        for object_idx in changed:
+            ox, oy = self.object_coords[object_idx]
+            self._background[ox, oy] = GRAY
+            self._observation[ox, oy] = GRAY
+        self._painted_status[changed] = 0.0
+
+        if self._painted_agent is not None:
+            px, py = self._painted_agent
+            self._observation[px, py] = self._background[px, py]
 
-    def generate_observation(self, agent_loc, object_status, reds, blues):
-        state = np.copy(self.episode_template)
         x, y = agent_loc
+        self._observation[x, y] = YELLOW
+        self._painted_agent = (x, y)
+        return self._observation
 
-        for object_idx, coord in enumerate(self.object_coords):
-            if not self.object_status[object_idx]:
-                ox, oy = coord
-                state[ox][oy] = np.array([128, 128, 128])
-        state[x][y] = np.array([255, 255, 0])
-        return state
+    def generate_observation(self, agent_loc, object_status, reds, blues):
+        return observation_view(self._render_observation(agent_loc), self.copy_observation)
 
     def get_useful(self, img=None):
         raise NotImplementedError
 
     def get_visualization_segment(self):
-        if self.episode_template is not None:
+        if self.reds is not None:
             obj_ids = np.arange(len(self.object_coords))
-            obj_ids = np.random.permutation(obj_ids)
+            obj_ids = self._random().permutation(obj_ids)
             red_ids, blue_ids = obj_ids[:4], obj_ids[4:]
-            self.reds = [self.object_coords[k] for k in red_ids]
-            self.blues = [self.object_coords[k] for k in blue_ids]
+            self.reds = self.object_coords[red_ids]
+            self.blues = self.object_coords[blue_ids]
 
-            state_coords = [[x, y] for x in range(15)
-                            for y in range(15) if not int(self.obstacles_map[x][y])]
+            d = len(self.obstacles_map)
+            state_coords = [[x, y] for x in range(d)
+                            for y in range(d) if not int(self.obstacles_map[x][y])]
             states = [self.generate_observation(
                 coord, self.object_status, self.reds) for coord in state_coords]
             return np.array(states), np.array(state_coords)
@@ -267,37 +475,258 @@ class ContinualCollectRGB(ContinualCollectXY):
             raise NotImplementedError
 
 
+class ViewMasks(NamedTuple):
+    """
+        Visibility regions of a partially observable patch.
+        visible[region[x, y]] is True on the cells seen by an agent standing at (x, y).
+    """
+    visible: np.ndarray
+    region: np.ndarray
+
+
+@functools.lru_cache(maxsize=None)
+def quadrant_view_masks(size: int = 15) -> ViewMasks:
+    """ The agent sees its own room (quadrant), or both rooms joined by the corridor it is standing in. """
+    c = size // 2
+    visible = np.zeros((9, size, size), dtype=bool)
+    visible[0, :c + 1, :c + 1] = True
+    visible[1, c:, :c + 1] = True
+    visible[2, :c + 1, c:] = True
+    visible[3, c:, c:] = True
+    visible[4, :, :c + 1] = True
+    visible[5, :, c:] = True
+    visible[6, :c + 1, :] = True
+    visible[7, c:, :] = True
+    # full view, only reachable on maps without a wall at the centre
+    visible[8] = True
+
+    # region indexed by (sign(x - c) + 1, sign(y - c) + 1)
+    regions = np.array([
+        [0, 6, 2],
+        [4, 8, 5],
+        [1, 7, 3],
+    ])
+    side = np.sign(np.arange(size) - c) + 1
+    index = regions[side[:, None], side[None, :]]
+    return _read_only(ViewMasks(visible, index))
+
+
+@functools.lru_cache(maxsize=None)
+def egocentric_view_masks(size: int = 15, radius: int = 2) -> ViewMasks:
+    """ The agent sees a (2 * radius + 1) square window centred on itself. """
+    i = np.arange(size)
+    near = np.abs(i[:, None] - i[None, :]) <= radius
+    visible = near[:, None, :, None] & near[None, :, None, :]
+    visible = visible.reshape(size * size, size, size)
+    index = np.arange(size * size).reshape(size, size)
+    return _read_only(ViewMasks(visible, index))
+
+
+def _read_only(view: ViewMasks) -> ViewMasks:
+    # the masks are cached and shared by every patch
+    for arr in view:
+        arr.flags.writeable = False
+    return view
+
+
 class ContinualCollectPartial(ContinualCollectRGB):
-    def __init__(self, id: str, seed=np.random.randint(int(1e5)), num_objects=8):
-        super().__init__(id, seed)
+    __slots__ = ('_partial_observation', 'view_masks')
+
+    def __init__(self, id: str, seed=np.random.randint(int(1e5)), num_objects=8, jit=False, copy_observation=True,
+                 view_masks: ViewMasks | None = None, rng: np.random.Generator | None = None,
+                 observation_mode: str = 'both', layout: str = 'four_rooms'):
+        super().__init__(id, seed, num_objects, jit, copy_observation, rng, observation_mode, layout)
+        self._partial_observation = None
+        if view_masks is None:
+            view_masks = quadrant_view_masks(len(self.obstacles_map))
+        self.view_masks = view_masks
 
     def generate_observation(self, agent_loc, object_status, reds, blues):
-        state = super().generate_observation(agent_loc, object_status, reds, blues)
+        if self._partial_observation is None:
+            self._partial_observation = np.zeros(self.state_dim)
+        state = self._partial_observation
+        np.copyto(state, self._render_observation(agent_loc))
         x, y = agent_loc
-        if (x < 7 and y < 7):
-            visual = [[i, j] for i in range(0, 8) for j in range(0, 8)]
-        elif (x > 7 and y < 7):
-            visual = [[i, j] for i in range(7, 15) for j in range(0, 8)]
-        elif (x < 7 and y > 7):
-            visual = [[i, j] for i in range(0, 8) for j in range(7, 15)]
-        elif (x > 7 and y > 7):
-            visual = [[i, j] for i in range(7, 15) for j in range(7, 15)]
-        elif (x == 7 and y < 7):
-            visual = [[i, j] for i in range(0, 15) for j in range(0, 8)]
-        elif (x == 7 and y > 7):
-            visual = [[i, j] for i in range(0, 15) for j in range(7, 15)]
-        elif (x < 7 and y == 7):
-            visual = [[i, j] for i in range(0, 8) for j in range(0, 15)]
-        elif (x > 7 and y == 7):
-            visual = [[i, j] for i in range(7, 15) for j in range(0, 15)]
-        else:
-            raise NotImplementedError
-        for coord in [[i, j] for i in range(0, 15) for j in range(0, 15)]:
-            if coord not in visual:
-                state[coord[0], coord[1]] = np.array([128., 128., 128.])
-            # else:
-            #     print(coord, state[coord])
-        return state
+        state[~self.view_masks.visible[self.view_masks.region[x, y]]] = GRAY
+        return observation_view(state, self.copy_observation)
+
+
+class BatchedContinualCollect:
+    """
+    Steps N picky-eater patches with a single vectorized call.
+
+    Agent locations, object status, red/blue assignments and obstacle maps are
+    held as stacked (N, ...) arrays. Every environment owns a RandomState that is
+    seeded the same way the single-patch classes seed the global generator, so
+    row i reproduces a standalone ContinualCollectXY/RGB/Partial built with seeds[i].
+    """
+
+    # right, down, left, up, stay
+    ACTIONS = np.array([(0, 1), (1, 0), (0, -1), (-1, 0), (0, 0)])
+    STAY = 4
+
+    def __init__(self, seeds, observation='rgb', num_objects=8, view_masks: ViewMasks | None = None,
+                 observation_mode: str = 'both', layout: str = 'four_rooms'):
+        if observation not in ('xy', 'rgb', 'partial'):
+            raise NotImplementedError(f'Unknown observation type: {observation}')
+
+        self.observation = observation
+        self.observation_mode = check_observation_mode(observation_mode)
+        self.num_envs = len(seeds)
+        self.num_objects = num_objects
+
+        obstacles_map = shared_obstacles_map(layout)
+        self.size = len(obstacles_map)
+        n, k, d = self.num_envs, num_objects, self.size
+        self._env_ids = np.arange(n)
+
+        self.obstacles = np.repeat(obstacles_map[None] != 0, n, axis=0)
+        self.object_coords = np.zeros((n, k, 2), dtype=np.int64)
+        # index of the first object sitting on each cell, -1 for empty cells
+        self.object_index = np.full((n, d, d), -1, dtype=np.int64)
+
+        self._rngs = []
+        empty_space = shared_empty_cells(layout, self.size)
+        for i, seed in enumerate(seeds):
+            rng = np.random.RandomState(seed)
+            object_locations = rng.choice(np.arange(len(empty_space)), k)
+            self.object_coords[i] = empty_space[object_locations]
+
+            # the image based patches re-seed after placing the objects
+            if observation != 'xy':
+                rng = np.random.RandomState(seed)
+            self._rngs.append(rng)
+            self.object_index[i] = kernels.build_object_index(self.object_coords[i], d)
+
+        self.agent_loc = np.zeros((n, 2), dtype=np.int64)
+        self.object_status = np.ones((n, k))
+        self.red_ids = np.zeros((n, k // 2), dtype=np.int64)
+        self.blue_ids = np.zeros((n, k - k // 2), dtype=np.int64)
+        self.rewarding_red = np.ones(n, dtype=bool)
+
+        # reward handed out for picking up the object on each cell
+        self._cell_reward = np.zeros((n, d, d))
+        # objects whose availability keeps the fruit from resetting
+        self._rewarding_objects = np.zeros((n, k), dtype=bool)
+
+        self.main_template = np.where(self.obstacles[..., None], 0., GRAY)
+        self.episode_template = self.main_template.copy()
+        self.view_masks = view_masks if view_masks is not None else quadrant_view_masks(d)
+
+    def get_action_dim(self):
+        return len(self.ACTIONS)
+
+    def reset(self):
+        """
+        Should only call this function once, at the very beginning of each run
+        """
+        for i, rng in enumerate(self._rngs):
+            self._reset_fruit(i)
+            while True:
+                rx, ry = rng.randint(low=0, high=self.size, size=2)
+                if not self.obstacles[i, rx, ry] and self.object_index[i, rx, ry] < 0:
+                    self.agent_loc[i] = rx, ry
+                    break
+
+        return self._state_and_observation()
+
+    def _state_and_observation(self):
+        state = None if self.observation_mode == 'observation' else self.generate_state()
+        if self.observation_mode == 'state':
+            return state, None
+        if state is not None and self.observation == 'xy':
+            return state, state.copy()
+        return state, self.generate_observation()
+
+    def _reset_fruit(self, i):
+        rng = self._rngs[i]
+        obj_ids = rng.permutation(np.arange(self.num_objects))
+        self.red_ids[i] = obj_ids[:self.num_objects // 2]
+        self.blue_ids[i] = obj_ids[self.num_objects // 2:]
+        self.rewarding_red[i] = rng.choice(['red', 'blue']) == 'red'
+        self.object_status[i] = 1.0
+
+        reds = self.object_coords[i, self.red_ids[i]]
+        blues = self.object_coords[i, self.blue_ids[i]]
+        rewarding, penalty = (reds, blues) if self.rewarding_red[i] else (blues, reds)
+
+        # rewarding cells win over penalty cells when two objects share a cell
+        self._cell_reward[i] = 0.0
+        self._cell_reward[i, penalty[:, 0], penalty[:, 1]] = -1.0
+        self._cell_reward[i, rewarding[:, 0], rewarding[:, 1]] = 1.0
+
+        self._rewarding_objects[i] = False
+        self._rewarding_objects[i, self.object_index[i, rewarding[:, 0], rewarding[:, 1]]] = True
+
+        self.episode_template[i] = self.main_template[i]
+        self.episode_template[i, reds[:, 0], reds[:, 1]] = RED
+        self.episode_template[i, blues[:, 0], blues[:, 1]] = BLUE
+
+    def check_fruit_resetting(self):
+        """ Resets the fruit of every environment without rewarding objects left. Returns the reset mask. """
+        non_rewarding = ~np.any(self._rewarding_objects & (self.object_status != 0), axis=1)
+        for i in np.flatnonzero(non_rewarding):
+            self._reset_fruit(i)
+        return non_rewarding
+
+    def generate_state(self):
+        n = self.num_envs
+        reds = self.object_coords[self._env_ids[:, None], self.red_ids].reshape(n, -1)
+        blues = self.object_coords[self._env_ids[:, None], self.blue_ids].reshape(n, -1)
+        return np.concatenate([self.agent_loc, self.object_status, reds, blues], axis=1).astype(np.float64)
+
+    def generate_observation(self):
+        if self.observation == 'xy':
+            return self.generate_state()
+
+        ids = self._env_ids
+        obs = self.episode_template.copy()
+
+        env_idx, obj_idx = np.nonzero(self.object_status == 0)
+        consumed = self.object_coords[env_idx, obj_idx]
+        obs[env_idx, consumed[:, 0], consumed[:, 1]] = GRAY
+        obs[ids, self.agent_loc[:, 0], self.agent_loc[:, 1]] = YELLOW
+
+        if self.observation == 'partial':
+            hidden = ~self.view_masks.visible[self.view_masks.region[self.agent_loc[:, 0], self.agent_loc[:, 1]]]
+            obs[hidden] = GRAY
+
+        return obs
+
+    def step(self, actions):
+        ids = self._env_ids
+        actions = np.asarray(actions, dtype=np.int64)
+
+        # Ensuring the next position is within bounds and not an obstacle
+        nxt = np.clip(self.agent_loc + self.ACTIONS[actions], 0, self.size - 1)
+        blocked = self.obstacles[ids, nxt[:, 0], nxt[:, 1]]
+        nxt[blocked] = self.agent_loc[blocked]
+
+        moved = np.any(nxt != self.agent_loc, axis=1)
+        direction = np.where(moved, actions, self.STAY)
+
+        x, y = nxt[:, 0], nxt[:, 1]
+        obj = self.object_index[ids, x, y]
+        available = (obj >= 0) & (self.object_status[ids, np.maximum(obj, 0)] != 0)
+        reward = np.where(available, self._cell_reward[ids, x, y], 0.0)
+        self.object_status[ids[available], obj[available]] = 0.0
+
+        self.agent_loc = nxt
+        self.check_fruit_resetting()
+
+        state, observation = self._state_and_observation()
+        return state, observation, reward, np.zeros(self.num_envs, dtype=bool), direction
+
+
+def _coords(value) -> np.ndarray | None:
+    # serialized coordinates are lists of [x, y]
+    if value is None:
+        return None
+    return np.array(value, dtype=COORD_DTYPE).reshape(-1, 2)
+
+
+def _copy(value):
+    return None if value is None else value.copy()
 
 
 def draw(state):
@@ -0,0 +1,40 @@
+import numpy as np
+from multiprocessing import shared_memory
+from typing import Dict, Iterable, Tuple
+
+# numpy arrays backed by shared memory segments, used to hand results back from worker processes
+# the parent creates the arrays and passes their layout to the workers, which attach by name
+
+Layout = Dict[str, Tuple[str, Tuple[int, ...], str]]
+Arrays = Dict[str, Tuple[shared_memory.SharedMemory, np.ndarray]]
+
+
+def create_array(shape: Tuple[int, ...], dtype) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    """ Allocates a zeroed array in a new shared memory segment. """
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    arr.fill(0)
+    return shm, arr
+
+
+def layout(arrays: Arrays) -> Layout:
+    """ What a worker needs to attach to the arrays, picklable. """
+    return {name: (shm.name, arr.shape, arr.dtype.str) for name, (shm, arr) in arrays.items()}
+
+
+def attach(layout: Layout) -> Arrays:
+    arrays = {}
+    for name, (shm_name, shape, dtype) in layout.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        arrays[name] = (shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+    return arrays
+
+
+def release(segments: Iterable[shared_memory.SharedMemory], unlink: bool) -> None:
+    """ Closes the segments, and frees them when unlink is set (only the creating process should). """
+    for shm in segments:
+        shm.close()
+        if unlink:
+            shm.unlink()
@@ -0,0 +1,82 @@
+import unittest
+
+import numpy as np
+
+from red_blue_world.Env import RedBlueEnv, VectorRedBlueEnv
+from red_blue_world.patches.pickyeater import ContinualCollectRGB
+
+
+class TestVectorRedBlueEnv(unittest.TestCase):
+    def test_sync_matches_single_envs(self):
+        config = {'env_name': 'pe_rgb', 'grid_size': 15, 'seed': 10}
+        vec = VectorRedBlueEnv(config, 3)
+        states, observations = vec.reset()
+        self.assertEqual(observations.shape, (3, 15, 15, 3))
+
+        actions = np.random.RandomState(0).randint(5, size=(50, 3))
+        rewards = []
+        for a in actions:
+            _, _, r, _ = vec.step(a)
+            rewards.append(r)
+
+        # copy i behaves like a standalone env seeded with seed + i
+        for i in range(3):
+            env = ContinualCollectRGB('pe_rgb', seed=10 + i)
+            s, _ = env.reset()
+            np.testing.assert_array_equal(s, states[i])
+            for a, r in zip(actions[:, i], rewards):
+                _, _, reward, _, _ = env.step(a)
+                self.assertEqual(reward, r[i])
+
+    def test_subprocess_matches_sync(self):
+        config = {'env_name': 'pe_partial', 'grid_size': 15, 'seed': 0}
+        sync = VectorRedBlueEnv(config, 5)
+        sub = VectorRedBlueEnv(config, 5, mode='subprocess', num_workers=2)
+        try:
+            for a, b in zip(sync.reset(), sub.reset()):
+                np.testing.assert_array_equal(a, b)
+
+            rng = np.random.RandomState(1)
+            for _ in range(50):
+                actions = rng.randint(5, size=5)
+                for a, b in zip(sync.step(actions), sub.step(actions)):
+                    np.testing.assert_array_equal(a, b)
+        finally:
+            sub.close()
+
+    def test_grid_world(self):
+        vec = VectorRedBlueEnv({'env_name': 'gw', 'grid_size': 5}, 4)
+        states, observations = vec.reset()
+        self.assertEqual(states.shape, (4, 2))
+        self.assertEqual(observations.shape, (4, 5, 5))
+
+        for _ in range(20):
+            states, observations, rewards, directions = vec.step(np.zeros(4, dtype=np.int64))
+        # walking up long enough leaves the patch through its top edge
+        np.testing.assert_array_equal(directions, 0)
+
+    def test_subprocess_leaves_global_generator_alone(self):
+        np.random.seed(0)
+        expected = np.random.rand()
+
+        np.random.seed(0)
+        sub = VectorRedBlueEnv({'env_name': 'gw', 'grid_size': 5}, 2, mode='subprocess', num_workers=1)
+        sub.close()
+        self.assertEqual(np.random.rand(), expected)
+
+    def test_unknown_env(self):
+        with self.assertRaises(NotImplementedError):
+            RedBlueEnv({'env_name': 'nope', 'grid_size': 5})
+
+    def test_state_only(self):
+        config = {'env_name': 'pe_rgb', 'grid_size': 15, 'seed': 3}
+        both = VectorRedBlueEnv(config, 2)
+        states = VectorRedBlueEnv(dict(config, observation_mode='state'), 2)
+
+        s, o = states.reset()
+        self.assertIsNone(o)
+        np.testing.assert_array_equal(s, both.reset()[0])
+        for a in np.random.RandomState(2).randint(5, size=(30, 2)):
+            s, o, r, _ = states.step(a)
+            self.assertIsNone(o)
+            np.testing.assert_array_equal(s, both.step(a)[0])
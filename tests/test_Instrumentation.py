@@ -0,0 +1,47 @@
+import unittest
+
+import numpy as np
+
+from red_blue_world.Instrumentation import Histogram, InstrumentedStore, Stats
+from red_blue_world.Quilt import Quilt
+from tests.test_Quilt import random_walk
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles_within_bucket_width(self):
+        h = Histogram()
+        samples = np.random.RandomState(0).randint(1, 10**7, size=5000)
+        for ns in samples:
+            h.record(int(ns))
+
+        for q in (50, 99):
+            exact = np.percentile(samples, q)
+            self.assertLessEqual(abs(h.percentile(q) - exact), 0.25 * exact)
+
+
+class TestQuiltStats(unittest.TestCase):
+    def test_disabled_adds_nothing(self):
+        np.random.seed(0)
+        quilt = Quilt()
+        self.assertNotIn('step', vars(quilt))
+        self.assertNotIsInstance(quilt._store, InstrumentedStore)
+        self.assertEqual(quilt.stats_snapshot(), {'counters': {}, 'latency': {}, 'gauges': {}})
+        quilt.close()
+
+    def test_snapshot(self):
+        np.random.seed(0)
+        quilt = Quilt(max_patches=4, stats=Stats())
+        quilt.reset()
+        for _ in random_walk(quilt, 50, 1000, np.random.RandomState(0)):
+            pass
+        quilt.close()
+
+        snapshot = quilt.stats_snapshot()
+        latency = snapshot['latency']
+        self.assertEqual(latency['quilt.transition']['count'], 50)
+        self.assertEqual(latency['quilt.step']['count'], latency['patch.step']['count'])
+        for name in ('quilt.ensure_load', 'quilt.storage_load', 'quilt.build', 'quilt.write_back', 'store.store_patches'):
+            self.assertGreater(latency[name]['count'], 0)
+
+        self.assertGreater(snapshot['counters']['evict.written'], 0)
+        self.assertLessEqual(snapshot['gauges']['quilt.cache_size'], 4)
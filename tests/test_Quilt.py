@@ -1,7 +1,352 @@
+import copy
+import threading
 import unittest
-import os
-import shutil
+import tracemalloc
+
+import numpy as np
+
+from red_blue_world.patches.gw import Action
+from red_blue_world.patches.pickyeater import ContinualCollectRGB
+from red_blue_world.Instrumentation import Stats
+from red_blue_world.Quilt import SNAPSHOT_KEY, MultiAgentQuilt, Quilt
+from red_blue_world.StorageManager import StoreFactory, patch_key
+
+# how each action moves the agent across the patch plane
+PATCH_MOVES = {
+    Action.up.value: (0, 1),
+    Action.right.value: (1, 0),
+    Action.down.value: (0, -1),
+    Action.left.value: (-1, 0),
+}
+
+def random_walk(quilt: Quilt, transitions: int, world_size: int, rng: np.random.RandomState):
+    """ Walks the quilt in random directions, staying inside a world_size x world_size patch plane. """
+    for _ in range(transitions):
+        x, y = quilt._active_patch_id
+        while True:
+            a = rng.randint(4)
+            dx, dy = PATCH_MOVES[a]
+            if 0 <= x + dx < world_size and 0 <= y + dy < world_size:
+                break
+
+        start = quilt._active_patch_id
+        while quilt._active_patch_id == start:
+            quilt.step(a)
+
+        yield quilt._active_patch_id
+
+class PickyEaterQuilt(MultiAgentQuilt):
+    """ A world of picky-eater patches, every one built from the same generator seed. """
+    def build_patch(self, agent_loc, patch_id=None):
+        return ContinualCollectRGB(str(patch_id), rng=np.random.default_rng(8), observation_mode='state')
+
 
 class TestQuilt(unittest.TestCase):
-    def test_getBase(self):
-        ...
+    def test_unload_writes_back(self):
+        np.random.seed(0)
+        quilt = Quilt(max_patches=2)
+        quilt.reset()
+        first_state = quilt._active_patch.serialize()
+
+        # leaving twice pushes the first patch out of the working set
+        walk = random_walk(quilt, 2, 1000, np.random.RandomState(0))
+        list(walk)
+        self.assertNotIn((0, 0), quilt._patches)
+        self.assertTrue(quilt.patch_exists((0, 0)))
+
+        stored = quilt._store.load_patch_state(patch_key((0, 0)))
+        self.assertEqual(stored['objects'], first_state['objects'])
+
+        # re-entering rehydrates the same layout
+        quilt._ensure_load((0, 0), (0, 0))
+        self.assertEqual(quilt._patches[(0, 0)].serialize()['objects'], first_state['objects'])
+
+    def test_random_walk_memory_is_flat(self):
+        np.random.seed(0)
+        quilt = Quilt(max_patches=32)
+        quilt.reset()
+        walk = random_walk(quilt, 3000, 1000, np.random.RandomState(0))
+
+        tracemalloc.start()
+        for i, _ in enumerate(walk):
+            self.assertLessEqual(quilt.cache_size(), 32)
+            # simplejson keeps a bounded internal cache that takes a while to fill up
+            if i == 1500:
+                warm, _ = tracemalloc.get_traced_memory()
+        end, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertLess(end - warm, 256 * 1024)
+
+    def test_byte_budget(self):
+        np.random.seed(0)
+        quilt = Quilt(max_patches=None, max_bytes=64 * 1024)
+        quilt.reset()
+        for _ in random_walk(quilt, 200, 1000, np.random.RandomState(1)):
+            self.assertLessEqual(quilt._bytes, 64 * 1024)
+        self.assertGreater(quilt.cache_size(), 1)
+
+    def test_prefetch_finds_neighbors_resident(self):
+        np.random.seed(0)
+        quilt = Quilt(max_patches=32)
+        quilt.reset()
+        for _ in random_walk(quilt, 300, 1000, np.random.RandomState(2)):
+            self.assertLessEqual(quilt.cache_size(), 32)
+        quilt.close()
+
+        stats = quilt.prefetch_stats()
+        self.assertEqual(stats['hits'] + stats['waits'] + stats['misses'], 300)
+        self.assertLess(stats['misses'], stats['hits'])
+
+    def test_neighborhood_is_one_store_read(self):
+        np.random.seed(0)
+        stats = Stats()
+        quilt = Quilt(max_patches=64, prefetch=False, stats=stats)
+        quilt.reset()
+
+        # store a few patches of the neighborhood
+        for patch_id in [(1, 1), (-2, 3), (3, -3)]:
+            quilt._ensure_load(patch_id, None)
+            quilt.unload_patch(patch_id)
+        stored = {patch_id: quilt._store.load_patch_state(patch_key(patch_id)) for patch_id in [(1, 1), (-2, 3), (3, -3)]}
+
+        stats.reset()
+        quilt._ensure_load9x9((0, 0), None)
+        latency = stats.snapshot()['latency']
+        self.assertEqual(latency['store.load_patch_states']['count'], 1)
+        self.assertNotIn('store.patch_exists', latency)
+        self.assertNotIn('store.load_patch_state', latency)
+
+        counters = stats.snapshot()['counters']
+        self.assertEqual(counters['load.stored'], 3)
+        self.assertEqual(counters['load.built'], 48 - 3)
+        self.assertEqual(quilt.cache_size(), 49)
+        for patch_id, state in stored.items():
+            self.assertEqual(quilt._patches[patch_id].serialize()['objects'], state['objects'])
+
+    def test_concurrent_eviction_keeps_patches(self):
+        # a tiny budget on a small plane makes the prefetch thread and the stepping thread
+        # evict and reload the same patches over and over
+        np.random.seed(0)
+        quilt = Quilt(max_patches=3)
+        quilt.reset()
+
+        seen = {(0, 0): quilt._active_patch.serialize()['objects']}
+        for patch_id in random_walk(quilt, 5000, 5, np.random.RandomState(3)):
+            objects = quilt._active_patch.serialize()['objects']
+            self.assertEqual(objects, seen.setdefault(patch_id, objects))
+            self.assertLessEqual(quilt.cache_size(), 3)
+        quilt.close()
+
+        self.assertEqual(len(seen), 25)
+        for patch_id in seen:
+            self.assertTrue(quilt.patch_exists(patch_id))
+
+
+class TestMultiAgentQuilt(unittest.TestCase):
+    def test_single_agent_matches_quilt(self):
+        actions = np.random.RandomState(4).randint(5, size=600)
+
+        np.random.seed(0)
+        quilt = Quilt(prefetch=False)
+        expected = [quilt.reset()]
+        for a in actions:
+            _, r = quilt.step(a)
+            # Quilt returns the location inside the patch the agent just left
+            expected.append((quilt._active_patch.agent_loc, r, quilt._active_patch_id))
+
+        np.random.seed(0)
+        multi = MultiAgentQuilt(1, prefetch=False)
+        got = [multi.reset()[0]]
+        for a in actions:
+            s, r = multi.step(np.array([a]))
+            got.append((s[0], r[0], multi.agent_patch_ids()[0]))
+
+        np.testing.assert_array_equal(got[0], expected[0])
+        for (s, r, patch_id), (es, er, epatch_id) in zip(got[1:], expected[1:]):
+            np.testing.assert_array_equal(s, es)
+            self.assertEqual(r, er)
+            self.assertEqual(patch_id, epatch_id)
+
+    def test_agents_share_patches(self):
+        np.random.seed(0)
+        quilt = MultiAgentQuilt(64, max_patches=128)
+        quilt.reset()
+        rng = np.random.RandomState(5)
+
+        for _ in range(300):
+            states, rewards = quilt.step(rng.randint(5, size=64))
+            self.assertEqual(states.shape, (64, 2))
+            self.assertEqual(rewards.shape, (64,))
+
+            occupied = set(quilt.agent_patch_ids())
+            self.assertLessEqual(quilt.cache_size(), max(128, len(occupied)))
+            for patch_id in occupied:
+                self.assertIn(patch_id, quilt._patches)
+        quilt.close()
+
+        # agents that are in the same patch step through the same patch object
+        self.assertLess(len(occupied), 64)
+
+    def test_picky_eater_world(self):
+        quilt = PickyEaterQuilt(4, prefetch=False)
+        locs = quilt.reset()
+        # steps each agent in turn, with the objects and generator of the shared patch
+        twin = copy.deepcopy(quilt._patches[(0, 0)])
+
+        rng = np.random.RandomState(6)
+        for _ in range(300):
+            actions = rng.randint(5, size=4)
+            states, rewards = quilt.step(actions)
+            for i, a in enumerate(actions):
+                twin.agent_loc = tuple(locs[i])
+                _, _, reward, _, _ = twin.step(a)
+                np.testing.assert_array_equal(states[i], twin.agent_loc)
+                self.assertEqual(rewards[i], reward)
+            locs = states
+
+        # the walls keep every agent in its patch
+        self.assertEqual(quilt.agent_patch_ids(), [(0, 0)] * 4)
+        patch = quilt._patches[(0, 0)]
+        out = np.zeros(patch.state_dim)
+        for loc in locs:
+            patch.observe_into(loc, out)
+            np.testing.assert_array_equal(out, twin.generate_observation(loc, twin.object_status, twin.reds, twin.blues))
+        quilt.close()
+
+
+class TestProceduralQuilt(unittest.TestCase):
+    def test_layout_does_not_depend_on_route(self):
+        layouts = []
+        for walk_seed in (6, 7):
+            quilt = Quilt(max_patches=4, world_seed=11)
+            quilt.reset()
+            seen = {}
+            for patch_id in random_walk(quilt, 150, 4, np.random.RandomState(walk_seed)):
+                seen[patch_id] = quilt._active_patch.serialize()['objects']
+            quilt.close()
+            layouts.append(seen)
+
+        common = set(layouts[0]) & set(layouts[1])
+        self.assertGreater(len(common), 1)
+        for patch_id in common:
+            self.assertEqual(layouts[0][patch_id], layouts[1][patch_id])
+
+    def test_unchanged_patches_are_not_stored(self):
+        quilt = Quilt(max_patches=2, world_seed=3)
+        quilt.reset()
+        for _ in random_walk(quilt, 100, 3, np.random.RandomState(0)):
+            pass
+        quilt.close()
+
+        for x in range(3):
+            for y in range(3):
+                self.assertFalse(quilt._store.patch_exists(patch_key((x, y))))
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_restore_continues_the_walk(self):
+        np.random.seed(0)
+        snapshot = StoreFactory.create_store('sqlite_basic', ':memory:')
+        quilt = Quilt(max_patches=4, prefetch=False, snapshot=snapshot)
+        quilt.reset()
+
+        # checkpoints between transitions, the patches evicted in between are captured when written back
+        rng = np.random.RandomState(1)
+        for i, _ in enumerate(random_walk(quilt, 30, 6, rng)):
+            if i % 10 == 9:
+                quilt.checkpoint().result()
+
+        layouts = {}
+        for key in quilt._store.patch_ids():
+            layouts[key] = quilt._store.load_patch_state(key)['objects']
+        for patch_id, patch in quilt._patches.items():
+            layouts[patch_key(patch_id)] = patch.serialize()['objects']
+
+        restored = Quilt.restore(snapshot, max_patches=4, prefetch=False)
+        self.assertEqual(restored._active_patch_id, quilt._active_patch_id)
+        self.assertEqual(restored._active_patch.agent_loc, quilt._active_patch.agent_loc)
+        self.assertEqual(restored._t, quilt._t)
+        for key, objects in layouts.items():
+            self.assertEqual(snapshot.load_patch_state(key)['objects'], objects)
+
+        # both walk on identically through the patches built before the checkpoint. Later ones
+        # are drawn from the global generator without a world_seed
+        for a in np.random.RandomState(2).randint(5, size=300):
+            if patch_key(quilt._active_patch_id) not in layouts:
+                break
+            s, r = quilt.step(a)
+            restored_s, restored_r = restored.step(a)
+            np.testing.assert_array_equal(restored_s, s)
+            self.assertEqual(restored_r, r)
+            self.assertEqual(restored._active_patch_id, quilt._active_patch_id)
+        quilt.close()
+        restored.close()
+
+    def test_only_dirty_patches_are_written(self):
+        stats = Stats()
+        snapshot = StoreFactory.create_store('sqlite_basic', ':memory:')
+        quilt = Quilt(prefetch=False, snapshot=snapshot, stats=stats)
+        quilt.reset()
+        quilt.checkpoint().result()
+        self.assertEqual(stats.snapshot()['counters']['checkpoint.written'], 1)
+
+        # staying in the patch dirties only that patch
+        quilt.step(Action.stay.value)
+        quilt.checkpoint().result()
+        self.assertEqual(stats.snapshot()['counters']['checkpoint.written'], 2)
+
+        quilt.checkpoint().result()
+        self.assertEqual(stats.snapshot()['counters']['checkpoint.written'], 2)
+        self.assertEqual(snapshot.load_patch_state(SNAPSHOT_KEY)['t'], 1)
+        quilt.close()
+
+    def test_multi_agent_restore(self):
+        np.random.seed(0)
+        snapshot = StoreFactory.create_store('sqlite_basic', ':memory:')
+        quilt = MultiAgentQuilt(8, prefetch=False, world_seed=9, snapshot=snapshot)
+        quilt.reset()
+        rng = np.random.RandomState(3)
+        for _ in range(200):
+            quilt.step(rng.randint(5, size=8))
+        quilt.checkpoint().result()
+
+        # the world_seed comes from the checkpoint
+        restored = MultiAgentQuilt.restore(snapshot, num_agents=8, prefetch=False)
+        self.assertEqual(restored.agent_patch_ids(), quilt.agent_patch_ids())
+        for _ in range(200):
+            actions = rng.randint(5, size=8)
+            states, rewards = quilt.step(actions)
+            restored_states, restored_rewards = restored.step(actions)
+            np.testing.assert_array_equal(restored_states, states)
+            np.testing.assert_array_equal(restored_rewards, rewards)
+        quilt.close()
+        restored.close()
+
+    def test_checkpoint_is_not_changed_by_later_steps(self):
+        snapshot = StoreFactory.create_store('sqlite_basic', ':memory:')
+        quilt = PickyEaterQuilt(4, prefetch=False, snapshot=snapshot)
+        quilt.reset()
+        rng = np.random.RandomState(7)
+        for _ in range(100):
+            quilt.step(rng.randint(5, size=4))
+
+        # hold the background thread, so the checkpoint is written after the steps below
+        gate = threading.Event()
+        quilt._back_thread.submit(gate.wait)
+        written = quilt.checkpoint()
+        expected = copy.deepcopy(quilt._patches[(0, 0)].serialize())
+        locs = quilt._agent_locs.copy()
+        for _ in range(200):
+            quilt.step(rng.randint(5, size=4))
+        gate.set()
+        written.result()
+
+        restored = PickyEaterQuilt.restore(snapshot, num_agents=4, prefetch=False)
+        np.testing.assert_array_equal(restored._agent_locs, locs)
+        patch_state = restored._patches[(0, 0)].serialize()
+        self.assertEqual(set(patch_state), set(expected))
+        for key, value in expected.items():
+            np.testing.assert_array_equal(patch_state[key], value)
+        quilt.close()
+        restored.close()
@@ -0,0 +1,102 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from red_blue_world.Env import RedBlueEnv
+from red_blue_world.interfaces import Direction
+from red_blue_world.Quilt import MultiAgentQuilt, Quilt
+from red_blue_world.Recorder import TrajectoryRecorder, read_trajectory
+
+
+class TestTrajectoryRecorder(unittest.TestCase):
+    def test_round_trip(self):
+        rng = np.random.RandomState(0)
+        rows = [
+            ((rng.randint(-5, 5), rng.randint(-5, 5)), rng.randint(15, size=2), rng.rand(3, 3), rng.randint(5), rng.rand(), rng.randint(5))
+            for _ in range(1000)
+        ]
+
+        for format in ('npz', 'npy'):
+            with tempfile.TemporaryDirectory() as path:
+                with TrajectoryRecorder(path, chunk_size=64, num_buffers=3, format=format) as recorder:
+                    for row in rows[:500]:
+                        recorder.record(*row)
+                    # a partial chunk in the middle of the trajectory
+                    recorder.flush()
+                    columns = [np.array(column) for column in zip(*rows[500:])]
+                    recorder.record_batch(*columns)
+
+                batches = list(read_trajectory(path, batch_size=100))
+                self.assertEqual([len(b['action']) for b in batches], [100] * 10)
+
+                data = {name: np.concatenate([b[name] for b in batches]) for name in batches[0]}
+                for k, name in enumerate(('patch_id', 'state', 'observation', 'action', 'reward', 'direction')):
+                    np.testing.assert_array_equal(data[name], np.array([row[k] for row in rows]))
+
+    def test_rejects_mismatched_rows(self):
+        with tempfile.TemporaryDirectory() as path:
+            recorder = TrajectoryRecorder(path, chunk_size=4)
+            recorder.record((0, 0), np.zeros(2), None, 1, 0.0, 4)
+
+            # the observation column was left out by the first row
+            with self.assertRaises(ValueError):
+                recorder.record((0, 0), np.zeros(2), np.zeros((3, 3)), 1, 0.0, 4)
+            with self.assertRaises(ValueError):
+                recorder.record((0, 0), None, None, 1, 0.0, 4)
+            with self.assertRaises(ValueError):
+                recorder.record_batch(np.zeros((2, 2)), None, None, np.ones(2), np.zeros(2), np.full(2, 4))
+
+            recorder.close()
+            with self.assertRaises(ValueError):
+                recorder.record((0, 0), np.zeros(2), None, 1, 0.0, 4)
+
+            self.assertEqual(sum(len(b['action']) for b in read_trajectory(path)), 1)
+
+    def test_quilt(self):
+        with tempfile.TemporaryDirectory() as path:
+            np.random.seed(0)
+            with TrajectoryRecorder(path, chunk_size=128) as recorder:
+                quilt = Quilt(max_patches=8, recorder=recorder)
+                quilt.reset()
+                expected = []
+                for a in np.random.RandomState(1).randint(5, size=1000):
+                    patch_id = quilt._active_patch_id
+                    s, r = quilt.step(int(a))
+                    expected.append((patch_id, s, a, r))
+                quilt.close()
+
+            data = next(read_trajectory(path, batch_size=1000))
+            self.assertNotIn('observation', data)
+            np.testing.assert_array_equal(data['patch_id'], [e[0] for e in expected])
+            np.testing.assert_array_equal(data['state'], [e[1] for e in expected])
+            np.testing.assert_array_equal(data['action'], [e[2] for e in expected])
+            np.testing.assert_array_equal(data['reward'], [e[3] for e in expected])
+
+            # the recorded direction says when the agent left the patch
+            left = data['direction'] != Direction.none.value
+            moved = np.any(data['patch_id'][1:] != data['patch_id'][:-1], axis=1)
+            np.testing.assert_array_equal(left[:-1], moved)
+
+    def test_multi_agent_quilt(self):
+        with tempfile.TemporaryDirectory() as path:
+            with TrajectoryRecorder(path, chunk_size=100, format='npy') as recorder:
+                quilt = MultiAgentQuilt(4, max_patches=16, world_seed=0, recorder=recorder)
+                quilt.reset()
+                for a in np.random.RandomState(2).randint(5, size=(50, 4)):
+                    quilt.step(a)
+                quilt.close()
+
+            data = next(read_trajectory(path, batch_size=200))
+            self.assertEqual(len(data['action']), 200)
+            self.assertEqual(data['patch_id'].shape, (200, 2))
+
+    def test_env(self):
+        with tempfile.TemporaryDirectory() as path:
+            with TrajectoryRecorder(path) as recorder:
+                env = RedBlueEnv({'env_name': 'pe_rgb', 'grid_size': 15, 'seed': 0}, recorder=recorder)
+                env.reset()
+                observations = [env.step(a)[1] for a in [0, 1, 2, 3, 4] * 4]
+
+            data = next(read_trajectory(path))
+            np.testing.assert_array_equal(data['observation'], observations)
@@ -0,0 +1,36 @@
+import unittest
+
+import numpy as np
+
+from red_blue_world.patches.gw import AGENT
+from red_blue_world.ShardedQuilt import ShardedQuilt, _owner
+
+
+class TestShardedQuilt(unittest.TestCase):
+    def test_agents_cross_regions(self):
+        # one patch per region, so every transition hands the agent to another worker
+        quilt = ShardedQuilt(8, 2, region_size=1, seed=0)
+        try:
+            states, observations = quilt.reset()
+            self.assertEqual(observations.shape, (8, 15, 15))
+
+            rng = np.random.RandomState(0)
+            total = np.zeros(8)
+            for _ in range(400):
+                states, observations, rewards = quilt.step(rng.randint(5, size=8))
+                total += np.abs(rewards)
+
+                # every observation shows its own agent where its state says it is
+                for i in range(8):
+                    self.assertEqual(observations[i, states[i, 0], states[i, 1]], AGENT)
+        finally:
+            quilt.close()
+
+        self.assertGreater(total.sum(), 0)
+
+    def test_owner_stripes(self):
+        # a region's four neighbors are never owned by the same worker as the region
+        for x, y in [(0, 0), (3, -2), (-5, 7)]:
+            owner = _owner((x, y), 4, 1)
+            for nx, ny in [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]:
+                self.assertNotEqual(_owner((nx, ny), 4, 1), owner)
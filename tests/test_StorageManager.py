@@ -2,9 +2,13 @@ import unittest
 import os
 import json
 import shutil
-from red_blue_world.StorageManager import StoreFactory
+import sqlite3
+import tempfile
+from red_blue_world.Instrumentation import InstrumentedStore, Stats
+from red_blue_world.StorageManager import IndexedStore, StoreFactory, patch_key, parse_patch_key
 from typing import NamedTuple
 import simplejson
+import numpy as np
 
 class TestPatchConfig(NamedTuple):
     label: int
@@ -46,3 +50,248 @@ class TestSqliteBasicStorage(unittest.TestCase):
         exists_2 = sqlite_basic.patch_exists(patch_id="def456")
         self.assertTrue(exists_1)
         self.assertFalse(exists_2)
+
+
+class TestSqliteBasicStorageFiles(unittest.TestCase):
+
+    def setUp(self):
+        # every database goes into a directory of its own, so reruns start from nothing
+        self._tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _db(self, name: str) -> str:
+        return os.path.join(self._tmp.name, name)
+
+    def test_store_patches(self):
+
+        sqlite_basic = StoreFactory.create_store("sqlite_basic", self._db("store_patches_test.db"))
+        items = [(str(i), {"grid_weather" : "hot", "cells" : [i, i + 1]}) for i in range(100)]
+        sqlite_basic.store_patches(items)
+
+        patch_states_stored = dict(sqlite_basic.load_patch_states(patch_ids=[str(i) for i in range(100)]))
+        self.assertDictEqual(patch_states_stored, dict(items))
+
+    def test_buffered_store(self):
+
+        sqlite_basic = StoreFactory.create_store("sqlite_basic", self._db("buffered_store_test.db"), buffer_size=10)
+        for i in range(15):
+            sqlite_basic.store_patch(patch_id=str(i), patch_state={"cells" : [i]})
+
+        # the first 10 were flushed together, the rest are still queued but visible
+        self.assertEqual(sqlite_basic.con.execute("SELECT COUNT(*) FROM patches").fetchone()[0], 10)
+        self.assertTrue(sqlite_basic.patch_exists(patch_id="14"))
+        self.assertDictEqual(sqlite_basic.load_patch_state(patch_id="14"), {"cells" : [14]})
+
+        sqlite_basic.flush()
+        self.assertEqual(sqlite_basic.con.execute("SELECT COUNT(*) FROM patches").fetchone()[0], 15)
+        sqlite_basic.close()
+
+    def test_binary_codec(self):
+
+        sqlite_basic = StoreFactory.create_store("sqlite_basic", self._db("binary_codec_test.db"), codec="binary")
+        original_patch_state = {
+            "rewarding_color": "red",
+            "reds": [[1, 2], [3, 4]],
+            "object_status": np.array([1.0, 0.0, 1.0]),
+            "last_agent_state": None,
+        }
+        sqlite_basic.store_patch(patch_id="abc123", patch_state=original_patch_state)
+        patch_state_stored = sqlite_basic.load_patch_state(patch_id="abc123")
+
+        self.assertEqual(patch_state_stored["rewarding_color"], "red")
+        self.assertEqual(patch_state_stored["reds"], [[1, 2], [3, 4]])
+        self.assertIsNone(patch_state_stored["last_agent_state"])
+        self.assertTrue(np.array_equal(patch_state_stored["object_status"], original_patch_state["object_status"]))
+
+    def test_reads_json_rows(self):
+
+        sqlite_basic = StoreFactory.create_store("sqlite_basic", self._db("json_rows_test.db"), codec="binary")
+        original_patch_state = {"grid_weather" : "hot", "cells" : [1, 2, 3]}
+
+        # a row written as json text before the store switched codecs
+        sqlite_basic._write([("abc123", simplejson.dumps(original_patch_state))])
+        sqlite_basic.store_patch(patch_id="def456", patch_state=original_patch_state)
+
+        patch_states_stored = sqlite_basic.load_patch_states(patch_ids=["abc123", "def456"])
+        self.assertListEqual(patch_states_stored, [("abc123", original_patch_state), ("def456", original_patch_state)])
+
+    def test_persistent_reopen(self):
+
+        sqlite_basic = StoreFactory.create_store("sqlite_basic", self._db("persistent_test.db"), buffer_size=10)
+        sqlite_basic.store_patches([(patch_key((x, 0)), {"cells" : [x]}) for x in range(5)])
+        sqlite_basic.store_patch(patch_id=patch_key((9, 9)), patch_state={"cells" : [9]})
+        sqlite_basic.close()
+
+        reopened = StoreFactory.create_store("sqlite_basic", self._db("persistent_test.db"), persistent=True, index="exact")
+        self.assertTrue(reopened.patch_exists(patch_id=patch_key((9, 9))))
+        self.assertFalse(reopened.patch_exists(patch_id=patch_key((5, 0))))
+        self.assertDictEqual(reopened.load_patch_state(patch_id=patch_key((3, 0))), {"cells" : [3]})
+        reopened.close()
+
+        # without persistent the database starts over
+        fresh = StoreFactory.create_store("sqlite_basic", self._db("persistent_test.db"))
+        self.assertFalse(fresh.patch_exists(patch_id=patch_key((3, 0))))
+        fresh.close()
+
+    def test_load_region(self):
+
+        sqlite_basic = StoreFactory.create_store("sqlite_basic", self._db("load_region_test.db"), buffer_size=100)
+        coords = [(x, y) for x in range(-10, 10) for y in range(-10, 10)]
+        sqlite_basic.store_patches([(patch_key(c), {"cells" : list(c)}) for c in coords])
+        sqlite_basic.store_patch(patch_id="abc123", patch_state={"cells" : []})
+
+        region = sqlite_basic.load_region(-3, -2, 3, 4)
+        self.assertCountEqual([patch_id for patch_id, _ in region],
+                              [patch_key((x, y)) for x in range(-3, 4) for y in range(-2, 5)])
+        for patch_id, patch_state in region:
+            self.assertListEqual(patch_state["cells"], list(parse_patch_key(patch_id)))
+
+        self.assertListEqual(sqlite_basic.load_region(20, 20, 30, 30), [])
+        self.assertEqual(len(sqlite_basic.load_region(-100, -100, 100, 100)), len(coords))
+        sqlite_basic.close()
+
+    def test_migrates_v1(self):
+
+        # a database written with the version 1 table, keyed by patch_id alone
+        con = sqlite3.connect(self._db("migrate_v1_test.db"))
+        with con:
+            con.execute("CREATE TABLE patches(patch_id TEXT PRIMARY KEY, patch_state BLOB NOT NULL)")
+            con.execute("INSERT INTO patches VALUES(?, ?)", (patch_key((1, 2)), simplejson.dumps({"cells" : [1, 2]})))
+            con.execute("INSERT INTO patches VALUES(?, ?)", ("abc123", simplejson.dumps({"cells" : []})))
+            con.execute("PRAGMA user_version=1")
+        con.close()
+
+        sqlite_basic = StoreFactory.create_store("sqlite_basic", self._db("migrate_v1_test.db"), persistent=True)
+        self.assertDictEqual(sqlite_basic.load_patch_state(patch_id=patch_key((1, 2))), {"cells" : [1, 2]})
+        self.assertTrue(sqlite_basic.patch_exists(patch_id="abc123"))
+        self.assertEqual(len(sqlite_basic.load_region(0, 0, 2, 2)), 1)
+        sqlite_basic.close()
+
+    def test_opens_unversioned_json_database(self):
+
+        db_name = self._db("unversioned_test.db")
+
+        # the table of the stores from before the schema was versioned, json text and user_version 0
+        con = sqlite3.connect(db_name)
+        with con:
+            con.execute("CREATE TABLE patches(patch_id TEXT PRIMARY KEY, patch_state TEXT NOT NULL)")
+            con.execute("INSERT INTO patches VALUES(?, ?)", ("abc123", simplejson.dumps({"cells" : [1, 2]})))
+        con.close()
+
+        sqlite_basic = StoreFactory.create_store("sqlite_basic", db_name, persistent=True)
+        self.assertDictEqual(sqlite_basic.load_patch_state(patch_id="abc123"), {"cells" : [1, 2]})
+        self.assertListEqual(sqlite_basic.load_patch_states(patch_ids=["abc123"]), [("abc123", {"cells" : [1, 2]})])
+        self.assertEqual(len(sqlite_basic.load_region(0, 0, 1, 1)), 0)
+        sqlite_basic.close()
+
+    def test_schema_version(self):
+
+        sqlite_basic = StoreFactory.create_store("sqlite_basic", self._db("schema_version_test.db"))
+        sqlite_basic.con.execute("PRAGMA user_version=99")
+        sqlite_basic.close()
+
+        with self.assertRaises(ValueError):
+            StoreFactory.create_store("sqlite_basic", self._db("schema_version_test.db"), persistent=True)
+
+    def test_independent_instances(self):
+
+        first = StoreFactory.create_store("sqlite_basic", ":memory:")
+        second = StoreFactory.create_store("sqlite_basic", ":memory:")
+        first.store_patch(patch_id="abc123", patch_state={"cells" : [1]})
+
+        self.assertIsNot(first, second)
+        self.assertTrue(first.patch_exists(patch_id="abc123"))
+        self.assertFalse(second.patch_exists(patch_id="abc123"))
+        first.close()
+        second.close()
+
+
+class TestMmapTiledStorage(unittest.TestCase):
+
+    def test_load_patch_state(self):
+
+        store = StoreFactory.create_store("mmap_tiled", record_size=256, tile_size=4)
+        original_patch_state = {"agent_loc" : [1, 2], "objects" : [[0, 1, 0, 0], [17, 2, 2, 1]]}
+        store.store_patch(patch_id=patch_key((-3, 5)), patch_state=original_patch_state)
+
+        self.assertDictEqual(store.load_patch_state(patch_id=patch_key((-3, 5))), original_patch_state)
+        self.assertDictEqual(store.load_patch_state(patch_id=patch_key((3, 5))), {})
+        store.close()
+
+    def test_load_patch_states(self):
+
+        store = StoreFactory.create_store("mmap_tiled", record_size=256, tile_size=4)
+
+        # spread over several tiles, and enough of them to grow the file
+        coords = [(x, y) for x in range(-5, 6) for y in range(-5, 6)]
+        for x, y in coords:
+            store.store_patch(patch_id=patch_key((x, y)), patch_state={"cells" : [x, y]})
+
+        neighborhood = [patch_key((x, y)) for x in range(-1, 2) for y in range(-1, 2)] + [patch_key((50, 50))]
+        patch_states_stored = dict(store.load_patch_states(patch_ids=neighborhood))
+
+        self.assertEqual(len(patch_states_stored), 9)
+        for key, patch_state in patch_states_stored.items():
+            self.assertEqual(patch_state["cells"], list(parse_patch_key(key)))
+        store.close()
+
+    def test_patch_exists(self):
+
+        store = StoreFactory.create_store("mmap_tiled", record_size=256)
+        store.store_patch(patch_id=(0, 0), patch_state={"cells" : []})
+        self.assertTrue(store.patch_exists(patch_id=(0, 0)))
+        self.assertFalse(store.patch_exists(patch_id=(1, 0)))
+        self.assertFalse(store.patch_exists(patch_id=(100, 0)))
+        self.assertRaises(ValueError, lambda: store.store_patch(patch_id=(0, 0), patch_state={"cells" : list(range(1000))}))
+        self.assertRaises(ValueError, lambda: store.store_patch(patch_id="quilt", patch_state={"cells" : []}))
+        store.close()
+
+    def test_load_region(self):
+
+        store = StoreFactory.create_store("mmap_tiled", record_size=256)
+        store.store_patches([(patch_key((x, y)), {"cells" : [x, y]}) for x in range(-10, 10) for y in range(-10, 10)])
+        region = store.load_region(-3, -2, 3, 4)
+        self.assertCountEqual([patch_id for patch_id, _ in region],
+                              [patch_key((x, y)) for x in range(-3, 4) for y in range(-2, 5)])
+        store.close()
+
+
+class TestIndexedStore(unittest.TestCase):
+
+    def test_negative_lookups_skip_the_store(self):
+
+        for index in ("exact", "bloom"):
+            stats = Stats()
+            inner = InstrumentedStore(StoreFactory.create_store("sqlite_basic", ":memory:"), stats)
+            store = IndexedStore(inner, index, expected_patches=1000)
+            store.store_patches([(patch_key((x, 0)), {"cells" : [x]}) for x in range(10)])
+            store.store_patch(patch_id="abc123", patch_state={"cells" : []})
+
+            stats.reset()
+            for x in range(1000, 1100):
+                self.assertFalse(store.patch_exists(patch_id=patch_key((x, -x))))
+                self.assertDictEqual(store.load_patch_state(patch_id=patch_key((x, -x))), {})
+            self.assertListEqual(store.load_patch_states(patch_ids=[patch_key((-1, 1)), patch_key((-2, 1))]), [])
+            # a bloom filter may let a few false positives through
+            self.assertLess(sum(h['count'] for h in stats.snapshot()['latency'].values()), 10)
+
+            self.assertTrue(store.patch_exists(patch_id=patch_key((3, 0))))
+            self.assertTrue(store.patch_exists(patch_id="abc123"))
+            self.assertEqual(len(store.load_patch_states(patch_ids=[patch_key((x, 0)) for x in range(-5, 5)])), 5)
+            store.close()
+
+    def test_rebuilds_from_store(self):
+
+        for store_type in ("sqlite_basic", "mmap_tiled"):
+            inner = StoreFactory.create_store(store_type, ":memory:")
+            coords = [(x, y) for x in range(-20, 20) for y in range(-20, 20) if (x + y) % 3 == 0]
+            inner.store_patches([(patch_key(c), {"cells" : list(c)}) for c in coords])
+
+            for index in ("exact", "bloom"):
+                store = IndexedStore(inner, index, expected_patches=len(coords))
+                for x in range(-20, 20):
+                    for y in range(-20, 20):
+                        self.assertEqual(store.patch_exists(patch_id=patch_key((x, y))), (x + y) % 3 == 0)
+            inner.close()
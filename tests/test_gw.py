@@ -0,0 +1,59 @@
+import unittest
+
+import numpy as np
+
+from red_blue_world.interfaces import Direction
+from red_blue_world.patches.gw import AGENT, ContinualGridWorld
+
+
+class TestContinualGridWorld(unittest.TestCase):
+    def test_serialize_round_trip(self):
+        patch = ContinualGridWorld(15, rng=np.random.default_rng(0))
+        patch.reset()
+
+        copy = ContinualGridWorld(15, rng=np.random.default_rng(1))
+        copy.load(patch.serialize())
+        self.assertEqual(copy.config, patch.config)
+        self.assertEqual(copy.serialize(), patch.serialize())
+
+    def test_step_batch_matches_step(self):
+        patch = ContinualGridWorld(15, rng=np.random.default_rng(2))
+        locs = np.array([(x, y) for x in range(15) for y in range(15)])
+        for action in range(5):
+            next_locs, rewards, directions = patch.step_batch(locs, np.full(len(locs), action))
+            for loc, next_loc, r, d in zip(locs, next_locs, rewards, directions):
+                patch.agent_loc = tuple(loc)
+                s, _, reward, direction = patch.step(action)
+                np.testing.assert_array_equal(s, next_loc)
+                self.assertEqual(reward, r)
+                self.assertEqual(direction, Direction(d))
+
+    def test_jit_matches_python_step(self, steps=500):
+        outputs = []
+        for jit in (False, True):
+            patch = ContinualGridWorld(15, jit=jit, rng=np.random.default_rng(4))
+            trajectory = [patch.reset()]
+            for a in np.random.RandomState(0).randint(5, size=steps):
+                trajectory.append(patch.step(a))
+            outputs.append(trajectory)
+
+        for python_out, jit_out in zip(*outputs):
+            for p, j in zip(python_out, jit_out):
+                if isinstance(p, Direction):
+                    self.assertEqual(p, j)
+                else:
+                    np.testing.assert_array_equal(p, j)
+
+    def test_observation(self):
+        patch = ContinualGridWorld(15, rng=np.random.default_rng(3), observation_mode='state')
+        patch.reset()
+        for a in [0, 1, 1, 2, 3, 3, 4] * 5:
+            patch.step(a)
+        self.assertIsNone(patch._observation)
+
+        expected = np.zeros((15, 15))
+        for value in patch.config.values():
+            expected[value.x, value.y] = value.label
+        expected[patch.agent_loc] = AGENT
+        np.testing.assert_array_equal(patch.generate_observation(), expected)
+
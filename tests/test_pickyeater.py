@@ -5,7 +5,9 @@ import numpy as np
 import sys
 sys.path.insert(0, '..')
 
-from red_blue_world.patches.pickyeater import ContinualCollectRGB, ContinualCollectPartial, draw
+from red_blue_world.Codec import get_codec
+from red_blue_world.interfaces import Direction
+from red_blue_world.patches.pickyeater import COORD_DTYPE, BatchedContinualCollect, ContinualCollectXY, ContinualCollectRGB, ContinualCollectPartial, draw, egocentric_view_masks, shared_obstacles_map
 
 class TestConfig(unittest.TestCase):
     # def test_step(self, test_steps=10):
@@ -45,7 +47,7 @@ class TestConfig(unittest.TestCase):
         """Hack the environment"""
         rb = env.rewarding_blocks
         for b in rb:
-            idx = env.object_coords.index(b)
+            idx = env.object_coords.tolist().index(b.tolist())
             env.object_status[idx] = 0
         self.assertTrue(env.check_fruit_resetting(), "Should add fruit now")
         self.assertTrue(env.object_status.sum() == len(env.object_status), "All object_status should be 1")
@@ -55,7 +57,7 @@ class TestConfig(unittest.TestCase):
         state = env.reset()
         pb = env.penalty_blocks
         for b in pb:
-            idx = env.object_coords.index(b)
+            idx = env.object_coords.tolist().index(b.tolist())
             env.object_status[idx] = 0
         self.assertTrue(not env.check_fruit_resetting(), "Should Not add fruit now")
         self.assertTrue(env.object_status.sum() == len(env.object_status) // 2, "Only rewarding object_status should be 1")
@@ -66,10 +68,229 @@ class TestConfig(unittest.TestCase):
         rb = env.rewarding_blocks
         pb = env.penalty_blocks
         for b in pb[:len(pb)//2]:
-            idx = env.object_coords.index(b)
+            idx = env.object_coords.tolist().index(b.tolist())
             env.object_status[idx] = 0
         for b in rb:
-            idx = env.object_coords.index(b)
+            idx = env.object_coords.tolist().index(b.tolist())
             env.object_status[idx] = 0
         self.assertTrue(env.check_fruit_resetting(), "Should add fruit now")
         self.assertTrue(env.object_status.sum() == len(env.object_status), "All object_status should be 1")
+
+
+class TestBatchedContinualCollect(unittest.TestCase):
+    def test_matches_independent_patches(self, steps=200):
+        seeds = list(range(8))
+        actions = np.random.RandomState(0).randint(5, size=(steps, len(seeds)))
+
+        for observation, cls in [('xy', ContinualCollectXY), ('rgb', ContinualCollectRGB), ('partial', ContinualCollectPartial)]:
+            # each patch is run on its own, since they all share the global random state
+            expected = []
+            for i, seed in enumerate(seeds):
+                env = cls(id='(0,0)', seed=seed)
+                outputs = [env.reset()]
+                for t in range(steps):
+                    outputs.append(env.step(actions[t, i]))
+                expected.append(outputs)
+
+            batch = BatchedContinualCollect(seeds, observation=observation)
+            state, obs = batch.reset()
+            self.assertTrue(np.array_equal(state, np.stack([e[0][0] for e in expected])))
+            self.assertTrue(np.array_equal(obs, np.stack([e[0][1] for e in expected])))
+
+            for t in range(steps):
+                outputs = batch.step(actions[t])
+                for k in (0, 1, 2, 4):
+                    target = np.stack([np.asarray(e[t + 1][k]) for e in expected])
+                    self.assertTrue(np.array_equal(outputs[k], target), f"{observation}: mismatch at step {t}")
+
+
+class TestJitBackend(unittest.TestCase):
+    def test_matches_python_step(self, steps=300):
+        for cls in [ContinualCollectXY, ContinualCollectRGB, ContinualCollectPartial]:
+            outputs = []
+            for jit in (False, True):
+                env = cls(id='(0,0)', seed=3, jit=jit)
+                trajectory = [env.reset()]
+                actions = np.random.RandomState(0).randint(env.get_action_dim(), size=steps)
+                for a in actions:
+                    trajectory.append(env.step(a))
+                outputs.append(trajectory)
+
+            for python_out, jit_out in zip(*outputs):
+                for p, j in zip(python_out, jit_out):
+                    self.assertTrue(np.array_equal(np.asarray(p), np.asarray(j)))
+
+    def test_load_rebuilds_tables(self):
+        env = ContinualCollectRGB(id='(0,0)', seed=0, jit=True)
+        env.reset()
+        state = env.serialize()
+        state['object_status'] = [0.0] * len(env.object_coords)
+        env.load(state)
+        self.assertTrue(env.check_fruit_resetting(), "Should add fruit now")
+
+
+class TestObservationBuffer(unittest.TestCase):
+    def test_view_matches_copy(self, steps=200):
+        for cls in [ContinualCollectRGB, ContinualCollectPartial]:
+            actions = np.random.RandomState(0).randint(5, size=steps)
+
+            # run one after the other, the patches share the global random state
+            trajectories = []
+            for copy_observation in (True, False):
+                env = cls(id='(0,0)', seed=1, copy_observation=copy_observation)
+                _, obs = env.reset()
+                observations = [np.array(obs)]
+                for a in actions:
+                    _, obs, _, _, _ = env.step(a)
+                    observations.append(np.array(obs))
+                trajectories.append(observations)
+                self.assertEqual(obs.flags.writeable, copy_observation)
+
+            for obs_c, obs_v in zip(*trajectories):
+                self.assertTrue(np.array_equal(obs_c, obs_v))
+
+
+class TestViewMasks(unittest.TestCase):
+    def test_egocentric_window(self, steps=50):
+        env = ContinualCollectPartial(id='(0,0)', seed=2, view_masks=egocentric_view_masks(15, radius=2))
+        env.reset()
+        for a in np.random.RandomState(0).randint(5, size=steps):
+            _, obs, _, _, _ = env.step(a)
+            x, y = env.agent_loc
+            full = env._render_observation(env.agent_loc)
+
+            i, j = np.meshgrid(np.arange(15), np.arange(15), indexing='ij')
+            inside = (np.abs(i - x) <= 2) & (np.abs(j - y) <= 2)
+            self.assertTrue(np.array_equal(obs[inside], full[inside]))
+            self.assertTrue(np.all(obs[~inside] == 128.))
+
+
+class TestLocalGenerator(unittest.TestCase):
+    def test_generator_leaves_global_state_alone(self):
+        np.random.seed(0)
+        expected = np.random.rand()
+
+        np.random.seed(0)
+        trajectories = []
+        for _ in range(2):
+            env = ContinualCollectRGB('test', rng=np.random.default_rng(5))
+            s, _ = env.reset()
+            states = [s]
+            for a in [0, 1, 1, 2, 3, 3, 0, 4] * 10:
+                s, _, _, _, _ = env.step(a)
+                states.append(s)
+            trajectories.append(np.array(states))
+
+        self.assertEqual(np.random.rand(), expected)
+        np.testing.assert_array_equal(trajectories[0], trajectories[1])
+
+
+class TestObservationMode(unittest.TestCase):
+    def test_skipped_parts_match_both(self, steps=200):
+        for cls in [ContinualCollectXY, ContinualCollectRGB, ContinualCollectPartial]:
+            actions = np.random.RandomState(0).randint(5, size=steps)
+
+            trajectories = {}
+            for mode in ('both', 'state', 'observation'):
+                env = cls(id='(0,0)', rng=np.random.default_rng(4), observation_mode=mode)
+                trajectory = [env.reset()]
+                for a in actions:
+                    s, obs, _, _, _ = env.step(a)
+                    trajectory.append((s, obs))
+                trajectories[mode] = trajectory
+
+            for both, state, observation in zip(trajectories['both'], trajectories['state'], trajectories['observation']):
+                self.assertIsNone(state[1])
+                self.assertIsNone(observation[0])
+                np.testing.assert_array_equal(both[0], state[0])
+                np.testing.assert_array_equal(both[1], observation[1])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(NotImplementedError):
+            ContinualCollectXY(id='(0,0)', observation_mode='pixels')
+
+
+class TestSharedTables(unittest.TestCase):
+    def test_obstacles_and_template_are_shared(self):
+        a = ContinualCollectRGB('a', rng=np.random.default_rng(0))
+        b = ContinualCollectPartial('b', rng=np.random.default_rng(1))
+        self.assertIs(a.obstacles_map, b.obstacles_map)
+        self.assertIs(a.main_template, b.main_template)
+        self.assertFalse(a.obstacles_map.flags.writeable)
+        np.testing.assert_array_equal(a.obstacles_map, ContinualCollectXY.get_obstacles_map())
+
+    def test_compact_layout(self):
+        env = ContinualCollectPartial('compact', rng=np.random.default_rng(0), observation_mode='state')
+        env.reset()
+        for a in np.random.RandomState(0).randint(5, size=50):
+            env.step(a)
+
+        # every attribute has a slot and nothing is rendered in state mode
+        self.assertEqual(vars(env), {})
+        self.assertIsNone(env._observation)
+        for coords in (env.object_coords, env.reds, env.blues, env.rewarding_blocks, env.penalty_blocks):
+            self.assertEqual(coords.dtype, COORD_DTYPE)
+
+        # the stored state keeps coordinates as lists
+        codec = get_codec('json')
+        copy = ContinualCollectPartial('compact', rng=np.random.default_rng(0))
+        copy.load(codec.decode(codec.encode(env.serialize())))
+        for key in ('reds', 'blues', 'rewarding_blocks', 'penalty_blocks', 'object_status'):
+            np.testing.assert_array_equal(getattr(copy, key), getattr(env, key))
+            self.assertEqual(getattr(copy, key).dtype, getattr(env, key).dtype)
+        np.testing.assert_array_equal(copy.generate_observation(env.agent_loc, copy.object_status, copy.reds, copy.blues),
+                                      env.generate_observation(env.agent_loc, env.object_status, env.reds, env.blues))
+
+    def test_layouts(self):
+        # the default layout keeps the original hand written map
+        expected = np.zeros([15, 15])
+        expected[7, [0, 1, 4, 5, 6, 7, 8, 9, 10, 13, 14]] = 1.0
+        expected[[0, 1, 4, 5, 6, 7, 8, 9, 10, 13, 14], 7] = 1.0
+        expected[[0, 1, 4, 5, 6, 7, 8, 9, 10, 13, 14], 14] = 1.0
+        expected[14, [0, 1, 4, 5, 6, 7, 8, 9, 10, 13, 14]] = 1.0
+        np.testing.assert_array_equal(shared_obstacles_map('four_rooms', 15), expected)
+        self.assertIs(shared_obstacles_map('four_rooms', 15), shared_obstacles_map())
+
+        env = ContinualCollectRGB('open', rng=np.random.default_rng(0), layout='open')
+        _, obs = env.reset()
+        self.assertFalse(np.any(np.all(obs == 0., axis=-1)))
+
+        with self.assertRaises(NotImplementedError):
+            ContinualCollectXY('nope', layout='maze')
+
+
+class TestSharedPatch(unittest.TestCase):
+    def test_step_batch_matches_step(self, steps=100):
+        for cls in [ContinualCollectXY, ContinualCollectRGB, ContinualCollectPartial]:
+            batched = cls('batched', rng=np.random.default_rng(6))
+            single = cls('single', rng=np.random.default_rng(6))
+            batched.reset()
+            single.reset()
+
+            rng = np.random.RandomState(0)
+            locs = np.array([single.agent_loc] * 4, dtype=np.int64)
+            for _ in range(steps):
+                actions = rng.randint(5, size=len(locs))
+                next_locs, rewards, directions = batched.step_batch(locs, actions)
+                for i, a in enumerate(actions):
+                    single.agent_loc = tuple(locs[i])
+                    _, _, reward, _, _ = single.step(a)
+                    np.testing.assert_array_equal(next_locs[i], single.agent_loc)
+                    self.assertEqual(rewards[i], reward)
+                self.assertTrue(np.all(directions == Direction.none.value))
+                np.testing.assert_array_equal(batched.object_status, single.object_status)
+                locs = next_locs
+
+    def test_observe_into(self):
+        for cls in [ContinualCollectXY, ContinualCollectRGB, ContinualCollectPartial]:
+            env = cls('observe', rng=np.random.default_rng(7))
+            env.reset()
+            agent_loc = env.agent_loc
+            _, expected = cls('observe', rng=np.random.default_rng(7)).reset()
+            for loc in [(0, 0), (3, 12), agent_loc]:
+                out = np.zeros_like(expected)
+                env.observe_into(loc, out)
+                np.testing.assert_array_equal(
+                    out, env.generate_observation(loc, env.object_status, env.reds, env.blues))
+            self.assertEqual(env.agent_loc, agent_loc)
+            np.testing.assert_array_equal(out, expected)